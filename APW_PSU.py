@@ -1,5 +1,10 @@
+import array
 import bitcrane
+import threading
 import time
+import weakref
+
+from metrics import metrics, STATUS_OK, STATUS_TIMEOUT
 
 PSU_CMD_GET_HW_VERSION = 0x02
 PSU_CMD_GET_FW_VERSION = 0x01
@@ -10,86 +15,281 @@ PSU_CMD_DISABLE_WDT = 0x81
 PSU_CMD_FEED_WDT = 0x0A
 PSU_CMD_READ_CAL = 0x06
 
+PSU_I2C_ADDR = 0x10
+PSU_I2C_REG = 0x11
+
+PSU_RESPONSE_TIMEOUT = 2.0  # seconds to keep polling for a valid response
+PSU_POLL_MIN = 0.005        # first poll interval, doubled after every invalid read
+PSU_POLL_MAX = 0.2
+PSU_LATENCY_ALPHA = 0.25    # weight of the newest sample in the latency estimate
+PSU_BULK_FAILURES = 3       # bulk transfers that must fail in a row before a port is marked as lacking them
+PSU_LOCK_STEP_REQUESTS = 2  # control requests a PSU lock holder makes between pauses with bulk transfers (a read and its tail)
+PSU_FRAME_MAX = 8           # bytes in the longest command frame (two argument bytes)
+PSU_EXCHANGE_REQUESTS = 3   # control requests of an uncontended bulk exchange: write, read, tail read
+
+# default linear conversions, used until a unit's own calibration is loaded (see psu_cal.py)
+PSU_SET_OFFSET = 15.092         # volts at setpoint code 0
+PSU_SET_SLOPE = -0.013          # volts per setpoint code
+PSU_MEASURE_SCALE = 63.017      # measurement counts per volt
+PSU_MEASURE_OFFSET = 0.8615     # measurement counts at 0 V
+PSU_MEASURE_TABLE_SIZE = 1 << 12
+
+# learned seconds from request to valid response, keyed by PSU command byte
+psu_latency = {}
+
+# firmware support for whole-frame PSU transfers, per control port: True/False once probed
+psu_bulk_support = weakref.WeakKeyDictionary()
+# bulk transfers failed in a row on a port that has never completed one
+psu_bulk_failures = weakref.WeakKeyDictionary()
+
+class PsuLock:
+    """
+    One PSU command at a time per control port, so frames from different
+    threads don't interleave on the bridge. Urgent holders (safety-lane
+    views, e.g. the watchdog feeder) go ahead of every waiting normal one,
+    and a normal holder pauses between bridge operations (between single
+    bytes of a per-byte read, after a whole per-byte write) and while it
+    waits for the PSU, letting urgent ones run in between. An urgent command
+    therefore waits for at most one step of a long exchange, not all of it.
+    Re-entrant for the thread that holds it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._owner = None
+        self._owner_urgent = False
+        self._depth = 0
+        self._urgent_waiting = 0
+        self._urgent_runs = 0
+        self._paused = False
+
+    def acquire(self, urgent=False):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            if urgent:
+                self._urgent_waiting += 1
+                while self._owner is not None:
+                    self._cond.wait()
+                self._urgent_waiting -= 1
+                self._urgent_runs += 1
+            else:
+                while self._owner is not None or self._urgent_waiting or self._paused:
+                    self._cond.wait()
+            self._owner = me
+            self._owner_urgent = urgent
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def pause(self, seconds=0.0):
+        """
+        Sleep for seconds with the lock open to urgent holders only, then take
+        it back (after any urgent holder that got in is done). A pause of 0
+        only yields if an urgent holder is waiting. Urgent holders just sleep.
+        Returns True if an urgent holder ran, i.e. the PSU may have answered
+        its command since and the caller's reply is gone.
+        """
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner != me or self._owner_urgent or (seconds <= 0 and not self._urgent_waiting):
+                holding = False
+            else:
+                holding = True
+                runs = self._urgent_runs
+                depth = self._depth
+                self._owner = None
+                self._paused = True
+                self._cond.notify_all()
+        if seconds > 0:
+            time.sleep(seconds)
+        if not holding:
+            return False
+        with self._cond:
+            while self._owner is not None or self._urgent_waiting:
+                self._cond.wait()
+            self._owner = me
+            self._owner_urgent = False
+            self._depth = depth
+            self._paused = False
+            return self._urgent_runs != runs
+
+class PsuPreempted(Exception):
+    """An urgent PSU command ran during a paused exchange, which has to start over."""
+
+psu_locks = weakref.WeakKeyDictionary()
+_psu_locks_lock = threading.Lock()
+
+def psu_port(ser):
+    """The object PSU state is kept for; views of one port (ctrl_scheduler lanes) share their scheduler's."""
+    return getattr(ser, 'scheduler', ser)
+
+def psu_step_requests(ser):
+    """
+    Most control requests a normal PSU lock holder on ser's port makes
+    between pauses: a bulk read and its tail, or without bulk transfers a
+    whole per-byte command frame (after a failed bulk try while support is
+    still unknown).
+    """
+    bulk = psu_bulk_support.get(psu_port(ser))
+    if bulk is True:
+        return PSU_LOCK_STEP_REQUESTS
+    if bulk is False:
+        return max(PSU_LOCK_STEP_REQUESTS, PSU_FRAME_MAX)
+    return 1 + PSU_FRAME_MAX
+
+def psu_exchange_requests(ser, packet_len, num_read_bytes):
+    """
+    Control requests in an uncontended exchange on ser's port: three with
+    bulk transfers, one per byte written and read (plus a tail read of up to
+    a frame) without, and both while bulk support is still unknown.
+    """
+    bulk = psu_bulk_support.get(psu_port(ser))
+    per_byte = packet_len + 2 * num_read_bytes - 1
+    if bulk is True:
+        return PSU_EXCHANGE_REQUESTS
+    if bulk is False:
+        return per_byte
+    return PSU_EXCHANGE_REQUESTS + per_byte
+
+def psu_lock(ser):
+    port = psu_port(ser)
+    with _psu_locks_lock:
+        lock = psu_locks.get(port)
+        if lock is None:
+            lock = psu_locks[port] = PsuLock()
+    return lock
+
 
 #send a single byte to a register over I2C
 def i2c_send_byte(ser, address, register, data, debug=False):
     id = 0xBC
     packet = bytes([0x09, 0x00, id, 0x00, bitcrane.PAGE_PSU, bitcrane.I2C_COMMAND_WRITE, address, register, data])
-    ser.write(packet)
     size = 1
-    if debug:
-        print("ctrl tx: [%s]" % bitcrane.prettyHex(packet))
-    data = ser.read(size+3)
-    if data:
-        bytes_read = len(data)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl rx: [%s]" % bitcrane.prettyHex(data))
-            if data[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, data[2]))
-                return None
-        else:
-            print("No data received")
-            return None
-    else:
-        print("No data received")
+    data = bitcrane.ctrl_transaction(ser, packet, size+3, debug)
+    if data is None:
         return None
 
     return data[-size:]
 
 #read a single byte over I2C
 def i2c_read_byte(ser, address, debug=False):
-    ser.reset_input_buffer()
     size = 1
     id = 0xAB
     packet = bytes([0x08, 0x00, id, 0x00, bitcrane.PAGE_PSU, bitcrane.I2C_COMMAND_READ, address, size])
-    ser.write(packet)
-    if debug:
-        print("ctrl tx: [%s]" % bitcrane.prettyHex(packet))
-    data = ser.read(size+3)
-    if data:
-        bytes_read = len(data)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl rx: [%s]" % bitcrane.prettyHex(data))
-            if data[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, data[2]))
-                return None
-        else:
-            print("No data received")
-            return None
-    else:
-        print("No data received")
+    data = bitcrane.ctrl_transaction(ser, packet, size+3, debug)
+    if data is None:
         return None
 
     return data[-size:]
 
+#write a whole frame to a register over I2C in one control transaction
+def i2c_send_frame(ser, address, register, data_bytes, debug=False):
+    id = 0xBD
+    packet = bytes([0x08 + len(data_bytes), 0x00, id, 0x00, bitcrane.PAGE_PSU, bitcrane.I2C_COMMAND_WRITE, address, register]) + bytes(data_bytes)
+    data = bitcrane.ctrl_transaction(ser, packet, 4, debug)
+    if data is None or len(data) < 4:
+        return None
+
+    return data[3:]
+
+#read num_bytes over I2C in one control transaction
+def i2c_read_frame(ser, address, num_bytes, debug=False):
+    id = 0xAD
+    packet = bytes([0x08, 0x00, id, 0x00, bitcrane.PAGE_PSU, bitcrane.I2C_COMMAND_READ, address, num_bytes])
+    data = bitcrane.ctrl_transaction(ser, packet, num_bytes+3, debug)
+    if data is None or len(data) != num_bytes+3:
+        return None
+
+    return data[3:]
+
+def psu_bulk_result(ser, ok):
+    """
+    Record the outcome of a bulk PSU transfer on ser's port. Any success marks
+    the port as supporting them; it is only marked as lacking them after
+    PSU_BULK_FAILURES failures in a row without one, so a transient error
+    doesn't send every later transfer down the per-byte path.
+    """
+    port = psu_port(ser)
+    if ok:
+        psu_bulk_support[port] = True
+        psu_bulk_failures.pop(port, None)
+    elif psu_bulk_support.get(port) is None:
+        failures = psu_bulk_failures.get(port, 0) + 1
+        psu_bulk_failures[port] = failures
+        if failures >= PSU_BULK_FAILURES:
+            psu_bulk_support[port] = False
+
 def psu_send_bytes(ser, address, register, data_bytes, debug=False):
     """
-    Send a list of bytes individually via I2C, checking response for each.
+    Send a list of bytes to the PSU.
+    The whole frame goes out in one control transaction. If that fails the
+    bytes are sent individually, checking the response for each; when the
+    per-byte path works but the bulk one has failed PSU_BULK_FAILURES times
+    running without ever working, the port is remembered as lacking bulk
+    support and later calls go straight to per-byte.
+    A per-byte write isn't paused for urgent commands: the PSU takes a frame
+    as the next length-byte-many bytes, so an urgent frame written into a
+    cut one would be swallowed, and padding the cut frame out costs as many
+    requests as finishing it.
     Returns True if all bytes sent successfully, False otherwise.
     """
     if debug:
         print(f"Sending bytes to PSU: [{' '.join(f'{b:02X}' for b in data_bytes)}]")
+    bulk = psu_bulk_support.get(psu_port(ser))
+    if bulk is not False:
+        if i2c_send_frame(ser, address, register, data_bytes, debug) is not None:
+            psu_bulk_result(ser, True)
+            return True
+        if debug:
+            print("PSU bulk write failed, falling back to per-byte writes")
     for i, byte in enumerate(data_bytes):
         result = i2c_send_byte(ser, address, register, byte, debug)
         if result is None:
-            print(f"Error: Failed to send byte {i} (0x{byte:02X})")
+            if debug:
+                print(f"Error: Failed to send byte {i} (0x{byte:02X})")
             return False
+    if bulk is None:
+        psu_bulk_result(ser, False)
     return True
 
-def psu_read_bytes(ser, address, num_bytes, debug=False):
+def psu_read_bytes(ser, address, num_bytes, debug=False, lock=None):
     """
-    Read a number of bytes individually via I2C, checking response for each.
+    Read a number of bytes from the PSU.
+    Uses a single multi-byte read unless the port is known to lack bulk
+    support (see psu_bulk_result), otherwise reads the bytes individually,
+    checking the response for each. With the caller's PsuLock, per-byte
+    reads pause it between bytes and raise PsuPreempted if an urgent
+    command got in and took the response.
     Returns list of bytes read, or None if any read fails.
     """
+    bulk = psu_bulk_support.get(psu_port(ser))
+    if bulk is not False:
+        data = i2c_read_frame(ser, address, num_bytes, debug)
+        if data is not None:
+            psu_bulk_result(ser, True)
+            return list(data)
+        if debug:
+            print("PSU bulk read failed, falling back to per-byte reads")
     result = []
     for i in range(num_bytes):
+        if i and lock is not None and lock.pause():
+            raise PsuPreempted()
         byte = i2c_read_byte(ser, address, debug)
         if byte is None:
-            print(f"Error: Failed to read byte {i}")
+            if debug:
+                print(f"Error: Failed to read byte {i}")
             return None
         result.append(byte[0])
+    if bulk is None:
+        psu_bulk_result(ser, False)
     return result
 
 #-----
@@ -103,6 +303,172 @@ def make_packet(bytes_list):
     bytes_list.append((checksum >> 8) & 0xFF) #high byte
     return [0x55, 0xAA] + bytes_list
 
+def check_response(data, command=None):
+    """
+    Check a PSU response frame: 0x55 0xAA header, a length byte that fits in
+    the data and the 16-bit little-endian checksum that make_packet appends.
+    With a command, the frame must also echo that command byte, so a stale
+    reply to an earlier request (or another caller's) isn't taken for it.
+    Returns True if the frame is complete and valid.
+    """
+    if data is None or len(data) < 5:
+        return False
+    if data[0] != 0x55 or data[1] != 0xAA:
+        return False
+    length = data[2]
+    if length < 3 or length + 2 > len(data):
+        return False
+    if command is not None and (length < 4 or data[3] != command):
+        return False
+    checksum = sum(data[2:length]) & 0xFFFF
+    return checksum == (data[length] | (data[length + 1] << 8))
+
+def frame_offset(data):
+    """Index of a 0x55 0xAA header that starts after byte 0 (0 if there is none)."""
+    if not data or (data[0] == 0x55 and len(data) > 1 and data[1] == 0xAA):
+        return 0
+    for i in range(1, len(data)):
+        if data[i] == 0x55 and (i + 1 == len(data) or data[i + 1] == 0xAA):
+            return i
+    return 0
+
+def psu_transaction(ser, packet, num_read_bytes, debug=False, timeout=PSU_RESPONSE_TIMEOUT):
+    """
+    Send a make_packet frame to the PSU and poll for its response.
+    The first read waits for most of the latency learned for this command,
+    after that reads back off exponentially until check_response passes
+    for a frame echoing the packet's command byte.
+    Returns list of bytes read, or None if no valid response arrived in time.
+    Holds the port's psu_lock for the exchange; ser with a true `urgent`
+    attribute jumps the queue for it. A normal holder pauses the lock while
+    it waits and between reads, and if an urgent command got in meanwhile
+    it sends its own packet again. A ser with its own
+    psu_transaction (broker.BrokerClient) runs the exchange there instead,
+    under the lock of the process that owns the port.
+    """
+    if hasattr(ser, 'psu_transaction'):
+        return _psu_remote(ser, packet, num_read_bytes, debug, timeout)
+    lock = psu_lock(ser)
+    lock.acquire(getattr(ser, 'urgent', False))
+    try:
+        return _psu_exchange(ser, packet, num_read_bytes, debug, timeout, lock)
+    finally:
+        lock.release()
+
+def _psu_remote(ser, packet, num_read_bytes, debug, timeout):
+    command = packet[3]
+    name = "psu_cmd_%02x" % command
+    begin = metrics.begin(bitcrane.port_name(ser), name, packet)
+    data = ser.psu_transaction(packet, num_read_bytes, timeout)
+    if not check_response(data, command):
+        metrics.end(bitcrane.port_name(ser), name, packet, data, begin, STATUS_TIMEOUT)
+        if debug:
+            print("Error: No valid PSU response to command %02X" % command)
+        return None
+    metrics.end(bitcrane.port_name(ser), name, packet, data, begin, STATUS_OK)
+    return data
+
+def _psu_exchange(ser, packet, num_read_bytes, debug, timeout, lock):
+    command = packet[3]
+    name = "psu_cmd_%02x" % command
+    begin = metrics.begin(bitcrane.port_name(ser), name, packet)
+    deadline = time.monotonic() + timeout
+    estimate = psu_latency.get(command)
+    send = True
+    while True:
+        try:
+            if send:
+                if not psu_send_bytes(ser, PSU_I2C_ADDR, PSU_I2C_REG, packet, debug):
+                    metrics.end(bitcrane.port_name(ser), name, packet, None, begin, STATUS_TIMEOUT)
+                    return None
+                send = False
+                start = time.monotonic()
+                wait = estimate * 0.8 if estimate else 0.0
+                delay = PSU_POLL_MIN
+            if lock.pause(wait):
+                raise PsuPreempted()
+            data = psu_read_bytes(ser, PSU_I2C_ADDR, num_read_bytes, debug, lock)
+            offset = frame_offset(data)
+            if offset:
+                # the read started before the response was ready and ended mid-frame: read the rest
+                rest = psu_read_bytes(ser, PSU_I2C_ADDR, offset, debug, lock)
+                if rest is not None:
+                    data = list(data[offset:]) + list(rest)
+        except PsuPreempted:
+            # an urgent command went to the PSU meanwhile and replaced our reply
+            if debug:
+                print("PSU command %02X preempted, sending it again" % command)
+            if time.monotonic() + PSU_POLL_MIN > deadline:
+                metrics.end(bitcrane.port_name(ser), name, packet, None, begin, STATUS_TIMEOUT)
+                return None
+            send = True
+            continue
+        elapsed = time.monotonic() - start
+        if check_response(data, command):
+            if estimate is None:
+                psu_latency[command] = elapsed
+            else:
+                psu_latency[command] = estimate + PSU_LATENCY_ALPHA * (elapsed - estimate)
+            if debug:
+                print("PSU response to %02X after %.1f ms" % (command, elapsed * 1000))
+            metrics.end(bitcrane.port_name(ser), name, packet, data, begin, STATUS_OK)
+            return data
+        if time.monotonic() + delay > deadline:
+            metrics.end(bitcrane.port_name(ser), name, packet, data, begin, STATUS_TIMEOUT)
+            if debug:
+                print("Error: No valid PSU response to command %02X" % command)
+            return None
+        wait = delay
+        delay = min(delay * 2, PSU_POLL_MAX)
+
+class PsuConverter:
+    """
+    Voltage conversions for one PSU, precomputed into lookup tables: volts for
+    every setpoint code and for every measurement count below
+    PSU_MEASURE_TABLE_SIZE.
+    """
+
+    def __init__(self, set_offset=PSU_SET_OFFSET, set_slope=PSU_SET_SLOPE,
+                 measure_scale=PSU_MEASURE_SCALE, measure_offset=PSU_MEASURE_OFFSET):
+        self.set_offset = set_offset
+        self.set_slope = set_slope
+        self.measure_scale = measure_scale
+        self.measure_offset = measure_offset
+        self.set_table = array.array('d', (set_offset + set_slope * code for code in range(256)))
+        self.measure_table = array.array('d', ((counts + measure_offset) / measure_scale
+                                               for counts in range(PSU_MEASURE_TABLE_SIZE)))
+
+    def setpoint_volts(self, code):
+        return self.set_table[code]
+
+    def setpoint_code(self, voltage):
+        """Nearest setpoint code for a voltage, clamped to 0-255."""
+        return min(255, max(0, int(round((voltage - self.set_offset) / self.set_slope))))
+
+    def measured_volts(self, counts):
+        if counts < PSU_MEASURE_TABLE_SIZE:
+            return self.measure_table[counts]
+        return (counts + self.measure_offset) / self.measure_scale
+
+    def as_dict(self):
+        return {'set_offset': self.set_offset, 'set_slope': self.set_slope,
+                'measure_scale': self.measure_scale, 'measure_offset': self.measure_offset}
+
+# default conversions, for ports without a calibration of their own
+psu_converter = PsuConverter()
+
+# each port's unit calibration, installed by psu_cal.load_calibration
+psu_converters = weakref.WeakKeyDictionary()
+
+def converter_for(ser):
+    """Conversions for the PSU behind ser: its installed calibration, else the defaults."""
+    return psu_converters.get(psu_port(ser), psu_converter)
+
+#convert a PSU_CMD_MEASURE_VOLTAGE response to volts, with ser's calibration if given
+def measured_voltage_volts(data, ser=None):
+    converter = psu_converter if ser is None else converter_for(ser)
+    return converter.measured_volts(data[5] << 8 | data[4])
+
 def PSU_set_enable(ser, enable=True, debug=False):
     if enable:
         print("Enabling PSU...")
@@ -116,12 +482,8 @@ def PSU_get_hw_version(ser, debug=False):
     version_command = [PSU_CMD_GET_HW_VERSION]
     version_command = make_packet(version_command)
     print(f"Sending PSU HW version: [{' '.join(f'{b:02X}' for b in version_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, version_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, version_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU HW Version response: [{' '.join(f'{b:02X}' for b in data)}]")
         return data
@@ -133,12 +495,8 @@ def PSU_get_fw_version(ser, debug=False):
     version_command = [PSU_CMD_GET_FW_VERSION]
     version_command = make_packet(version_command)
     print(f"Sending PSU FW version: [{' '.join(f'{b:02X}' for b in version_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, version_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, version_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU FW Version response: [{' '.join(f'{b:02X}' for b in data)}]")
         return data
@@ -150,12 +508,8 @@ def PSU_config_watchdog(ser, value, debug=False):
     watchdog_command = [PSU_CMD_DISABLE_WDT, value, 0x00]
     watchdog_command = make_packet(watchdog_command)
     print(f"Sending PSU config watchdog: [{' '.join(f'{b:02X}' for b in watchdog_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, watchdog_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, watchdog_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU watchdog config response: [{' '.join(f'{b:02X}' for b in data)}]")
         return data
@@ -168,12 +522,8 @@ def PSU_set_voltage_raw(ser, hex_voltage, debug=False):
     set_voltage_command = [PSU_CMD_SET_VOLTAGE, hex_voltage, 0x00]
     set_voltage_command = make_packet(set_voltage_command)
     print(f"Sending PSU set voltage: [{' '.join(f'{b:02X}' for b in set_voltage_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, set_voltage_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, set_voltage_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU set voltage response: [{' '.join(f'{b:02X}' for b in data)}]")
         return data
@@ -182,7 +532,7 @@ def PSU_set_voltage_raw(ser, hex_voltage, debug=False):
 
 def PSU_set_voltage(ser, voltage, debug=False):
     num_read_bytes = 8
-    hex_voltage = int((voltage - 15.092)/-0.013)
+    hex_voltage = converter_for(ser).setpoint_code(voltage)
     PSU_set_voltage_raw(ser, hex_voltage, debug)
     
 def PSU_get_voltage(ser, debug=False):
@@ -190,15 +540,11 @@ def PSU_get_voltage(ser, debug=False):
     voltage_command = [PSU_CMD_GET_VOLTAGE]
     voltage_command = make_packet(voltage_command)
     print(f"Sending PSU read voltage: [{' '.join(f'{b:02X}' for b in voltage_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, voltage_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, voltage_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU voltage response: [{' '.join(f'{b:02X}' for b in data)}]")
-        print("Read Voltage = %.3f V" % (15.092 - (data[4] * 0.013)))
+        print("Read Voltage = %.3f V" % converter_for(ser).setpoint_volts(data[4]))
         return data
     else:
         return None
@@ -208,16 +554,12 @@ def PSU_measure_voltage(ser, debug=False):
     measure_voltage_command = [PSU_CMD_MEASURE_VOLTAGE]
     measure_voltage_command = make_packet(measure_voltage_command)
     print(f"Sending PSU measure voltage: [{' '.join(f'{b:02X}' for b in measure_voltage_command)}]")
-    psu_send_bytes(ser, 0x10, 0x11, measure_voltage_command, debug)
-
-    time.sleep(0.5)
-
-    #read back num_read_bytes bytes
-    data = psu_read_bytes(ser, 0x10, num_read_bytes, debug)
+    #send and poll until a valid num_read_bytes response comes back
+    data = psu_transaction(ser, measure_voltage_command, num_read_bytes, debug)
     if data:
         print(f"Read PSU measured voltage response: [{' '.join(f'{b:02X}' for b in data)}]")
         measured_voltage = (data[5] << 8 | data[4])
-        print("Measured Voltage = 0x%04X (%.2f)" % (measured_voltage, (measured_voltage+0.8615)/63.017))
+        print("Measured Voltage = 0x%04X (%.2f)" % (measured_voltage, measured_voltage_volts(data, ser)))
         return data
     else:
         return None
\ No newline at end of file
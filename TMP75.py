@@ -17,32 +17,67 @@ TMP75_CONFIG_REG = 0x01     # Configuration register (defaults to 0x00)
 TMP75_TLO_REG = 0x02        # Temperature low limit register
 TMP75_THI_REG = 0x03        # Temperature high limit register
 
+# Configuration register bits
+TMP75_CFG_SD = 0x01         # Shutdown mode
+TMP75_CFG_TM = 0x02         # Thermostat mode: 0 comparator, 1 interrupt
+TMP75_CFG_POL = 0x04        # ALERT polarity
+TMP75_CFG_FQ_MASK = 0x18    # Fault queue
+TMP75_CFG_RES_MASK = 0x60   # Converter resolution R1:R0
+TMP75_CFG_OS = 0x80         # One-shot conversion (only in shutdown mode)
+
+# maximum conversion time in seconds for each resolution
+TMP75_CONVERSION_TIME = {9: 0.0375, 10: 0.075, 11: 0.150, 12: 0.300}
+
+# consecutive out-of-limit conversions before ALERT asserts, as FQ bits
+TMP75_FAULT_QUEUE = {1: 0x00, 2: 0x08, 4: 0x10, 6: 0x18}
+
+# SMBus Alert Response Address: a read returns the address of an alerting
+# sensor (in interrupt mode) in bits 7:1 and clears its ALERT
+SMBUS_ARA_ADDR = 0x0C
+
      
 def prettyHex(data):
     return ' '.join(f'{byte:02X}' for byte in data)
 
-def read_temperature(ser, chipnum=0, hashboard_num=0, debug=False):
-
+def sensor_address(hashboard_num, chipnum=0):
     if hashboard_num == 0:
-        if chipnum == 0:
-            address = TMP75_HB0_I2CADDR0
-        else:
-            address = TMP75_HB0_I2CADDR1
+        return TMP75_HB0_I2CADDR0 if chipnum == 0 else TMP75_HB0_I2CADDR1
     elif hashboard_num == 1:
-        if chipnum == 0:
-            address = TMP75_HB1_I2CADDR0
-        else:
-            address = TMP75_HB1_I2CADDR1
+        return TMP75_HB1_I2CADDR0 if chipnum == 0 else TMP75_HB1_I2CADDR1
     elif hashboard_num == 2:
-        if chipnum == 0:
-            address = TMP75_HB2_I2CADDR0
-        else:
-            address = TMP75_HB2_I2CADDR1
+        return TMP75_HB2_I2CADDR0 if chipnum == 0 else TMP75_HB2_I2CADDR1
+    raise ValueError("Invalid hashboard number. Must be 0-2.")
+
+#convert the two temperature register bytes to degrees C
+def raw_to_celsius(data):
+    # convert data to signed 12 bit integer with struct
+    return (struct.unpack('>h', bytes(data[:2]))[0] >> 4) / 16.0
+
+#two limit register bytes for degrees C (12 bits, left justified)
+def celsius_to_raw(temp):
+    value = max(-2048, min(2047, int(round(temp * 16))))
+    return list(struct.pack('>h', value << 4))
+
+def alert_response(ser, debug=False):
+    """
+    Read the SMBus Alert Response Address. Returns the 7-bit address of the
+    lowest-addressed sensor with ALERT asserted (clearing it), or None when no
+    sensor is alerting. Call again to collect the next one.
+    """
+    data = bitcrane.i2c_read(ser, 0xBA, SMBUS_ARA_ADDR, 1, debug)
+    if data is None:
+        return None
+    return data[0] >> 1
+
+def read_temperature(ser, chipnum=0, hashboard_num=0, debug=False):
+
+    address = sensor_address(hashboard_num, chipnum)
 
     data = bitcrane.i2c_read_bytes(ser, 0xBB, address, TMP75_TEMP_REG, 2, debug)
+    if data is None or len(data) != 2:
+        return None
 
-    # convert data to signed 12 bit integer with struct
-    temp = (struct.unpack('>h', data)[0] >> 4) / 16.0
+    temp = raw_to_celsius(data)
 
     if debug:
         print("Raw Temperature = %02X %02X" % (data[0], data[1]))
@@ -52,15 +87,145 @@ def read_temperature(ser, chipnum=0, hashboard_num=0, debug=False):
 
 def read_config(ser, hashboard_num=0):
 
-    if hashboard_num == 0:
-        address = TMP75_HB0_I2CADDR0
-    elif hashboard_num == 1:
-        address = TMP75_HB1_I2CADDR0
-    elif hashboard_num == 2:
-        address = TMP75_HB2_I2CADDR0
+    address = sensor_address(hashboard_num, 0)
 
-    data = bitcrane.i2c_read_bytes(ser, 0xCC, address, TMP75_CONFIG_REG, 1)[0]
+    data = bitcrane.i2c_read_bytes(ser, 0xCC, address, TMP75_CONFIG_REG, 1)
+    if data is None:
+        return None
+    data = data[0]
 
     print("Config Register = %02X" % data)
 
     return data
+
+
+class TMP75Sensor:
+    """
+    One TMP75 with a cached image of its configuration register.
+
+    The config register is read from the device once and after that only
+    written, so changing resolution or triggering a one-shot conversion is a
+    single I2C write. Reads return None instead of raising when the bus
+    transaction fails.
+    """
+
+    def __init__(self, ser, address, debug=False):
+        self.ser = ser
+        self.address = address
+        self.debug = debug
+        self.config = None
+        self.limits = None
+
+    @classmethod
+    def on_board(cls, ser, hashboard_num, chipnum=0, debug=False):
+        return cls(ser, sensor_address(hashboard_num, chipnum), debug)
+
+    def read_config(self, refresh=False):
+        """Config register, from the cache unless refresh is set. None if the read fails."""
+        if self.config is None or refresh:
+            data = bitcrane.i2c_read_bytes(self.ser, 0xCC, self.address, TMP75_CONFIG_REG, 1, self.debug)
+            if data is None:
+                return None
+            self.config = data[0] & ~TMP75_CFG_OS & 0xFF
+        return self.config
+
+    def write_config(self, value):
+        if value & ~TMP75_CFG_OS == self.config:
+            return                  # nothing changes, skip the bus write
+        bitcrane.i2c_send_bytes(self.ser, self.address, TMP75_CONFIG_REG, value, self.debug)
+        self.config = value & ~TMP75_CFG_OS & 0xFF
+
+    def update_config(self, mask, bits):
+        config = self.read_config()
+        if config is None:
+            return False
+        self.write_config((config & ~mask) | (bits & mask))
+        return True
+
+    @property
+    def resolution(self):
+        config = self.read_config()
+        return 9 + ((config & TMP75_CFG_RES_MASK) >> 5) if config is not None else None
+
+    def set_resolution(self, bits):
+        """Select 9-12 bit conversions; fewer bits convert faster (27.5 ms at 9 bits vs 220 ms at 12)."""
+        if bits not in TMP75_CONVERSION_TIME:
+            raise ValueError("Invalid resolution. Must be 9-12 bits.")
+        return self.update_config(TMP75_CFG_RES_MASK, (bits - 9) << 5)
+
+    @property
+    def conversion_time(self):
+        return TMP75_CONVERSION_TIME.get(self.resolution, TMP75_CONVERSION_TIME[12])
+
+    def shutdown(self, enable=True):
+        """In shutdown the sensor only converts when a one-shot is triggered."""
+        return self.update_config(TMP75_CFG_SD, TMP75_CFG_SD if enable else 0)
+
+    def trigger_one_shot(self):
+        """Start a single conversion; the sensor must be in shutdown mode."""
+        config = self.read_config()
+        if config is None:
+            return False
+        bitcrane.i2c_send_bytes(self.ser, self.address, TMP75_CONFIG_REG, config | TMP75_CFG_SD | TMP75_CFG_OS, self.debug)
+        self.config = config | TMP75_CFG_SD
+        return True
+
+    def read_temperature(self):
+        data = bitcrane.i2c_read_bytes(self.ser, 0xBB, self.address, TMP75_TEMP_REG, 2, self.debug)
+        if data is None or len(data) != 2:
+            return None
+        return raw_to_celsius(data)
+
+    def read_limits(self, refresh=False):
+        """(t_low, t_high) in degrees C, from the cache unless refresh is set. None if a read fails."""
+        if self.limits is None or refresh:
+            low = bitcrane.i2c_read_bytes(self.ser, 0xCD, self.address, TMP75_TLO_REG, 2, self.debug)
+            high = bitcrane.i2c_read_bytes(self.ser, 0xCE, self.address, TMP75_THI_REG, 2, self.debug)
+            if low is None or high is None or len(low) != 2 or len(high) != 2:
+                return None
+            self.limits = (raw_to_celsius(low), raw_to_celsius(high))
+        return self.limits
+
+    def set_limits(self, t_low, t_high):
+        """
+        Program the alert limits. ALERT asserts above t_high and, in
+        comparator mode, stays asserted until the temperature falls below
+        t_low; the gap between them is the hysteresis.
+        """
+        if t_low >= t_high:
+            raise ValueError("t_low must be below t_high")
+        limits = (raw_to_celsius(celsius_to_raw(t_low)), raw_to_celsius(celsius_to_raw(t_high)))
+        if limits == self.limits:
+            return
+        bitcrane.i2c_send_frame(self.ser, self.address, TMP75_TLO_REG, celsius_to_raw(t_low), self.debug)
+        bitcrane.i2c_send_frame(self.ser, self.address, TMP75_THI_REG, celsius_to_raw(t_high), self.debug)
+        self.limits = limits
+
+    def set_alert_mode(self, interrupt=True, faults=2, active_high=False):
+        """
+        Comparator mode follows the temperature. Interrupt mode asserts ALERT
+        once when t_high is crossed and once when the temperature is back
+        below t_low; reading any register or the SMBus alert response clears
+        it. Only interrupt mode answers alert_response().
+        """
+        if faults not in TMP75_FAULT_QUEUE:
+            raise ValueError("Invalid fault queue length. Must be 1, 2, 4 or 6.")
+        bits = (TMP75_CFG_TM if interrupt else 0) | (TMP75_CFG_POL if active_high else 0) | TMP75_FAULT_QUEUE[faults]
+        return self.update_config(TMP75_CFG_TM | TMP75_CFG_POL | TMP75_CFG_FQ_MASK, bits)
+
+
+def board_sensors(ser, hashboards=(0, 1, 2), debug=False):
+    """TMP75Sensor objects for both sensors on each hashboard."""
+    return [TMP75Sensor.on_board(ser, hashboard_num, chipnum, debug) for hashboard_num in hashboards for chipnum in (0, 1)]
+
+def one_shot_all(sensors):
+    """
+    Trigger a one-shot conversion on every sensor, wait once for the slowest
+    conversion, then read them back to back. Sensors are left in shutdown.
+    Returns a list of temperatures (None for sensors that failed).
+    """
+    triggered = [sensor.trigger_one_shot() for sensor in sensors]
+    times = [sensor.conversion_time for sensor, ok in zip(sensors, triggered) if ok]
+    if times:
+        time.sleep(max(times))
+    return [sensor.read_temperature() if ok else None for sensor, ok in zip(sensors, triggered)]
@@ -0,0 +1,113 @@
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+import bitcrane
+import bm13xx
+
+#enumerate the ASIC chains of all three S19j Pro hashboards at once
+#
+# The GPIO resets for every board go out together on the shared control port,
+# then one worker thread per board sends the init and ping frames on that
+# board's ASIC port, collects the responses and addresses the chips.
+
+CTRL_PORT = '/dev/tty.usbmodemb310cc521'
+ASIC_PORTS = {
+    0: '/dev/tty.usbmodemb310cc523',
+    1: '/dev/tty.usbmodemb310cc525',
+    2: '/dev/tty.usbmodemb310cc527',
+}
+
+ASIC_INIT_FRAME = bm13xx.write_register(bm13xx.REG_VERSION_MASK, 0x9000FFFF)     # 55 AA 51 09 00 A4 90 00 FF FF 1C
+ASIC_PING_FRAME = bm13xx.ping()                                                     # 55 AA 52 05 00 00 0A
+
+ChainInventory = namedtuple('ChainInventory', 'hashboard_num chip_count chip_ids responses elapsed addresses error')
+ChainInventory.__doc__ = """
+Result of enumerating one hashboard chain.
+    chip_count: number of chips that answered the ping
+    chip_ids: Counter of chip ID register values (0x1362... for BM1362)
+    responses: list of bm13xx.AsicResponse in arrival order
+    elapsed: seconds from the ping write to the last response
+    addresses: chip addresses assigned after the ping, in chain order
+    error: None, or the exception text if the board could not be enumerated
+"""
+
+
+def open_asic_ports(hashboards=(0, 1, 2), ports=ASIC_PORTS, timeout=2):
+    """Open the ASIC serial port of each hashboard. Returns {hashboard_num: serial.Serial}."""
+    opened = {}
+    try:
+        for hashboard_num in hashboards:
+            opened[hashboard_num] = serial.Serial(port=ports[hashboard_num], baudrate=115200, timeout=timeout)
+    except serial.SerialException:
+        for ser in opened.values():
+            ser.close()
+        raise
+    return opened
+
+def enumerate_chain(ser_asic, hashboard_num, expected=bm13xx.S19JPRO_ASIC_COUNT, timeout=2, debug=False):
+    """
+    Init and ping the chain on one ASIC port that has just come out of reset,
+    then send chain inactive and give every chip that answered an address in
+    one compiled write. Returns a ChainInventory.
+    """
+    bm13xx.send(ser_asic, ASIC_INIT_FRAME)
+    time.sleep(0.1)
+
+    #clear the rx buffer
+    ser_asic.reset_input_buffer()
+
+    start = time.monotonic()
+    bm13xx.send(ser_asic, ASIC_PING_FRAME)
+    responses = []
+    # a fixed idle cutoff: a learned one would drop a slow chip and every chip after it
+    for response in bm13xx.read_responses(ser_asic, expected=expected, timeout=timeout, idle_timeout=bm13xx.ASIC_IDLE_TIMEOUT):
+        responses.append(response)
+        if debug:
+            print("HB%d response %03d: %s" % (hashboard_num, len(responses), bitcrane.prettyHex(response.raw)))
+    elapsed = (responses[-1].timestamp if responses else time.monotonic()) - start
+
+    addresses = []
+    if responses:
+        bm13xx.send(ser_asic, bm13xx.address_chain(len(responses)))
+        addresses = bm13xx.chip_addresses(len(responses))
+
+    chip_ids = Counter(response.value >> 16 for response in responses)
+    return ChainInventory(hashboard_num, len(responses), chip_ids, responses, elapsed, addresses, None)
+
+def enumerate_chains(ser_ctrl, asic_ports, expected=bm13xx.S19JPRO_ASIC_COUNT, timeout=2, debug=False):
+    """
+    Reset and enumerate several hashboards concurrently.
+
+    Args:
+        ser_ctrl: Control port (serial.Serial or ControlTransport), used for the resets
+        asic_ports: {hashboard_num: open ASIC serial port}
+        expected: Chips per chain; a board finishes as soon as this many answer
+
+    Returns:
+        {hashboard_num: ChainInventory}
+    """
+    hashboards = sorted(asic_ports)
+    if not hashboards:
+        return {}
+    bitcrane.reset_asics(ser_ctrl, hashboards, debug)
+    time.sleep(0.1)
+
+    def worker(hashboard_num):
+        try:
+            return enumerate_chain(asic_ports[hashboard_num], hashboard_num, expected, timeout, debug)
+        except (serial.SerialException, OSError) as e:
+            return ChainInventory(hashboard_num, 0, Counter(), [], 0.0, [], str(e))
+
+    with ThreadPoolExecutor(max_workers=len(hashboards)) as pool:
+        return dict(zip(hashboards, pool.map(worker, hashboards)))
+
+def print_inventory(inventories):
+    for hashboard_num, inventory in sorted(inventories.items()):
+        if inventory.error:
+            print("HB%d: error: %s" % (hashboard_num, inventory.error))
+            continue
+        ids = ', '.join("%04X x%d" % (chip_id, count) for chip_id, count in sorted(inventory.chip_ids.items()))
+        print("HB%d: %3d chips in %6.1f ms  [%s]" % (hashboard_num, inventory.chip_count, inventory.elapsed * 1000, ids))
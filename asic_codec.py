@@ -0,0 +1,87 @@
+import array
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#bulk codec for the 9-bit words on the ASIC serial ports
+#
+# Each 9-bit word travels as a pair of bytes:
+# - **First byte**: Lower 8 bits of the 9-bit word (bits 0-7)
+# - **Second byte**: Bit 8 (only LSB is used, can be 0 or 1)
+#
+# That is exactly a little-endian u16 with the top 7 bits cleared, so whole
+# buffers are converted with array/memoryview copies and one bytes.translate
+# over the odd bytes instead of a Python loop per word. When NumPy arrays are
+# passed in, the NumPy path is used instead.
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+_BIT8_ONLY = bytes(b & 0x01 for b in range(256))   # translate table: keep only bit 8
+_HEX9 = [f'{value:03X}' for value in range(0x200)]
+
+
+def encode9(words):
+    """
+    Pack 9-bit words into (low byte, bit-8 byte) pairs.
+
+    Args:
+        words: Iterable of u16 values, array('H') or NumPy integer array
+
+    Returns:
+        bytearray ready for ser.write()
+    """
+    if np is not None and isinstance(words, np.ndarray):
+        return bytearray((words.astype('<u2') & 0x1FF).tobytes())
+
+    if not (isinstance(words, array.array) and words.typecode == 'H'):
+        words = array.array('H', words)
+    elif _BIG_ENDIAN:
+        words = array.array('H', words)
+    if _BIG_ENDIAN:
+        words.byteswap()
+    packet = bytearray(words.tobytes())
+    packet[1::2] = packet[1::2].translate(_BIT8_ONLY)
+    return packet
+
+def decode9_into(data, out):
+    """
+    Unpack (low byte, bit-8 byte) pairs into a caller-supplied buffer.
+    A trailing odd byte is ignored.
+
+    Args:
+        data: bytes-like received from the ASIC port
+        out: Preallocated array('H') or NumPy uint16 array with room for
+             len(data) // 2 words
+
+    Returns:
+        Number of words written
+    """
+    count = len(data) // 2
+    if len(out) < count:
+        raise ValueError("Output buffer too small: need %d words, have %d" % (count, len(out)))
+
+    if np is not None and isinstance(out, np.ndarray):
+        out[:count] = np.frombuffer(data, dtype='<u2', count=count) & 0x1FF
+        return count
+
+    # strided memoryview copies are slow, so mask in a bytearray and copy once
+    pairs = bytearray(memoryview(data)[:count * 2])
+    pairs[1::2] = pairs[1::2].translate(_BIT8_ONLY)
+    if _BIG_ENDIAN:
+        pairs[0::2], pairs[1::2] = pairs[1::2], pairs[0::2]
+    memoryview(out).cast('B')[:count * 2] = pairs
+    return count
+
+def decode9(data):
+    """Unpack (low byte, bit-8 byte) pairs into a new array('H')."""
+    out = array.array('H', bytes(len(data) // 2 * 2))
+    decode9_into(data, out)
+    return out
+
+def format9(data):
+    """
+    Format (low byte, bit-8 byte) pairs as 9-bit hex strings like "1FA 0F0 042".
+    """
+    return ' '.join(map(_HEX9.__getitem__, decode9(bytes(data))))
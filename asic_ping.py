@@ -3,18 +3,66 @@ import TMP75
 import time
 import sys
 import bitcrane
+import bm13xx
+import asic_chains
+import registry
 
 #takes a S19j Pro hashboard number as an argument and pings all the ASICs and reads the PCB temperatures
 
 def prettyHex(data):
     return ' '.join(f'{byte:02X}' for byte in data)
 
+#enumerate all three hashboards concurrently, sharing the control port for the resets
+def ping_all():
+    # find the ports through the device registry, falling back to the paths in asic_chains.py
+    try:
+        device = registry.find_device()
+        ctrl_path, asic_paths = device.path(registry.ROLE_CTRL), device.asic_ports()
+    except LookupError as e:
+        print(f"{e}, using the ports in asic_chains.py")
+        ctrl_path, asic_paths = asic_chains.CTRL_PORT, asic_chains.ASIC_PORTS
+    try:
+        serial_port_ctrl = serial.Serial(
+            port=ctrl_path,
+            baudrate=115200,
+            timeout=1
+        )
+        asic_ports = asic_chains.open_asic_ports(ports=asic_paths)
+    except serial.SerialException as e:
+        print(f"Error opening serial port: {e}")
+        exit(1)
+
+    try:
+        while True:
+            print(f"\n{'='*50}")
+            print("All hashboards")
+            print(f"{'='*50}")
+            inventories = asic_chains.enumerate_chains(serial_port_ctrl, asic_ports)
+            asic_chains.print_inventory(inventories)
+
+            print("\nReading board temps...")
+            for hashboard_num in sorted(asic_ports):
+                temp0 = TMP75.read_temperature(serial_port_ctrl, 0, hashboard_num)
+                temp1 = TMP75.read_temperature(serial_port_ctrl, 1, hashboard_num)
+                print("HB%d Temp 0: %.2f C  Temp 1: %.2f C" % (hashboard_num, temp0, temp1))
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping the script.")
+    finally:
+        serial_port_ctrl.close()
+        for ser in asic_ports.values():
+            ser.close()
+
 # Take command line argument for hashboard number
 if len(sys.argv) != 2:
     print("Usage: python ping_looper.py <hashboard_num>")
-    print("  hashboard_num: Hashboard number to ping")
+    print("  hashboard_num: Hashboard number to ping, or 'all' to ping all three concurrently")
     exit(1)
 
+if sys.argv[1] == 'all':
+    ping_all()
+    exit(0)
+
 try:
     hashboard_num = int(sys.argv[1])
 except ValueError:
@@ -52,24 +100,20 @@ try:
         print("Sending reset command to ASIC...")
         bitcrane.reset_asic(serial_port_ctrl, hashboard_num, True)
         time.sleep(0.1)
-        serial_port_asic.write(bytes([0x55, 0xAA, 0x51, 0x09, 0x00, 0xA4, 0x90, 0x00, 0xFF, 0xFF, 0x1C])) #55 AA 51 09 00 A4 90 00 FF FF 1C
+        bm13xx.send(serial_port_asic, asic_chains.ASIC_INIT_FRAME) #55 AA 51 09 00 A4 90 00 FF FF 1C
         time.sleep(0.1)
 
         #clear the rx buffer
         serial_port_asic.reset_input_buffer()
 
-        serial_port_asic.write(bytes([0x55, 0xAA, 0x52, 0x05, 0x00, 0x00, 0x0A]))
+        bm13xx.send(serial_port_asic, asic_chains.ASIC_PING_FRAME) #55 AA 52 05 00 00 0A
         print("Sent ping..")
-        # wait for the response for 2 seconds
+        # collect responses until every chip has answered, the chain goes quiet or 2 seconds pass
         rx_count = 0
-        while True:
-            response = serial_port_asic.read(11)
-            if response:
-                rx_count += 1
-                print("response %02d: %s" % (rx_count, prettyHex(response)))
-            else:
-                print()
-                break
+        for response in bm13xx.read_responses(serial_port_asic, expected=bm13xx.S19JPRO_ASIC_COUNT, timeout=2):
+            rx_count += 1
+            print("response %02d: %s" % (rx_count, prettyHex(response.raw)))
+        print()
 
         time.sleep(0.1)
         print("\nReading board temps...")
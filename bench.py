@@ -0,0 +1,235 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+import serial
+
+import APW_PSU
+import TMP75
+import asic_codec
+import bitcrane
+import bm13xx
+
+#control-bus latency and throughput benchmarks
+#
+# Runs every command type against a real control port or against the pty
+# simulator, reports round-trip latency percentiles and ops/sec, writes the
+# results as JSON and compares them with a stored baseline.
+#
+# usage:
+#   python bench.py --sim -o results.json
+#   python bench.py --ctrl /dev/tty.usbmodemb310cc521 --asic /dev/tty.usbmodemb310cc523
+#   python bench.py --sim --baseline baseline.json --threshold 20
+#
+# On a real board the benchmarks only write harmless values: GPIO_HB0_RST is
+# held high (out of reset) and FAN1 is set to --fan-speed.
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, elapsed, failures):
+    latencies = sorted(latencies)
+    return {
+        'n': len(latencies),
+        'failures': failures,
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+def run(op, iterations, warmup=3):
+    """Time op() iterations times. op returns None on failure."""
+    for _ in range(warmup):
+        op()
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        result = op()
+        latencies.append(time.perf_counter() - t0)
+        if result is None:
+            failures += 1
+    return summarize(latencies, time.perf_counter() - start, failures)
+
+def run_pipelined(transport, packet, iterations, depth):
+    """Keep depth requests in flight on a ControlTransport."""
+    latencies = []
+    failures = 0
+    in_flight = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        in_flight.append((time.perf_counter(), transport.request(packet)))
+        if len(in_flight) >= depth:
+            t0, future = in_flight.pop(0)
+            failures += _wait(future)
+            latencies.append(time.perf_counter() - t0)
+    for t0, future in in_flight:
+        failures += _wait(future)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - start, failures)
+
+def _wait(future):
+    try:
+        future.result(1.0)
+        return 0
+    except Exception:
+        return 1
+
+def control_benchmarks(ser, iterations, fan_speed):
+    psu_measure = APW_PSU.make_packet([APW_PSU.PSU_CMD_MEASURE_VOLTAGE])
+    psu_get = APW_PSU.make_packet([APW_PSU.PSU_CMD_GET_VOLTAGE])
+    return {
+        'gpio_set': lambda: bitcrane.gpio_set(ser, 0xAB, bitcrane.GPIO_HB0_RST, bitcrane.GPIO_HIGH),
+        'fan_set_speed': lambda: bitcrane.fan_set_speed(ser, 0xAB, 1, fan_speed),
+        'get_fan_rpm': lambda: bitcrane.get_fan_rpm(ser, 0xAB, 1),
+        'i2c_read_bytes': lambda: bitcrane.i2c_read_bytes(ser, 0xBB, TMP75.TMP75_HB0_I2CADDR0, TMP75.TMP75_TEMP_REG, 2),
+        'tmp75_read_temperature': lambda: _no_raise(TMP75.read_temperature, ser, 0, 0),
+        'psu_get_voltage': lambda: APW_PSU.psu_transaction(ser, psu_get, 8),
+        'psu_measure_voltage': lambda: APW_PSU.psu_transaction(ser, psu_measure, 8),
+    }
+
+def _no_raise(func, *args):
+    try:
+        return func(*args)
+    except Exception:
+        return None
+
+def framing_benchmarks(chip_count):
+    words = list(range(0x100, 0x100 + 64))
+    encoded = bytes(asic_codec.encode9(words))
+    out = asic_codec.decode9(encoded)
+    body = bytearray(b'\x13\x62\x03\x00\x00\x00\x00\x00\x00')
+    body[-1] = bm13xx.crc5(body, len(body) * 8 - 5)
+    stream = (bm13xx.ASIC_RESPONSE_PREAMBLE + bytes(body)) * chip_count
+    framer = bm13xx.ResponseFramer()
+    return {
+        'asic_encode9_64w': lambda: asic_codec.encode9(words),
+        'asic_decode9_into_64w': lambda: asic_codec.decode9_into(encoded, out),
+        'asic_frame_chain_%d' % chip_count: lambda: framer.feed(stream),
+    }
+
+def asic_ping(ser_asic, chip_count):
+    ser_asic.reset_input_buffer()
+    bm13xx.send(ser_asic, bm13xx.ping())
+    count = sum(1 for _ in bm13xx.read_responses(ser_asic, expected=chip_count, timeout=2))
+    return count if count == chip_count else None
+
+def compare(results, baseline, threshold):
+    """
+    Compare against a baseline results dict. A benchmark regresses when its
+    p50 or p99 latency grows, or its ops/sec drops, by more than threshold percent.
+    Returns a list of regression descriptions.
+    """
+    regressions = []
+    limit = threshold / 100.0
+    for name, base in baseline.get('results', {}).items():
+        current = results['results'].get(name)
+        if current is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if base[key] > 0 and current[key] > base[key] * (1 + limit):
+                regressions.append("%s %s %.3f -> %.3f" % (name, key, base[key], current[key]))
+        if base['ops_per_sec'] > 0 and current['ops_per_sec'] < base['ops_per_sec'] * (1 - limit):
+            regressions.append("%s ops_per_sec %.1f -> %.1f" % (name, base['ops_per_sec'], current['ops_per_sec']))
+    return regressions
+
+def print_results(results):
+    print("%-28s %7s %10s %9s %9s %9s %9s %5s" % ('benchmark', 'n', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'fail'))
+    for name, r in results['results'].items():
+        print("%-28s %7d %10.1f %9.3f %9.3f %9.3f %9.3f %5d" % (
+            name, r['n'], r['ops_per_sec'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms'], r['failures']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bitcrane control-bus latency and throughput benchmarks")
+    parser.add_argument('--ctrl', help="control serial port")
+    parser.add_argument('--asic', help="ASIC serial port for the chain ping benchmark")
+    parser.add_argument('--sim', action='store_true', help="run against bitcrane_sim instead of hardware")
+    parser.add_argument('--sim-latency', type=float, default=0.5, help="simulator reply latency in ms")
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=16, help="requests in flight for the pipelined benchmark")
+    parser.add_argument('--chips', type=int, default=bm13xx.S19JPRO_ASIC_COUNT)
+    parser.add_argument('--fan-speed', type=int, default=50)
+    parser.add_argument('--only', help="comma separated benchmark names to run")
+    parser.add_argument('-o', '--output', help="write results JSON here")
+    parser.add_argument('--baseline', help="baseline results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=20.0, help="allowed regression in percent")
+    args = parser.parse_args()
+
+    sim = None
+    if args.sim:
+        from bitcrane_sim import BitcraneSim
+        sim = BitcraneSim(latency=args.sim_latency / 1000, chip_count=args.chips).start()
+        args.ctrl = sim.ctrl_port
+        args.asic = sim.asic_ports[0]
+    if not args.ctrl:
+        parser.error("--ctrl or --sim is required")
+
+    only = set(args.only.split(',')) if args.only else None
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'target': 'sim' if sim else args.ctrl,
+            'iterations': args.iterations,
+        },
+        'results': {},
+    }
+
+    try:
+        ser = serial.Serial(port=args.ctrl, baudrate=115200, timeout=1)
+        benchmarks = control_benchmarks(ser, args.iterations, args.fan_speed)
+        benchmarks.update(framing_benchmarks(args.chips))
+        ser_asic = None
+        if args.asic:
+            ser_asic = serial.Serial(port=args.asic, baudrate=115200, timeout=2)
+            benchmarks['asic_ping_chain'] = lambda: asic_ping(ser_asic, args.chips)
+
+        for name, op in benchmarks.items():
+            if only and name not in only:
+                continue
+            iterations = args.iterations if name != 'asic_ping_chain' else max(1, args.iterations // 20)
+            results['results'][name] = run(op, iterations)
+
+        if not only or 'get_fan_rpm_pipelined' in only:
+            from ctrl_transport import ControlTransport
+            transport = ControlTransport(ser, max_in_flight=max(args.depth, 1))
+            packet = bytes([6, 0x00, 0x00, 0x00, bitcrane.PAGE_FAN, bitcrane.FAN1_TACH_CMD])
+            results['results']['get_fan_rpm_pipelined'] = run_pipelined(transport, packet, args.iterations, args.depth)
+            transport.close()
+        else:
+            ser.close()
+        if ser_asic is not None:
+            ser_asic.close()
+    except serial.SerialException as e:
+        print(f"Error: {e}")
+        exit(1)
+    finally:
+        if sim is not None:
+            sim.close()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions over %.0f%%:" % args.threshold)
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("\nNo regressions over %.0f%% against %s" % (args.threshold, args.baseline))
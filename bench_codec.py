@@ -0,0 +1,82 @@
+import array
+import random
+import sys
+import timeit
+
+import asic_codec
+
+#micro-benchmark of the bulk 9-bit codec in asic_codec against the per-word loops it replaced
+#usage: python bench_codec.py [num_words]
+
+def loop_encode9(data):
+    packet = []
+    for value in data:
+        lower_byte = value & 0xFF
+        upper_byte = (value >> 8) & 0x01  # Only bit 8 is used
+        packet.append(lower_byte)
+        packet.append(upper_byte)
+    return packet
+
+def loop_decode9(rxdata):
+    data = []
+    for i in range(0, len(rxdata), 2):
+        lower_byte = rxdata[i]
+        upper_byte = rxdata[i + 1] & 0x01  # Only bit 8 is used
+        value = (upper_byte << 8) | lower_byte
+        data.append(value)
+    return data
+
+def loop_format9(data):
+    result = []
+    for i in range(0, len(data), 2):
+        if i + 1 < len(data):
+            lower_byte = data[i]
+            upper_byte = data[i + 1] & 0x01  # Only bit 8 is used
+            value = (upper_byte << 8) | lower_byte
+            result.append(f'{value:03X}')
+    return ' '.join(result)
+
+def bench(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    usec = best / number * 1e6
+    print(f"  {label:<28} {usec:10.2f} us/call")
+    return usec
+
+if __name__ == '__main__':
+    num_words = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    words = [random.randrange(0x200) for _ in range(num_words)]
+    rxdata = bytes(loop_encode9(words))
+    out = array.array('H', bytes(num_words * 2))
+    number = max(1, 200000 // num_words)
+
+    assert bytes(asic_codec.encode9(words)) == rxdata
+    assert asic_codec.decode9(rxdata).tolist() == loop_decode9(rxdata) == words
+    assert asic_codec.format9(rxdata) == loop_format9(rxdata)
+
+    print(f"{num_words} words, NumPy {'available' if asic_codec.np is not None else 'not installed'}")
+
+    print("encode")
+    base = bench("loop", lambda: loop_encode9(words), number)
+    fast = bench("encode9 (list)", lambda: asic_codec.encode9(words), number)
+    words_array = array.array('H', words)
+    bench("encode9 (array)", lambda: asic_codec.encode9(words_array), number)
+    print(f"  speedup {base / fast:.1f}x")
+
+    print("decode")
+    base = bench("loop", lambda: loop_decode9(rxdata), number)
+    fast = bench("decode9_into (array)", lambda: asic_codec.decode9_into(rxdata, out), number)
+    bench("decode9().tolist()", lambda: asic_codec.decode9(rxdata).tolist(), number)
+    print(f"  speedup {base / fast:.1f}x")
+
+    print("format")
+    base = bench("loop", lambda: loop_format9(rxdata), number)
+    fast = bench("format9", lambda: asic_codec.format9(rxdata), number)
+    print(f"  speedup {base / fast:.1f}x")
+
+    if asic_codec.np is not None:
+        np = asic_codec.np
+        words_np = np.array(words, dtype=np.uint16)
+        out_np = np.zeros(num_words, dtype=np.uint16)
+        print("numpy")
+        bench("encode9 (ndarray)", lambda: asic_codec.encode9(words_np), number)
+        bench("decode9_into (ndarray)", lambda: asic_codec.decode9_into(rxdata, out_np), number)
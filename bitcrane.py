@@ -1,6 +1,11 @@
+import random
+import select
 import serial
 import time
 
+import asic_codec
+from metrics import metrics, rtt, STATUS_OK, STATUS_TIMEOUT, STATUS_SHORT, STATUS_ID_MISMATCH
+
 PAGE_PSU = 0x04
 
 
@@ -21,6 +26,9 @@ GPIO_HB2_PLUG = 0x21
 
 GPIO_PSU_EN = 0x50
 
+PAGE_LED = 0x08
+LED_COLOR_CMD = 0x10
+
 PAGE_FAN = 0x09
 FAN1_SPEED_CMD = 0x11
 FAN1_TACH_CMD = 0x21
@@ -31,6 +39,18 @@ FAN3_TACH_CMD = 0x23
 FAN4_SPEED_CMD = 0x14
 FAN4_TACH_CMD = 0x24
 
+# control replies start [len_lo, len_hi, id] with len the whole reply length
+CTRL_REPLY_HEADER_LEN = 3
+CTRL_REPLY_MAX_LEN = 0x100
+CTRL_TIMEOUT = 1.0          # seconds, when the port has no timeout of its own
+CTRL_RETRIES = 2            # extra attempts for idempotent commands
+CTRL_RETRY_BACKOFF = 0.005  # seconds; retry n first sleeps a random 0..backoff * 2**n
+CTRL_RESYNC_SETTLE = 0.01   # seconds to wait for the rest of a half-received stale reply
+CTRL_ID_UNTRACKED = 0x00    # ID transports put on packets whose reply nobody waits for
+CTRL_POLL = 0.001           # seconds between in_waiting checks on ports without a fileno
+
+PAGE_NAMES = {PAGE_PSU: 'psu', PAGE_I2C: 'i2c', PAGE_GPIO: 'gpio', PAGE_LED: 'led', PAGE_FAN: 'fan'}
+
 
 def prettyHex(data):
     return ' '.join(f'{byte:02X}' for byte in data)
@@ -48,14 +68,192 @@ def prettyHex9(data):
     Returns:
         String with formatted 9-bit hex values like "1FA 0F0 042"
     """
-    result = []
-    for i in range(0, len(data), 2):
-        if i + 1 < len(data):
-            lower_byte = data[i]
-            upper_byte = data[i + 1] & 0x01  # Only bit 8 is used
-            value = (upper_byte << 8) | lower_byte
-            result.append(f'{value:03X}')
-    return ' '.join(result)
+    return asic_codec.format9(data)
+
+#metrics label for a control packet, e.g. "fan_21" for a FAN1 tach read
+def command_name(packet):
+    return "%s_%02x" % (PAGE_NAMES.get(packet[4], "page%02x" % packet[4]), packet[5])
+
+def port_name(ser):
+    return getattr(ser, 'port', None)
+
+def wire_packet(packet, reply):
+    """
+    A packet as a transport wrote it. Transports stamp their own ID into
+    byte 2 and the reply carries it back; with no reply the ID isn't known
+    and CTRL_ID_UNTRACKED stands in for it.
+    """
+    packet = bytearray(packet)
+    packet[2] = reply[2] if reply and len(reply) >= CTRL_REPLY_HEADER_LEN else CTRL_ID_UNTRACKED
+    return bytes(packet)
+
+def ctrl_send(ser, packet, debug=False, tag="ctrl"):
+    """
+    Write a control-page packet without waiting for its reply.
+    ser may be a serial.Serial or a ctrl_transport.ControlTransport.
+    """
+    if debug:
+        print("%s tx: [%s]" % (tag, prettyHex(packet)))
+    command = command_name(packet)
+    start = metrics.begin(port_name(ser), command, packet)
+    if hasattr(ser, 'transact'):
+        ser.send(packet)
+        packet = wire_packet(packet, None)
+    else:
+        ser.write(packet)
+    metrics.end(port_name(ser), command, packet, None, start)
+
+def wait_input(ser, timeout):
+    """
+    Wait up to timeout seconds for input on a plain serial port, without
+    touching ser.timeout (pyserial reconfigures the tty on every assignment).
+    Returns the number of bytes waiting.
+    """
+    waiting = ser.in_waiting
+    if waiting or timeout <= 0:
+        return waiting
+    try:
+        fd = ser.fileno()
+    except (AttributeError, NotImplementedError, OSError):
+        fd = None
+    if fd is not None:
+        select.select([fd], [], [], timeout)
+        return ser.in_waiting
+    deadline = time.monotonic() + timeout
+    while not waiting and time.monotonic() < deadline:
+        time.sleep(CTRL_POLL)
+        waiting = ser.in_waiting
+    return waiting
+
+def read_reply(ser, deadline):
+    """
+    Read one whole reply frame from a plain control port by its length field.
+    Bytes that can't start a reply are skipped one at a time, so the stream
+    realigns on the next frame boundary. Returns the frame, or whatever was
+    read of it by the monotonic deadline (possibly b''). Only bytes already
+    waiting are read, so the port's timeout is never changed.
+    """
+    buf = bytearray()
+    need = CTRL_REPLY_HEADER_LEN
+    while len(buf) < need:
+        waiting = wait_input(ser, deadline - time.monotonic())
+        if not waiting:
+            break
+        buf += ser.read(min(waiting, need - len(buf)))
+        if len(buf) >= CTRL_REPLY_HEADER_LEN:
+            length = buf[0] | (buf[1] << 8)
+            if length < CTRL_REPLY_HEADER_LEN or length > CTRL_REPLY_MAX_LEN:
+                del buf[0]
+                need = CTRL_REPLY_HEADER_LEN
+            else:
+                need = length
+    return bytes(buf)
+
+def ctrl_resync(ser, debug=False, settle=CTRL_RESYNC_SETTLE):
+    """
+    Drain replies already waiting on a plain control port a whole frame at a
+    time (late replies to timed-out requests, unread acks from ctrl_send),
+    waiting up to `settle` seconds for the rest of a half-received one so the
+    next read starts on a frame boundary. Returns the number of frames dropped.
+    """
+    dropped = 0
+    while ser.in_waiting:
+        frame = read_reply(ser, time.monotonic() + settle)
+        if not frame:
+            break
+        dropped += 1
+        if debug:
+            print("ctrl resync: dropping [%s]" % prettyHex(frame))
+    return dropped
+
+def _serial_exchange(ser, packet, timeout):
+    # write, then read frames until the one carrying our ID or the deadline;
+    # returns (reply, number of other replies skipped)
+    deadline = time.monotonic() + timeout
+    skipped = 0
+    ser.write(packet)
+    while True:
+        reply = read_reply(ser, deadline)
+        if len(reply) < CTRL_REPLY_HEADER_LEN or reply[2] == packet[2]:
+            return reply, skipped
+        skipped += 1
+
+def ctrl_transaction(ser, packet, rx_len, debug=False, tag="ctrl", retries=0):
+    """
+    Send a control-page packet and wait for its reply.
+
+    Args:
+        ser: serial.Serial or ctrl_transport.ControlTransport. With a plain
+             serial port replies already waiting are drained first
+             (ctrl_resync), then replies are read a frame at a time until one
+             carries byte 2 of the packet as its ID. With a transport the
+             packet gets a rolling ID and the reply is routed back by the
+             reader thread.
+        packet: Packet bytes, [len_lo, len_hi, id, 0x00, page, command, ...]
+        rx_len: Expected reply length in bytes
+        tag: Prefix for the debug prints
+        retries: Extra attempts after a timeout or bad reply, each after a
+                 random (jittered) backoff. Only for idempotent commands.
+
+    The timeout of each attempt comes from metrics.rtt: a multiple of the
+    recent 99th percentile round trip for this command, capped at the port's
+    own timeout, so a lost reply costs a few round trips instead of a second.
+    A late reply to an earlier attempt is accepted by the retry. Metrics
+    hooks get the packet with the ID a transport actually sent (wire_packet).
+
+    Returns:
+        The reply bytes, or None on timeout / ID mismatch. Timeouts, short
+        reads and ID mismatches are counted in metrics and only printed
+        when debug is set.
+    """
+    port = port_name(ser)
+    command = command_name(packet)
+    transport = hasattr(ser, 'transact')
+    default_timeout = getattr(ser, 'timeout', None)
+    if not transport:
+        default_timeout = CTRL_TIMEOUT if default_timeout is None else default_timeout
+        if ser.in_waiting:
+            ctrl_resync(ser, debug)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(random.uniform(0, CTRL_RETRY_BACKOFF * (1 << attempt)))
+            if debug:
+                print("%s retry %d" % (tag, attempt))
+        timeout = rtt.timeout(command, default_timeout)
+        if debug:
+            print("%s tx: [%s]" % (tag, prettyHex(packet)))
+
+        start = metrics.begin(port, command, packet)
+        skipped = 0
+        sent = packet
+        if transport:
+            rxdata = ser.transact(packet, timeout)
+            sent = wire_packet(packet, rxdata)
+        else:
+            rxdata, skipped = _serial_exchange(ser, packet, timeout)
+
+        if not rxdata:
+            metrics.end(port, command, sent, rxdata, start, STATUS_ID_MISMATCH if skipped else STATUS_TIMEOUT)
+            rtt.miss(command)
+            if debug:
+                print("No data received" if not skipped else "Error: ID mismatch. No reply with ID %02X" % packet[2])
+            continue
+        if debug:
+            print("%s rx: [%s]" % (tag, prettyHex(rxdata)))
+        if len(rxdata) < 3 or (not transport and rxdata[2] != packet[2]):
+            metrics.end(port, command, sent, rxdata, start, STATUS_ID_MISMATCH)
+            if debug:
+                print("Error: ID mismatch. Expected %02X, got %s" % (packet[2], prettyHex(rxdata[2:3])))
+            continue
+        if len(rxdata) < rx_len:
+            metrics.end(port, command, sent, rxdata, start, STATUS_SHORT)
+            if attempt < retries:
+                continue
+            return rxdata
+        rtt.record(command, metrics.end(port, command, sent, rxdata, start, STATUS_OK))
+        return rxdata
+    return None
 
 def fan_set_speed(ser, id, fan_num, speed_percent, debug=False):
     packet_len = 7
@@ -71,27 +269,8 @@ def fan_set_speed(ser, id, fan_num, speed_percent, debug=False):
         raise ValueError("Invalid fan number. Must be 1-4.")
     packet = bytes([packet_len, 0x00, id, 0x00, PAGE_FAN, fan_speed_command, speed_percent])
 
-    if debug:
-        print("ctrl fan tx: [%s]" % prettyHex(packet))
-
-    ser.write(packet)
-
     # wait for the response
-    rxdata = ser.read(4)
-    if rxdata:
-        bytes_read = len(rxdata)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl fan rx: [%s]" % prettyHex(rxdata))
-            if rxdata[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, rxdata[2]))
-                return
-        else:
-            print("No data received")
-            return
-    else:
-        print("No data received")
-    return
+    return ctrl_transaction(ser, packet, 4, debug, "ctrl fan", CTRL_RETRIES)
 
 def get_fan_rpm(ser, id, fan_num, debug=False):
     packet_len = 6
@@ -107,82 +286,62 @@ def get_fan_rpm(ser, id, fan_num, debug=False):
         raise ValueError("Invalid fan number. Must be 1-4.")
     packet = bytes([packet_len, 0x00, id, 0x00, PAGE_FAN, fan_tach_command])
 
-    if debug:
-        print("ctrl fan rpm tx: [%s]" % prettyHex(packet))
-
-    ser.write(packet)
-
     # wait for the response
-    rxdata = ser.read(5)
-    if rxdata:
-        bytes_read = len(rxdata)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl fan rpm rx: [%s]" % prettyHex(rxdata))
-            if rxdata[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, rxdata[2]))
-                return
-            rpm = (rxdata[4] << 8) | rxdata[3]
-            return rpm
-        else:
-            print("No data received")
-            return
-    else:
-        print("No data received")
-    return
+    rxdata = ctrl_transaction(ser, packet, 5, debug, "ctrl fan rpm", CTRL_RETRIES)
+    if rxdata is None or len(rxdata) < 5:
+        return None
+    rpm = (rxdata[4] << 8) | rxdata[3]
+    return rpm
 
 def gpio_set(ser, id, gpio, value, debug=False):
     packet_len = 7
     packet = bytes([packet_len, 0x00, id, 0x00, PAGE_GPIO, gpio, value])
 
-    if debug:
-        print("ctrl gpio tx: [%s]" % prettyHex(packet))
+    # wait for the response
+    return ctrl_transaction(ser, packet, 4, debug, "ctrl gpio", CTRL_RETRIES)
 
-    ser.write(packet)
+def led_set_color(ser, id, red, green, blue, debug=False, wait=True):
+    """
+    Set the RGB LED. With wait=False the packet is written and the ack is
+    left to the transport (or the next ctrl_transaction's resync), returning None.
+    """
+    packet = bytes([0x09, 0x00, id, 0x00, PAGE_LED, LED_COLOR_CMD, red, green, blue])
+    if not wait:
+        ctrl_send(ser, packet, debug, "ctrl led")
+        return None
 
     # wait for the response
-    rxdata = ser.read(4)
-    if rxdata:
-        bytes_read = len(rxdata)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl gpio rx: [%s]" % prettyHex(rxdata))
-            if rxdata[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, rxdata[2]))
-                return
-        else:
-            print("No data received")
-            return
-    else:
-        print("No data received")
-    return
+    return ctrl_transaction(ser, packet, 4, debug, "ctrl led")
 
 def i2c_send_bytes(ser, address, register, data, debug=False):
-     packet = bytes([0x09, 0x00, 0x01, 0x00, PAGE_I2C, I2C_COMMAND_WRITE, address, register, data])
-     ser.write(packet)
-     if debug:
-        print("ctrl tx: [%s]" % prettyHex(packet))
+    packet = bytes([0x09, 0x00, 0x01, 0x00, PAGE_I2C, I2C_COMMAND_WRITE, address, register, data])
+    if hasattr(ser, 'transact'):
+        # keep the write ordered with later reads and collect its ack
+        ctrl_transaction(ser, packet, 4, debug)
+    else:
+        ctrl_send(ser, packet, debug)
+
+#write several bytes starting at a register, e.g. a 16-bit sensor register
+def i2c_send_frame(ser, address, register, data_bytes, debug=False):
+    packet = bytes([0x08 + len(data_bytes), 0x00, 0x01, 0x00, PAGE_I2C, I2C_COMMAND_WRITE, address, register]) + bytes(data_bytes)
+    if hasattr(ser, 'transact'):
+        ctrl_transaction(ser, packet, 4, debug)
+    else:
+        ctrl_send(ser, packet, debug)
+
+#plain I2C read with no register pointer write; None if the device doesn't answer
+def i2c_read(ser, id, address, size, debug=False):
+    packet = bytes([0x08, 0x00, id, 0x00, PAGE_I2C, I2C_COMMAND_READ, address, size])
+    data = ctrl_transaction(ser, packet, size+3, debug)
+    if data is None or len(data) < size+3:
+        return None
+
+    return data[-size:]
 
 def i2c_read_bytes(ser, id, address, register, size, debug=False):
-    ser.reset_input_buffer()
     packet = bytes([0x09, 0x00, id, 0x00, PAGE_I2C, I2C_COMMAND_READWRITE, address, register, size])
-    ser.write(packet)
-    if debug:
-        print("ctrl tx: [%s]" % prettyHex(packet))
-    data = ser.read(size+3)
-    if data:
-        bytes_read = len(data)
-        if bytes_read > 0:
-            if debug:
-                print("ctrl rx: [%s]" % prettyHex(data))
-            if data[2] != id:
-                print("Error: ID mismatch. Expected %02X, got %02X" % (id, data[2]))
-                return None
-        else:
-            print("No data received")
-            return None
-    else:
-        print("No data received")
+    data = ctrl_transaction(ser, packet, size+3, debug, retries=CTRL_RETRIES)
+    if data is None or len(data) < size+3:
         return None
 
     return data[-size:]
@@ -193,61 +352,66 @@ def i2c_read_bytes(ser, id, address, register, size, debug=False):
 # - **Second byte**: Bit 8 (only LSB is used, can be 0 or 1)
 def asic_write(ser, data, debug=False):
     ser.reset_input_buffer()
-    packet = []
-    for value in data:
-        lower_byte = value & 0xFF
-        upper_byte = (value >> 8) & 0x01  # Only bit 8 is used
-        packet.append(lower_byte)
-        packet.append(upper_byte)
+    packet = asic_codec.encode9(data)
 
     if debug:
         print("asic tx: [%s]" % prettyHex(packet))
         print("asic tx9: [%s]" % prettyHex9(packet))
 
+    start = metrics.begin(port_name(ser), 'asic_write', packet)
     ser.write(packet)
+    metrics.end(port_name(ser), 'asic_write', packet, None, start)
     return
 
-def asic_read(ser, length, debug=False):
+#asic_read returns a list of the u16 values, or decodes straight into out
+# (a preallocated array('H') or NumPy uint16 array) and returns it when given
+def asic_read(ser, length, debug=False, out=None):
     expected_bytes = length * 2  # Each u16 is sent as 2 bytes
+    start = metrics.begin(port_name(ser), 'asic_read', None)
     rxdata = ser.read(expected_bytes)
 
     if len(rxdata) != expected_bytes:
-        print(f"Error: Expected {expected_bytes} bytes, got {len(rxdata)} bytes")
+        metrics.end(port_name(ser), 'asic_read', None, rxdata, start, STATUS_SHORT if rxdata else STATUS_TIMEOUT)
         if debug:
+            print(f"Error: Expected {expected_bytes} bytes, got {len(rxdata)} bytes")
             print("      asic rx: [%s]" % prettyHex9(rxdata))
         return []
+    metrics.end(port_name(ser), 'asic_read', None, rxdata, start)
     
     if debug:
         print("asic rx: [%s]" % prettyHex9(rxdata))
 
-    data = []
-    for i in range(0, len(rxdata), 2):
-        lower_byte = rxdata[i]
-        upper_byte = rxdata[i + 1] & 0x01  # Only bit 8 is used
-        value = (upper_byte << 8) | lower_byte
-        data.append(value)
-
-    return data
+    if out is not None:
+        asic_codec.decode9_into(rxdata, out)
+        return out
+    return asic_codec.decode9(rxdata).tolist()
     
 
 def reset_asic(ser, hashboard_num, debug=False):
-    if hashboard_num == 0:
-        rst_pin = GPIO_HB0_RST
-    elif hashboard_num == 1:
-        rst_pin = GPIO_HB1_RST
-    elif hashboard_num == 2:
-        rst_pin = GPIO_HB2_RST
-    else:
-        raise ValueError("Invalid hashboard number. Must be 0-2.")
-    
+    reset_asics(ser, [hashboard_num], debug)
+
+def reset_asics(ser, hashboards, debug=False):
+    """
+    Pulse the reset line of several hashboards together: all go low, one
+    100 ms wait, then all go high again.
+    """
+    rst_pins = []
+    for hashboard_num in hashboards:
+        if hashboard_num == 0:
+            rst_pins.append(GPIO_HB0_RST)
+        elif hashboard_num == 1:
+            rst_pins.append(GPIO_HB1_RST)
+        elif hashboard_num == 2:
+            rst_pins.append(GPIO_HB2_RST)
+        else:
+            raise ValueError("Invalid hashboard number. Must be 0-2.")
+
     # Construct the command to reset the ASIC
-    command = bytes([0x07, 0x00, 0x00, 0x00, PAGE_GPIO, rst_pin, GPIO_LOW])
-    if debug:
-        print("reset_asic tx: [%s]" % prettyHex(command))
-    ser.write(command)
+    for rst_pin in rst_pins:
+        command = bytes([0x07, 0x00, 0x00, 0x00, PAGE_GPIO, rst_pin, GPIO_LOW])
+        ctrl_send(ser, command, debug, "reset_asic")
     time.sleep(0.1)
 
-    command = bytes([0x07, 0x00, 0x00, 0x00, PAGE_GPIO, rst_pin, GPIO_HIGH])
-    if debug:
-        print("reset_asic tx: [%s]" % prettyHex(command))
-    ser.write(command)
+    for rst_pin in rst_pins:
+        command = bytes([0x07, 0x00, 0x00, 0x00, PAGE_GPIO, rst_pin, GPIO_HIGH])
+        ctrl_send(ser, command, debug, "reset_asic")
@@ -0,0 +1,562 @@
+import argparse
+import heapq
+import os
+import pty
+import random
+import threading
+import time
+import tty
+
+import APW_PSU
+import TMP75
+import bitcrane
+import bm13xx
+
+#pseudo-terminal Bitcrane firmware simulator
+#
+# Opens one pty for the control port and one per hashboard ASIC port. The
+# slave paths can be handed to serial.Serial() or any of the scripts in place
+# of the /dev/tty.usbmodem... paths, so the library can be exercised and
+# benchmarked without a board.
+#
+# Control port: PAGE_GPIO, PAGE_FAN, PAGE_I2C (TMP75 register maps), PAGE_PSU
+# (APW 0x55AA framing) and the LED page 0x08.
+# ASIC ports: a BM1362 chain answering set address, read/write register and
+# chain inactive commands.
+
+
+BM1362_CHIP_ID = 0x13620300
+
+TMP75_ADDRESSES = (
+    TMP75.TMP75_HB0_I2CADDR0, TMP75.TMP75_HB0_I2CADDR1,
+    TMP75.TMP75_HB1_I2CADDR0, TMP75.TMP75_HB1_I2CADDR1,
+    TMP75.TMP75_HB2_I2CADDR0, TMP75.TMP75_HB2_I2CADDR1,
+)
+PSU_I2C_ADDR = 0x10
+FAN_MAX_RPM = 6000
+
+
+class SimPort:
+    """
+    One pty pair. Bytes written by the client arrive at on_data(); replies are
+    queued with a due time and written back in order by a delivery thread.
+    """
+
+    def __init__(self, name, on_data, latency, jitter, drop_rate, rng):
+        self.name = name
+        self.on_data = on_data
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.rng = rng
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.dropped = 0
+        self._queue = []
+        self._seq = 0
+        self._last_due = 0.0
+        self._cond = threading.Condition()
+        self._stop = False
+        self._threads = [
+            threading.Thread(target=self._read_loop, name="sim-%s-rx" % name, daemon=True),
+            threading.Thread(target=self._deliver_loop, name="sim-%s-tx" % name, daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def reply(self, data, delay=0.0):
+        """Queue data for the client after the port latency plus delay."""
+        if self.drop_rate and self.rng.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        due = time.monotonic() + self.latency + delay
+        if self.jitter:
+            due += self.rng.uniform(0, self.jitter)
+        with self._cond:
+            # the firmware answers in order, jitter only stretches the gaps
+            due = max(due, self._last_due)
+            self._last_due = due
+            self._seq += 1
+            heapq.heappush(self._queue, (due, self._seq, bytes(data)))
+            self._cond.notify()
+
+    def _read_loop(self):
+        while not self._stop:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            self.rx_bytes += len(data)
+            self.on_data(data)
+
+    def _deliver_loop(self):
+        with self._cond:
+            while not self._stop:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, seq, data = self._queue[0]
+                now = time.monotonic()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._queue)
+                try:
+                    os.write(self.master, data)
+                    self.tx_bytes += len(data)
+                except OSError:
+                    return
+
+
+class Tmp75Model:
+    def __init__(self, temperature):
+        self.temperature = temperature
+        self.config = 0x00
+        self.tlow = 0x4B00      # 75 C power-on default
+        self.thigh = 0x5000     # 80 C power-on default
+        self.last = self.sample()
+        self.alert = False
+        self.above = False      # interrupt mode: t_high crossed, waiting for t_low
+
+    @staticmethod
+    def celsius(raw):
+        return (raw - 0x10000 if raw & 0x8000 else raw) / 256.0
+
+    def update_alert(self):
+        t = self.temperature
+        if not self.config & TMP75.TMP75_CFG_TM:
+            # comparator: asserted above t_high until back below t_low
+            if t >= self.celsius(self.thigh):
+                self.alert = True
+            elif t < self.celsius(self.tlow):
+                self.alert = False
+        elif not self.above and t >= self.celsius(self.thigh):
+            self.alert = self.above = True
+        elif self.above and t < self.celsius(self.tlow):
+            self.alert = True
+            self.above = False
+
+    def alert_response(self):
+        # only interrupt mode answers the SMBus alert response address
+        self.update_alert()
+        if self.alert and self.config & TMP75.TMP75_CFG_TM:
+            self.alert = False
+            return True
+        return False
+
+    def sample(self):
+        resolution = 9 + ((self.config >> 5) & 0x03)
+        steps = 1 << (resolution - 8)
+        raw = int(round(self.temperature * steps)) << (16 - resolution)
+        return raw & 0xFFFF
+
+    def read(self, register, size):
+        self.update_alert()
+        if self.config & TMP75.TMP75_CFG_TM:
+            self.alert = False      # any register read clears an interrupt-mode alert
+        if register == TMP75.TMP75_TEMP_REG:
+            if not self.config & 0x01:
+                self.last = self.sample()
+            value = self.last
+        elif register == TMP75.TMP75_CONFIG_REG:
+            return bytes([self.config])[:size] + bytes(max(0, size - 1))
+        elif register == TMP75.TMP75_TLO_REG:
+            value = self.tlow
+        else:
+            value = self.thigh
+        return value.to_bytes(2, 'big')[:size] + bytes(max(0, size - 2))
+
+    def write(self, register, data):
+        if register == TMP75.TMP75_CONFIG_REG and data:
+            if data[0] & 0x80 and data[0] & 0x01:
+                self.last = self.sample()   # one-shot conversion while shut down
+            self.config = data[0] & 0x7F
+        elif register == TMP75.TMP75_TLO_REG and len(data) >= 2:
+            self.tlow = (data[0] << 8) | data[1]
+        elif register == TMP75.TMP75_THI_REG and len(data) >= 2:
+            self.thigh = (data[0] << 8) | data[1]
+
+
+class PsuModel:
+    """APW PSU behind the PAGE_PSU I2C bridge: 0x55AA framed commands and responses."""
+
+    def __init__(self, latency, rng):
+        self.latency = latency
+        self.rng = rng
+        self.rx = bytearray()
+        self.response = bytes(8)
+        self.ready_at = 0.0
+        self.cursor = 0
+        self.voltage_raw = 0x80
+        self.offset_error = 0.0     # volts this unit is off from the default setpoint conversion
+        self.watchdog = 0x01
+        self.wdt_feeds = 0
+        self.hw_version = (0x12, 0x34)
+        self.fw_version = (0x56, 0x78)
+        self.cal = (0x5A, 0x01)
+
+    def volts(self):
+        return APW_PSU.PSU_SET_OFFSET + self.offset_error + self.voltage_raw * APW_PSU.PSU_SET_SLOPE
+
+    def write(self, data):
+        self.rx += data
+        # a frame starts at 55 AA and its length byte covers everything after the header
+        start = self.rx.find(b'\x55\xAA')
+        if start < 0:
+            del self.rx[:-1]
+            return
+        del self.rx[:start]
+        if len(self.rx) < 3 or len(self.rx) < self.rx[2] + 2:
+            return
+        frame = bytes(self.rx[:self.rx[2] + 2])
+        del self.rx[:len(frame)]
+        if APW_PSU.check_response(frame):
+            self.command(frame[3], frame[4:-2])
+
+    def command(self, cmd, args):
+        if cmd == APW_PSU.PSU_CMD_GET_HW_VERSION:
+            payload = self.hw_version
+        elif cmd == APW_PSU.PSU_CMD_GET_FW_VERSION:
+            payload = self.fw_version
+        elif cmd == APW_PSU.PSU_CMD_SET_VOLTAGE:
+            self.voltage_raw = args[0] if args else self.voltage_raw
+            payload = (self.voltage_raw, 0x00)
+        elif cmd == APW_PSU.PSU_CMD_GET_VOLTAGE:
+            payload = (self.voltage_raw, 0x00)
+        elif cmd == APW_PSU.PSU_CMD_MEASURE_VOLTAGE:
+            counts = int(round((self.volts() + self.rng.uniform(-0.01, 0.01)) * APW_PSU.PSU_MEASURE_SCALE - APW_PSU.PSU_MEASURE_OFFSET))
+            payload = (counts & 0xFF, (counts >> 8) & 0xFF)
+        elif cmd == APW_PSU.PSU_CMD_DISABLE_WDT:
+            self.watchdog = args[0] if args else 0
+            payload = (self.watchdog, 0x00)
+        elif cmd == APW_PSU.PSU_CMD_FEED_WDT:
+            self.wdt_feeds += 1
+            payload = (0x00, 0x00)
+        elif cmd == APW_PSU.PSU_CMD_READ_CAL:
+            payload = self.cal
+        else:
+            return
+        self.response = bytes(APW_PSU.make_packet([cmd] + list(payload)))
+        self.ready_at = time.monotonic() + self.latency
+        self.cursor = 0
+
+    def read(self, size):
+        data = bytearray()
+        for _ in range(size):
+            if self.cursor == 0 and time.monotonic() < self.ready_at:
+                data.append(0x00)       # not ready yet, the bridge reads back zeros
+                continue
+            data.append(self.response[self.cursor])
+            self.cursor = (self.cursor + 1) % len(self.response)
+        return bytes(data)
+
+
+class AsicChainModel:
+    """
+    A BM1362 chain on one ASIC port. With a nonce_rate it also answers work
+    frames with synthetic nonces, on average nonce_rate per second for the
+    whole chain, for the most recent job.
+    """
+
+    def __init__(self, port, chip_count, chip_latency, rng, nonce_rate=0.0):
+        self.port = port
+        self.chip_count = chip_count
+        self.chip_latency = chip_latency
+        self.rng = rng
+        self.rx = bytearray()
+        self.addresses = []
+        self.registers = {}
+        self.inactive = False
+        self.faults = {}
+        self.nonce_rate = nonce_rate
+        self.job_id = None
+        self.jobs = 0
+        self.nonces = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.nonce_rate and self._thread is None:
+            self._thread = threading.Thread(target=self._nonce_loop, name="sim-nonces", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def _nonce_loop(self):
+        next_at = time.monotonic()
+        while not self._stop.wait(0.005):
+            now = time.monotonic()
+            if self.job_id is None:
+                next_at = now
+                continue
+            # chips with a miss_rate fault find proportionally fewer nonces
+            weights = [1.0 - self.faults.get(i, (0.0, 0.0, 0.0))[1] for i in range(self.chip_count)]
+            while next_at <= now:
+                i = self.rng.choices(range(self.chip_count), weights)[0]
+                value = (self.chip_address(i) << 24) | self.rng.getrandbits(24)
+                reg_addr = self.job_id | self.rng.randrange(8)    # job ID plus the core that found it
+                self.port.reply(self.response(value, 0x00, reg_addr, self.rng.getrandbits(16), bm13xx.ASIC_RESPONSE_JOB_FLAG))
+                self.nonces += 1
+                next_at += self.rng.expovariate(self.nonce_rate)
+
+    def set_fault(self, index, delay=0.0, miss_rate=0.0, corrupt_rate=0.0):
+        """
+        Make the chip at chain position index slow (delay seconds, which
+        every chip after it inherits), drop replies or corrupt their CRC.
+        """
+        self.faults[index] = (delay, miss_rate, corrupt_rate)
+
+    def response(self, value, chip_addr, reg_addr, extra=0, flags=0x00):
+        body = bytearray(value.to_bytes(4, 'big') + bytes([chip_addr, reg_addr]) + extra.to_bytes(2, 'big') + bytes([flags]))
+        body[-1] |= bm13xx.crc5(body, len(body) * 8 - 5)
+        return bm13xx.ASIC_RESPONSE_PREAMBLE + bytes(body)
+
+    def chip_address(self, index):
+        if index < len(self.addresses):
+            return self.addresses[index]
+        return 0x00
+
+    def feed(self, data):
+        self.rx += data
+        while True:
+            start = self.rx.find(b'\x55\xAA')
+            if start < 0:
+                del self.rx[:-1]
+                return
+            del self.rx[:start]
+            if len(self.rx) < 4 or len(self.rx) < self.rx[3] + 2:
+                return
+            frame = bytes(self.rx[:self.rx[3] + 2])
+            del self.rx[:len(frame)]
+            self.command(frame)
+
+    def command(self, frame):
+        header = frame[2]
+        if header & 0xE0 == bm13xx.CMD_TYPE_WORK:
+            self.job_id = frame[4]      # first payload byte
+            self.jobs += 1
+            return
+        if header & 0xE0 != bm13xx.CMD_TYPE_COMMAND:
+            return                      # unknown frames are ignored
+        broadcast = bool(header & bm13xx.CMD_BROADCAST)
+        cmd = header & 0x0F
+        if cmd == bm13xx.CMD_SET_ADDRESS and not broadcast:
+            # set address: the first chip that doesn't have one takes it
+            if len(self.addresses) < self.chip_count:
+                self.addresses.append(frame[4])
+        elif cmd == bm13xx.CMD_WRITE_REGISTER:
+            self.registers[frame[5]] = int.from_bytes(frame[6:10], 'big')
+        elif cmd == bm13xx.CMD_READ_REGISTER:
+            reg = frame[5]
+            if broadcast:
+                chips = range(self.chip_count)
+            else:
+                chips = [i for i in range(self.chip_count) if self.chip_address(i) == frame[4]]
+            extra = 0.0
+            for i in chips:
+                value = BM1362_CHIP_ID if reg == bm13xx.REG_CHIP_ID else self.registers.get(reg, 0)
+                response = self.response(value, self.chip_address(i), reg)
+                delay, miss_rate, corrupt_rate = self.faults.get(i, (0.0, 0.0, 0.0))
+                extra += delay
+                if miss_rate and self.rng.random() < miss_rate:
+                    continue
+                if corrupt_rate and self.rng.random() < corrupt_rate:
+                    response = response[:2] + bytes([response[2] ^ 0x01]) + response[3:]
+                self.port.reply(response, self.chip_latency * (i + 1) + extra)
+        elif cmd == bm13xx.CMD_CHAIN_INACTIVE:
+            self.inactive = True
+            self.addresses = []         # every chip waits for a new address
+
+
+class BitcraneSim:
+    """
+    Simulated Bitcrane controller with hashboards.
+
+    Args:
+        latency: Seconds before each control reply is sent
+        jitter: Extra random delay, uniform 0-jitter seconds, per reply
+        drop_rate: Probability that a reply is never sent
+        chip_count: ASIC chips per hashboard chain
+        chip_latency: Seconds between consecutive chip responses on a chain
+        psu_latency: Seconds the PSU takes to prepare a response
+        psu_bulk: Whether the firmware accepts whole-frame PSU transfers
+        hashboards: Which hashboards are plugged in
+        nonce_hashrate: H/s each chain "hashes" at once it has a job (0 = no nonces)
+        nonce_difficulty: Ticket difficulty the synthetic nonces stand for
+    """
+
+    def __init__(self, latency=0.0005, jitter=0.0, drop_rate=0.0, chip_count=bm13xx.S19JPRO_ASIC_COUNT,
+                 chip_latency=0.0001, psu_latency=0.03, psu_bulk=True, hashboards=(0, 1, 2), seed=None,
+                 nonce_hashrate=0.0, nonce_difficulty=256):
+        self.rng = random.Random(seed)
+        self.psu_bulk = psu_bulk
+        self.gpio = {}
+        self.fan_duty = {1: 0, 2: 0, 3: 0, 4: 0}
+        self.led = (0, 0, 0)
+        self.tmp75 = {address: Tmp75Model(40.0 + 2.5 * n) for n, address in enumerate(TMP75_ADDRESSES)}
+        self.psu = PsuModel(psu_latency, self.rng)
+        self.commands = 0
+        self._rx = bytearray()
+        self.ctrl = SimPort("ctrl", self._ctrl_data, latency, jitter, drop_rate, self.rng)
+        self.asic = {}
+        self.chains = {}
+        for hashboard_num in hashboards:
+            port = SimPort("hb%d" % hashboard_num, None, latency, jitter, drop_rate, self.rng)
+            chain = AsicChainModel(port, chip_count, chip_latency, self.rng, nonce_hashrate / (nonce_difficulty * (1 << 32)))
+            port.on_data = chain.feed
+            self.asic[hashboard_num] = port
+            self.chains[hashboard_num] = chain
+
+    @property
+    def ctrl_port(self):
+        return self.ctrl.path
+
+    @property
+    def asic_ports(self):
+        return {hashboard_num: port.path for hashboard_num, port in self.asic.items()}
+
+    def start(self):
+        self.ctrl.start()
+        for port in self.asic.values():
+            port.start()
+        for chain in self.chains.values():
+            chain.start()
+        return self
+
+    def close(self):
+        for chain in self.chains.values():
+            chain.close()
+        self.ctrl.close()
+        for port in self.asic.values():
+            port.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ctrl_data(self, data):
+        buf = self._rx
+        buf += data
+        while len(buf) >= 2:
+            length = buf[0] | (buf[1] << 8)
+            if length < 6:
+                del buf[0]              # not a packet header, resync
+                continue
+            if len(buf) < length:
+                return
+            packet = bytes(buf[:length])
+            del buf[:length]
+            self.commands += 1
+            self._ctrl_packet(packet)
+
+    def _ack(self, id, payload=b'\x00'):
+        self.ctrl.reply(bytes([3 + len(payload), 0x00, id]) + bytes(payload))
+
+    def _ctrl_packet(self, packet):
+        id, page, cmd, args = packet[2], packet[4], packet[5], packet[6:]
+        if page == bitcrane.PAGE_GPIO:
+            self.gpio[cmd] = args[0] if args else 0
+            self._ack(id)
+            if cmd in (bitcrane.GPIO_HB0_RST, bitcrane.GPIO_HB1_RST, bitcrane.GPIO_HB2_RST) and args and args[0] == bitcrane.GPIO_LOW:
+                chain = self.chains.get(cmd >> 4)
+                if chain is not None:
+                    chain.addresses = []
+                    chain.registers = {}
+                    chain.inactive = False
+        elif page == bitcrane.PAGE_FAN:
+            fan_num = cmd & 0x0F
+            if fan_num not in self.fan_duty:
+                return
+            if cmd & 0xF0 == 0x10:
+                self.fan_duty[fan_num] = args[0] if args else 0
+                self._ack(id)
+            else:
+                rpm = int(self.fan_duty[fan_num] * FAN_MAX_RPM / 100)
+                if rpm:
+                    rpm += self.rng.randint(-20, 20)
+                self._ack(id, rpm.to_bytes(2, 'little'))
+        elif page == bitcrane.PAGE_I2C:
+            self._i2c(id, cmd, args)
+        elif page == bitcrane.PAGE_PSU:
+            self._psu(id, cmd, args)
+        elif page == bitcrane.PAGE_LED and cmd == bitcrane.LED_COLOR_CMD and len(args) >= 3:
+            self.led = tuple(args[:3])
+            self._ack(id)
+
+    def _i2c(self, id, cmd, args):
+        if cmd == bitcrane.I2C_COMMAND_WRITE and len(args) >= 3:
+            sensor = self.tmp75.get(args[0])
+            if sensor is None:
+                self._ack(id, b'')      # NACK: header only
+                return
+            sensor.write(args[1], args[2:])
+            self._ack(id)
+        elif cmd == bitcrane.I2C_COMMAND_READWRITE and len(args) >= 3:
+            sensor = self.tmp75.get(args[0])
+            if sensor is None:
+                self._ack(id, b'')
+                return
+            self._ack(id, sensor.read(args[1], args[2]))
+        elif cmd == bitcrane.I2C_COMMAND_READ and len(args) >= 2 and args[0] == TMP75.SMBUS_ARA_ADDR:
+            # lowest address wins arbitration; nobody alerting is a NACK
+            for address in sorted(self.tmp75):
+                if self.tmp75[address].alert_response():
+                    self._ack(id, bytes([address << 1]) + bytes(max(0, args[1] - 1)))
+                    return
+            self._ack(id, b'')
+
+    def _psu(self, id, cmd, args):
+        if cmd == bitcrane.I2C_COMMAND_WRITE and len(args) >= 3 and args[0] == PSU_I2C_ADDR:
+            if len(args) > 3 and not self.psu_bulk:
+                return                  # old firmware: silently ignores multi-byte writes
+            self.psu.write(args[2:])
+            self._ack(id)
+        elif cmd == bitcrane.I2C_COMMAND_READ and len(args) >= 2 and args[0] == PSU_I2C_ADDR:
+            if args[1] > 1 and not self.psu_bulk:
+                return
+            self._ack(id, self.psu.read(args[1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pseudo-terminal Bitcrane firmware simulator")
+    parser.add_argument('--latency', type=float, default=0.5, help="control/ASIC reply latency in ms (default 0.5)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random reply delay in ms (default 0)")
+    parser.add_argument('--drop', type=float, default=0.0, help="probability of dropping a reply (default 0)")
+    parser.add_argument('--chips', type=int, default=bm13xx.S19JPRO_ASIC_COUNT, help="ASIC chips per chain (default 126)")
+    parser.add_argument('--psu-latency', type=float, default=30.0, help="PSU response preparation time in ms (default 30)")
+    parser.add_argument('--no-psu-bulk', action='store_true', help="reject whole-frame PSU transfers like older firmware")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    sim = BitcraneSim(latency=args.latency / 1000, jitter=args.jitter / 1000, drop_rate=args.drop,
+                      chip_count=args.chips, psu_latency=args.psu_latency / 1000,
+                      psu_bulk=not args.no_psu_bulk, seed=args.seed)
+    with sim:
+        print("Control port: %s" % sim.ctrl_port)
+        for hashboard_num, path in sorted(sim.asic_ports.items()):
+            print("HB%d ASIC port: %s" % (hashboard_num, path))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(" -> Stopping the simulator.")
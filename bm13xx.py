@@ -0,0 +1,299 @@
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+from metrics import metrics, rtt
+
+#BM13xx ASIC chain protocol helpers (BM1362 on the Antminer S19j Pro hashboards)
+#
+# Responses on the ASIC port are 11 byte frames:
+#   AA 55 | d0 d1 d2 d3 | chip_addr | reg_addr | x0 x1 | flags:3 crc5:5
+# For register reads d0-d3 is the big-endian register value. The CRC5 covers
+# every bit after the preamble except its own 5 bits.
+
+ASIC_RESPONSE_PREAMBLE = b'\xAA\x55'
+ASIC_RESPONSE_LEN = 11
+ASIC_RESPONSE_JOB_FLAG = 0x80   # set in the last byte for nonce/job responses
+
+S19JPRO_ASIC_COUNT = 126        # BM1362 chips on one S19j Pro hashboard
+ASIC_IDLE_TIMEOUT = 0.1         # seconds of silence that end a response burst, at most
+
+ASIC_COMMAND_PREAMBLE = b'\x55\xAA'
+CMD_TYPE_WORK = 0x20
+CMD_TYPE_COMMAND = 0x40
+CMD_BROADCAST = 0x10
+CMD_SET_ADDRESS = 0x00
+CMD_WRITE_REGISTER = 0x01
+CMD_READ_REGISTER = 0x02
+CMD_CHAIN_INACTIVE = 0x03
+
+REG_CHIP_ID = 0x00
+REG_VERSION_MASK = 0xA4
+
+AsicResponse = namedtuple('AsicResponse', 'value chip_addr reg_addr extra is_job timestamp raw')
+AsicResponse.__doc__ = """
+One validated response from the chain.
+    value: d0-d3 as a big-endian int (register value, or the raw nonce bytes)
+    chip_addr, reg_addr: bytes 6 and 7
+    extra: bytes 8-9 as a big-endian int (version bits on nonce responses)
+    is_job: True for nonce/job responses, False for register reads
+    timestamp: time.monotonic() of the read that completed the frame
+    raw: the full 11 byte frame
+"""
+
+
+def _crc5_table():
+    # the 5-bit CRC is kept in the top bits of a byte so a whole byte shifts through at once
+    table = []
+    for i in range(256):
+        reg = i
+        for _ in range(8):
+            reg = ((reg << 1) ^ (CRC5_POLY << 3)) if reg & 0x80 else (reg << 1)
+        table.append(reg & 0xF8)
+    return bytes(table)
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC16_POLY) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+CRC5_POLY = 0x05
+CRC5_INIT = 0x1F
+CRC16_POLY = 0x1021
+CRC16_INIT = 0xFFFF
+_CRC5_TABLE = _crc5_table()
+_CRC16_TABLE = _crc16_table()
+
+def crc5(data, bits=None):
+    """
+    BM13xx CRC5 (poly 0x05, init 0x1F, MSB first) over the first `bits` bits
+    of data, all of it by default. Commands carry it as their last byte.
+    """
+    if bits is None:
+        bits = len(data) * 8
+    table = _CRC5_TABLE
+    reg = CRC5_INIT << 3
+    for byte in data[:bits >> 3]:
+        reg = table[reg ^ byte]
+    crc = reg >> 3
+    # leftover bits of a partial last byte, one at a time
+    if bits & 7:
+        byte = data[bits >> 3]
+        for i in range(bits & 7):
+            feedback = ((crc >> 4) & 1) ^ ((byte >> (7 - i)) & 1)
+            crc = (crc << 1) & 0x1F
+            if feedback:
+                crc ^= CRC5_POLY
+    return crc
+
+def crc16(data):
+    """CRC16-CCITT (poly 0x1021, init 0xFFFF) used on work frames, appended big-endian."""
+    table = _CRC16_TABLE
+    crc = CRC16_INIT
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+def check_response_crc(frame):
+    """True if the CRC5 in the low bits of the last byte matches the frame."""
+    body = frame[2:]
+    return crc5(body, len(body) * 8 - 5) == (frame[-1] & 0x1F)
+
+def parse_response(frame, timestamp=None):
+    return AsicResponse(
+        value=int.from_bytes(frame[2:6], 'big'),
+        chip_addr=frame[6],
+        reg_addr=frame[7],
+        extra=(frame[8] << 8) | frame[9],
+        is_job=bool(frame[10] & ASIC_RESPONSE_JOB_FLAG),
+        timestamp=timestamp,
+        raw=bytes(frame),
+    )
+
+
+#-----
+# command frames: 55 AA | header | length | payload | crc
+# header = type | broadcast | command, length counts everything after 55 AA.
+# Commands end in a CRC5 byte, work frames in a big-endian CRC16. Builders
+# are memoized and return immutable bytes, so repeated frames cost a dict lookup.
+
+def command_frame(header, payload):
+    body = bytes([header, len(payload) + 3]) + bytes(payload)
+    return ASIC_COMMAND_PREAMBLE + body + bytes([crc5(body)])
+
+def work_frame(payload):
+    body = bytes([CMD_TYPE_WORK | 0x01, len(payload) + 4]) + bytes(payload)
+    crc = crc16(body)
+    return ASIC_COMMAND_PREAMBLE + body + bytes([crc >> 8, crc & 0xFF])
+
+@lru_cache(maxsize=1024)
+def set_address(chip_addr):
+    return command_frame(CMD_TYPE_COMMAND | CMD_SET_ADDRESS, [chip_addr, 0x00])
+
+@lru_cache(maxsize=None)
+def chain_inactive():
+    return command_frame(CMD_TYPE_COMMAND | CMD_BROADCAST | CMD_CHAIN_INACTIVE, [0x00, 0x00])
+
+@lru_cache(maxsize=4096)
+def read_register(reg_addr, chip_addr=None):
+    """Read a register from one chip, or from every chip when chip_addr is None."""
+    if chip_addr is None:
+        return command_frame(CMD_TYPE_COMMAND | CMD_BROADCAST | CMD_READ_REGISTER, [0x00, reg_addr])
+    return command_frame(CMD_TYPE_COMMAND | CMD_READ_REGISTER, [chip_addr, reg_addr])
+
+@lru_cache(maxsize=4096)
+def write_register(reg_addr, value, chip_addr=None):
+    """Write a 32-bit register on one chip, or on every chip when chip_addr is None."""
+    payload = [0x00 if chip_addr is None else chip_addr, reg_addr] + list(value.to_bytes(4, 'big'))
+    if chip_addr is None:
+        return command_frame(CMD_TYPE_COMMAND | CMD_BROADCAST | CMD_WRITE_REGISTER, payload)
+    return command_frame(CMD_TYPE_COMMAND | CMD_WRITE_REGISTER, payload)
+
+def ping():
+    """Broadcast read of the chip ID register, every chip answers."""
+    return read_register(REG_CHIP_ID)
+
+def compile_frames(frames):
+    """Join a sequence of frames into one contiguous buffer for a single write."""
+    return b''.join(frames)
+
+def address_interval(chip_count):
+    return max(1, 256 // chip_count)
+
+def chip_addresses(chip_count):
+    interval = address_interval(chip_count)
+    return [i * interval for i in range(chip_count)]
+
+@lru_cache(maxsize=16)
+def address_chain(chip_count):
+    """
+    Chain inactive followed by one set address per chip, spread evenly over
+    the 8-bit address space, compiled into one buffer.
+    """
+    return compile_frames([chain_inactive()] + [set_address(addr) for addr in chip_addresses(chip_count)])
+
+def send(ser, frame):
+    """Write a command frame or compiled sequence to an ASIC port."""
+    port = getattr(ser, 'port', None)
+    begin = metrics.begin(port, 'asic_cmd', frame)
+    ser.write(frame)
+    metrics.end(port, 'asic_cmd', frame, None, begin)
+
+
+class ResponseFramer:
+    """
+    Incremental framer for the ASIC response stream.
+
+    Bytes are fed in whatever chunks the port returns; complete frames are
+    cut out on the 0xAA55 preamble, checked with CRC5 and returned as
+    AsicResponse records. On a CRC failure the framer slides one byte past
+    the preamble and searches again, so split, merged or corrupted reads
+    resync on the next good frame. on_crc_error, if set, is called with the
+    number of good frames so far at each failure, placing it in the stream.
+    """
+
+    def __init__(self, frame_len=ASIC_RESPONSE_LEN):
+        self.frame_len = frame_len
+        self.buf = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+        self.on_crc_error = None
+
+    def reset(self):
+        self.dropped_bytes += len(self.buf)
+        del self.buf[:]
+
+    def feed(self, data, timestamp=None):
+        """Add received bytes and return the list of complete responses."""
+        buf = self.buf
+        buf += data
+        responses = []
+        while True:
+            start = buf.find(ASIC_RESPONSE_PREAMBLE)
+            if start < 0:
+                # keep a trailing 0xAA, it may be the first half of a preamble
+                keep = 1 if buf[-1:] == ASIC_RESPONSE_PREAMBLE[:1] else 0
+                self.dropped_bytes += len(buf) - keep
+                del buf[:len(buf) - keep]
+                break
+            if start:
+                self.dropped_bytes += start
+                del buf[:start]
+            if len(buf) < self.frame_len:
+                break
+            frame = buf[:self.frame_len]
+            if check_response_crc(frame):
+                responses.append(parse_response(frame, timestamp))
+                self.frames += 1
+                del buf[:self.frame_len]
+            else:
+                self.crc_errors += 1
+                self.dropped_bytes += 1
+                del buf[:1]
+                if self.on_crc_error is not None:
+                    self.on_crc_error(self.frames)
+        return responses
+
+
+def read_responses(ser, expected=None, timeout=2.0, idle_timeout=None, framer=None):
+    """
+    Yield AsicResponse records from an ASIC serial port as they arrive.
+
+    Stops as soon as `expected` responses have been yielded, when nothing has
+    arrived for idle_timeout seconds after the first byte, or after timeout
+    seconds in total. The port timeout is shortened while reading and
+    restored afterwards.
+
+    With idle_timeout None it follows the largest gap between chunks of each
+    earlier burst on this port (metrics.rtt 'asic_gap:<port>'), up to
+    ASIC_IDLE_TIMEOUT, so a healthy chain's read ends a few gaps after the
+    last reply. A burst the idle cutoff ends short of expected counts as a
+    miss, which doubles the timeout for the next read, so a chip that has
+    become slow is waited for again instead of staying missing; a chain with
+    chips really missing backs off to ASIC_IDLE_TIMEOUT.
+    """
+    framer = framer or ResponseFramer()
+    port = getattr(ser, 'port', None)
+    gap_key = 'asic_gap:%s' % port
+    adaptive = idle_timeout is None
+    if adaptive:
+        idle_timeout = rtt.timeout(gap_key, ASIC_IDLE_TIMEOUT)
+    count = 0
+    max_gap = None
+    received = False
+    start = last_rx = time.monotonic()
+    saved_timeout = ser.timeout
+    ser.timeout = min(idle_timeout, timeout)
+    try:
+        while expected is None or count < expected:
+            begin = metrics.begin(port, 'asic_rx', None)
+            chunk = ser.read(ser.in_waiting or 1)
+            if chunk:
+                metrics.end(port, 'asic_rx', None, chunk, begin)
+            now = time.monotonic()
+            if chunk:
+                if received:
+                    max_gap = max(max_gap or 0.0, now - last_rx)
+                received = True
+                last_rx = now
+                for response in framer.feed(chunk, now):
+                    count += 1
+                    yield response
+                    if expected is not None and count >= expected:
+                        return
+            elif received and now - last_rx >= idle_timeout:
+                if adaptive and expected is not None:
+                    rtt.miss(gap_key)       # may have cut off a slow chip
+                    max_gap = None
+                return
+            if now - start >= timeout:
+                return
+    finally:
+        ser.timeout = saved_timeout
+        if adaptive and max_gap is not None:
+            rtt.record(gap_key, max_gap)
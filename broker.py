@@ -0,0 +1,564 @@
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import serial
+
+import APW_PSU
+from ctrl_transport import ControlTransport
+
+#control and ASIC port broker over a Unix domain socket
+#
+# One daemon owns the serial ports. Control-page requests from every client
+# are pipelined onto one ControlTransport, so they get their own rolling IDs
+# and can't collide the way two processes writing the same tty do. Bytes
+# from each ASIC port are fanned out to every client subscribed to it, and
+# ASIC writes are serialized per port. A PSU command is a write then several
+# polling reads on the shared PSU bridge, so clients hand the whole exchange
+# to the broker (OP_PSU), which runs it under its own PSU lock on a small
+# worker pool.
+#
+# Replies and ASIC data are produced on the transport and ASIC reader
+# threads, so they never write to a socket directly: each connection has an
+# outbound queue drained by its own writer thread, and a client that stops
+# reading until its queue fills is dropped rather than stalling the others.
+#
+# Wire format, both directions: a fixed header then the payload
+#   u8 op | u8 channel | u16 tag | u32 payload length
+# channel 0 is the control port, 1-3 the HB0-HB2 ASIC ports. The client
+# picks the tag and the broker echoes it on the reply, so a client can have
+# many control requests outstanding on one connection.
+
+BROKER_SOCKET = os.environ.get('BITCRANE_BROKER', '/tmp/bitcrane-broker.sock')
+
+_HEADER = struct.Struct('<BBHI')
+_PSU_REQUEST = struct.Struct('<BH')
+
+OP_TRANSACT = 0x01      # ctrl packet -> OP_REPLY with the reply bytes, or OP_TIMEOUT
+OP_SEND = 0x02          # ctrl packet, no reply
+OP_WRITE = 0x03         # raw bytes to an ASIC port
+OP_SUBSCRIBE = 0x04     # start receiving OP_DATA for an ASIC channel
+OP_UNSUBSCRIBE = 0x05
+OP_PSU = 0x06           # u8 reply length | u16 timeout ms | PSU frame -> OP_REPLY with the response, or OP_TIMEOUT
+OP_REPLY = 0x81
+OP_TIMEOUT = 0x82
+OP_DATA = 0x83          # bytes read from an ASIC port
+OP_ERROR = 0x84         # payload is an error message
+
+CHANNEL_CTRL = 0
+CHANNEL_NAMES = {0: 'ctrl', 1: 'hb0', 2: 'hb1', 3: 'hb2'}
+MAX_PAYLOAD = 1 << 20
+
+def asic_channel(hashboard_num):
+    return 1 + hashboard_num
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("broker connection closed")
+        buf += chunk
+    return bytes(buf)
+
+def _recv_frame(sock):
+    op, channel, tag, length = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ConnectionError("broker frame too large: %d bytes" % length)
+    return op, channel, tag, _recv_exact(sock, length) if length else b''
+
+def _frame(op, channel, tag, payload=b''):
+    return _HEADER.pack(op, channel, tag, len(payload)) + payload
+
+
+class _Connection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.subscriptions = set()
+        self.in_flight = threading.BoundedSemaphore(server.client_in_flight)
+        self.closed = False
+        self.dropped = False
+        self._outbox = queue.Queue(server.client_queue)
+        self._writer = threading.Thread(target=self._write_loop, name="broker-client-tx", daemon=True)
+        self._writer.start()
+
+    def send(self, op, channel, tag, payload=b''):
+        """Queue a frame for the writer thread. Never blocks."""
+        if self.closed:
+            return
+        try:
+            self._outbox.put_nowait(_frame(op, channel, tag, payload))
+        except queue.Full:
+            self.dropped = True     # not reading: drop it rather than stall everyone
+            self.shutdown()
+
+    def shutdown(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            frame = self._outbox.get()
+            if frame is None or self.closed:
+                return
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.shutdown()
+                return
+
+    def serve(self):
+        try:
+            while True:
+                op, channel, tag, payload = _recv_frame(self.sock)
+                self.server.handle(self, op, channel, tag, payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.shutdown()
+            try:
+                self._outbox.put_nowait(None)
+            except queue.Full:
+                pass        # the writer sees closed after its next frame
+            self.server.disconnect(self)
+            self._writer.join(timeout=1.0)
+            self.sock.close()
+
+
+class BrokerServer:
+    """
+    Serve a control port and up to three ASIC ports to local clients.
+
+    Args:
+        ctrl: Open serial.Serial (or ControlTransport) for the control port
+        asic_ports: {hashboard_num: open serial.Serial}
+        path: Unix socket path
+        client_in_flight: Control requests one client may have outstanding, so
+            one busy client can't take every transport slot
+        client_queue: Frames queued to one client before it is dropped as stalled
+        psu_workers: Threads running OP_PSU exchanges
+    """
+
+    def __init__(self, ctrl, asic_ports=None, path=BROKER_SOCKET, client_in_flight=16, client_queue=1024, psu_workers=2,
+                 timeout=1.0, debug=False):
+        self.transport = ctrl if hasattr(ctrl, 'request') else ControlTransport(ctrl, timeout=timeout, debug=debug)
+        self.asic_ports = {asic_channel(hashboard_num): ser for hashboard_num, ser in (asic_ports or {}).items()}
+        self.path = path
+        self.client_in_flight = client_in_flight
+        self.client_queue = client_queue
+        self.timeout = timeout
+        self.debug = debug
+        self.connections = set()
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.dropped = 0
+        self._psu_pool = ThreadPoolExecutor(max_workers=psu_workers, thread_name_prefix="broker-psu")
+        self._asic_locks = {channel: threading.Lock() for channel in self.asic_ports}
+        self._deadlines = deque()      # (deadline, future), in deadline order as the timeout is fixed
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sock = None
+        self._threads = []
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(16)
+        self._threads.append(threading.Thread(target=self._accept_loop, name="broker-accept", daemon=True))
+        self._threads.append(threading.Thread(target=self._expire_loop, name="broker-expire", daemon=True))
+        for channel, ser in self.asic_ports.items():
+            ser.timeout = 0.05
+            self._threads.append(threading.Thread(target=self._asic_loop, args=(channel, ser),
+                                                  name="broker-%s" % CHANNEL_NAMES[channel], daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._sock is not None:
+            self._sock.close()
+        with self._lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        self._psu_pool.shutdown(wait=False)
+        self.transport.close()
+        for ser in self.asic_ports.values():
+            ser.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            connection = _Connection(self, sock)
+            with self._lock:
+                self.connections.add(connection)
+            threading.Thread(target=connection.serve, name="broker-client", daemon=True).start()
+
+    def disconnect(self, connection):
+        with self._lock:
+            self.connections.discard(connection)
+            if connection.dropped:
+                self.dropped += 1
+
+    def handle(self, connection, op, channel, tag, payload):
+        if op == OP_TRANSACT:
+            self._transact(connection, tag, payload)
+        elif op == OP_PSU:
+            if len(payload) <= _PSU_REQUEST.size:
+                connection.send(OP_ERROR, channel, tag, b"short PSU request")
+                return
+            connection.in_flight.acquire()
+            self._psu_pool.submit(self._psu, connection, tag, payload)
+        elif op == OP_SEND:
+            self.transport.send(payload)
+        elif op == OP_WRITE:
+            lock = self._asic_locks.get(channel)
+            if lock is None:
+                connection.send(OP_ERROR, channel, tag, b"no such ASIC channel")
+                return
+            with lock:
+                self.asic_ports[channel].write(payload)
+        elif op == OP_SUBSCRIBE:
+            if channel in self.asic_ports:
+                connection.subscriptions.add(channel)
+            else:
+                connection.send(OP_ERROR, channel, tag, b"no such ASIC channel")
+        elif op == OP_UNSUBSCRIBE:
+            connection.subscriptions.discard(channel)
+        else:
+            connection.send(OP_ERROR, channel, tag, b"unknown op")
+
+    def _transact(self, connection, tag, packet):
+        connection.in_flight.acquire()
+        self.requests += 1
+        future = self.transport.request(packet)
+        with self._lock:
+            self._deadlines.append((time.monotonic() + self.timeout, future))
+
+        def done(f):
+            connection.in_flight.release()
+            if f.cancelled() or f.exception() is not None:
+                self.timeouts += 1
+                connection.send(OP_TIMEOUT, CHANNEL_CTRL, tag)
+            else:
+                connection.send(OP_REPLY, CHANNEL_CTRL, tag, f.result())
+        future.add_done_callback(done)
+
+    def _psu(self, connection, tag, payload):
+        # psu_transaction holds the transport's PSU lock from the write to the
+        # last poll, so exchanges from different clients can't interleave
+        try:
+            num_read_bytes, timeout_ms = _PSU_REQUEST.unpack_from(payload)
+            self.requests += 1
+            data = APW_PSU.psu_transaction(self.transport, list(payload[_PSU_REQUEST.size:]), num_read_bytes,
+                                           self.debug, timeout_ms / 1000.0)
+        except Exception as e:
+            self.errors += 1
+            connection.send(OP_ERROR, CHANNEL_CTRL, tag, ("PSU exchange failed: %s" % e).encode())
+            return
+        finally:
+            connection.in_flight.release()
+        if data is None:
+            self.timeouts += 1
+            connection.send(OP_TIMEOUT, CHANNEL_CTRL, tag)
+        else:
+            connection.send(OP_REPLY, CHANNEL_CTRL, tag, bytes(data))
+
+    def _expire_loop(self):
+        # cancel requests the transport never answered so their IDs and slots come back
+        while not self._stop.wait(0.02):
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][1].done()):
+                    deadline, future = self._deadlines.popleft()
+                    if not future.done():
+                        expired.append(future)
+            for future in expired:
+                self.transport.cancel(future)
+
+    def _asic_loop(self, channel, ser):
+        while not self._stop.is_set():
+            try:
+                chunk = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                if self._stop.is_set():
+                    return
+                time.sleep(0.01)
+                continue
+            if not chunk:
+                continue
+            with self._lock:
+                listeners = [c for c in self.connections if channel in c.subscriptions]
+            for connection in listeners:
+                connection.send(OP_DATA, channel, 0, chunk)
+
+
+class AsicChannel:
+    """
+    Serial-port-like view of one ASIC port through the broker: write(),
+    read(size) honoring .timeout, in_waiting and reset_input_buffer(), so
+    bm13xx.send / read_responses and bitcrane.asic_write / asic_read work on it.
+    """
+
+    def __init__(self, client, channel, timeout=2.0):
+        self.client = client
+        self.channel = channel
+        self.timeout = timeout
+        self._rxbuf = bytearray()
+        self._cond = threading.Condition()
+
+    @property
+    def port(self):
+        return "%s:%s" % (self.client.path, CHANNEL_NAMES[self.channel])
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return len(self._rxbuf)
+
+    def _feed(self, data):
+        with self._cond:
+            self._rxbuf += data
+            self._cond.notify_all()
+
+    def write(self, data):
+        self.client._send(OP_WRITE, self.channel, 0, bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while len(self._rxbuf) < size and not self.client.closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            data = bytes(self._rxbuf[:size])
+            del self._rxbuf[:size]
+            return data
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._rxbuf.clear()
+
+    def close(self):
+        self.client._send(OP_UNSUBSCRIBE, self.channel, 0)
+        self.client._asic.pop(self.channel, None)
+
+
+class BrokerClient:
+    """
+    Drop-in replacement for a control port: implements transact / request /
+    send like ControlTransport, so every bitcrane, TMP75 and APW_PSU function
+    accepts it as `ser`; APW_PSU.psu_transaction runs whole PSU exchanges on
+    the broker through psu_transaction(). asic(hashboard_num) gives an ASIC
+    port view.
+    """
+
+    def __init__(self, path=BROKER_SOCKET, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self.closed = False
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._pending = {}
+        self._asic = {}
+        self._next_tag = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, name="broker-rx", daemon=True)
+        self._reader.start()
+
+    @property
+    def port(self):
+        return "%s:ctrl" % self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._reader.join(timeout=1.0)
+
+    def _send(self, op, channel, tag, payload=b''):
+        with self._write_lock:
+            self._sock.sendall(_frame(op, channel, tag, payload))
+
+    def request(self, packet, op=OP_TRANSACT):
+        """Send a control packet; the Future resolves to the reply bytes."""
+        future = Future()
+        with self._lock:
+            while True:
+                tag = self._next_tag
+                self._next_tag = (tag + 1) & 0xFFFF
+                if tag not in self._pending:
+                    break
+            self._pending[tag] = future
+        future.id = tag
+        try:
+            self._send(op, CHANNEL_CTRL, tag, bytes(packet))
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(tag, None)
+            future.set_exception(e)
+        return future
+
+    def transact(self, packet, timeout=None):
+        """Send a control packet and block for its reply; None on timeout."""
+        future = self.request(packet)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except (FutureTimeoutError, TimeoutError, OSError, ConnectionError):
+            with self._lock:
+                self._pending.pop(future.id, None)
+            return None
+
+    def psu_transaction(self, packet, num_read_bytes, timeout=APW_PSU.PSU_RESPONSE_TIMEOUT):
+        """
+        Run a whole PSU exchange (APW_PSU.psu_transaction) on the broker.
+        Returns the response bytes, or None if none arrived in time.
+        """
+        payload = _PSU_REQUEST.pack(num_read_bytes, min(0xFFFF, int(timeout * 1000))) + bytes(packet)
+        future = self.request(payload, OP_PSU)
+        try:
+            # the exchange may first wait for other clients' PSU commands
+            return list(future.result(timeout + self.timeout))
+        except (FutureTimeoutError, TimeoutError, OSError, ConnectionError, serial.SerialException):
+            with self._lock:
+                self._pending.pop(future.id, None)
+            return None
+
+    def send(self, packet):
+        self._send(OP_SEND, CHANNEL_CTRL, 0, bytes(packet))
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def asic(self, hashboard_num, timeout=2.0):
+        channel = asic_channel(hashboard_num)
+        view = self._asic.get(channel)
+        if view is None:
+            view = self._asic[channel] = AsicChannel(self, channel, timeout)
+            self._send(OP_SUBSCRIBE, channel, 0)
+        return view
+
+    def _read_loop(self):
+        try:
+            while True:
+                op, channel, tag, payload = _recv_frame(self._sock)
+                if op == OP_DATA:
+                    view = self._asic.get(channel)
+                    if view is not None:
+                        view._feed(payload)
+                    continue
+                with self._lock:
+                    future = self._pending.pop(tag, None) if channel == CHANNEL_CTRL else None
+                if future is None:
+                    continue
+                if op == OP_REPLY:
+                    future.set_result(payload)
+                elif op == OP_TIMEOUT:
+                    future.set_exception(FutureTimeoutError())
+                else:
+                    future.set_exception(serial.SerialException(payload.decode(errors='replace')))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError("broker connection closed"))
+            for view in list(self._asic.values()):
+                with view._cond:
+                    view._cond.notify_all()
+
+
+def connect(path=BROKER_SOCKET, timeout=1.0):
+    return BrokerClient(path, timeout)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Share a Bitcrane's control and ASIC ports between local processes")
+    parser.add_argument('--socket', default=BROKER_SOCKET, help="Unix socket path (default %(default)s)")
+    parser.add_argument('--serial', help="USB serial number of the Bitcrane, if several are attached")
+    parser.add_argument('--ctrl', help="control port path (default: from the device registry)")
+    parser.add_argument('--no-asic', action='store_true', help="only broker the control port")
+    parser.add_argument('--sim', action='store_true', help="broker a bitcrane_sim instance")
+    args = parser.parse_args()
+
+    sim = None
+    if args.sim:
+        from bitcrane_sim import BitcraneSim
+        sim = BitcraneSim().start()
+        ctrl_path, asic_paths = sim.ctrl_port, sim.asic_ports
+    elif args.ctrl:
+        ctrl_path, asic_paths = args.ctrl, {}
+    else:
+        import registry
+        device = registry.find_device(args.serial)
+        ctrl_path, asic_paths = device.path(registry.ROLE_CTRL), device.asic_ports()
+    if args.no_asic:
+        asic_paths = {}
+
+    try:
+        ctrl = serial.Serial(port=ctrl_path, baudrate=115200)
+        asic_ports = {hashboard_num: serial.Serial(port=path, baudrate=115200) for hashboard_num, path in asic_paths.items()}
+    except serial.SerialException as e:
+        print(f"Error opening serial port: {e}")
+        exit(1)
+
+    server = BrokerServer(ctrl, asic_ports, args.socket).start()
+    print("brokering %s and %d ASIC port(s) on %s" % (ctrl_path, len(asic_ports), args.socket))
+    try:
+        while True:
+            time.sleep(10)
+            print("%d clients, %d requests, %d timeouts, %d errors, %d dropped" % (
+                len(server.connections), server.requests, server.timeouts, server.errors, server.dropped))
+    except KeyboardInterrupt:
+        print(" -> Stopping the broker.")
+    finally:
+        server.close()
+        if sim is not None:
+            sim.close()
@@ -0,0 +1,317 @@
+import argparse
+import mmap
+import struct
+import threading
+import time
+from collections import Counter
+
+import APW_PSU
+import bitcrane
+import bm13xx
+import metrics
+
+#binary capture and replay of control and ASIC serial traffic
+#
+# Capture file layout:
+#   header (4096 bytes)
+#     magic "BCAP", version, data capacity, head/tail offsets, bytes used,
+#     records written, records overwritten, then a table of port names
+#   data area: a ring of records
+#     u16 length | u8 flags | u8 port | f64 monotonic timestamp | payload
+#     flags bit 0 is the direction (0 = tx, 1 = rx), bits 1-2 the kind
+#
+# Records are packed straight into an mmap of the file, so capturing costs a
+# struct.pack_into and a slice copy per transaction. When the ring is full the
+# oldest records are overwritten. A record that doesn't fit before the end of
+# the data area is preceded by a wrap marker and written at the start.
+# Hooks fire on the reader threads and every caller's thread, so appends are
+# serialized by a lock.
+
+CAPTURE_MAGIC = b'BCAP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER_SIZE = 4096
+CAPTURE_DEFAULT_CAPACITY = 16 * 1024 * 1024
+
+_HEADER = struct.Struct('<4sHHQQQQQQ')         # magic, version, port count, capacity, head, tail, used, records, overwritten
+_RECORD = struct.Struct('<HBBd')                # length, flags, port, timestamp
+_PORT_TABLE_OFFSET = 128
+_PORT_NAME_LEN = 60
+_MAX_PORTS = (CAPTURE_HEADER_SIZE - _PORT_TABLE_OFFSET) // _PORT_NAME_LEN
+_WRAP = 0xFFFF
+
+DIR_TX = 0
+DIR_RX = 1
+KIND_CTRL = 0       # control-page packets and replies
+KIND_ASIC = 1       # raw ASIC port bytes
+KIND_PSU = 2        # APW PSU 0x55AA frames
+KIND_NAMES = {KIND_CTRL: 'ctrl', KIND_ASIC: 'asic', KIND_PSU: 'psu'}
+PORT_UNKNOWN = 0xFF
+
+
+class Capture:
+    """
+    mmap-backed ring file of timestamped serial traffic.
+
+    Args:
+        path: Capture file, created (or truncated) at the given capacity
+        capacity: Size of the record ring in bytes
+    """
+
+    def __init__(self, path, capacity=CAPTURE_DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.ports = {}
+        self.head = 0
+        self.tail = 0
+        self.used = 0
+        self.records = 0
+        self.overwritten = 0
+        self._lock = threading.Lock()
+        with open(path, 'wb') as f:
+            f.truncate(CAPTURE_HEADER_SIZE + capacity)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), CAPTURE_HEADER_SIZE + capacity)
+        self._write_header()
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._write_header()
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Record every transaction reported to metrics from now on."""
+        metrics.add_post_hook(self._hook)
+        return self
+
+    def stop(self):
+        metrics.remove_hook(self._hook)
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, CAPTURE_MAGIC, CAPTURE_VERSION, len(self.ports), self.capacity,
+                          self.head, self.tail, self.used, self.records, self.overwritten)
+
+    def _port_id(self, port):
+        if port is None:
+            return PORT_UNKNOWN
+        port_id = self.ports.get(port)
+        if port_id is None:
+            if len(self.ports) >= _MAX_PORTS:
+                return PORT_UNKNOWN
+            port_id = self.ports[port] = len(self.ports)
+            name = port.encode()[:_PORT_NAME_LEN]
+            offset = _PORT_TABLE_OFFSET + port_id * _PORT_NAME_LEN
+            self._map[offset:offset + _PORT_NAME_LEN] = name.ljust(_PORT_NAME_LEN, b'\x00')
+        return port_id
+
+    def _drop_oldest(self):
+        base = CAPTURE_HEADER_SIZE
+        length = struct.unpack_from('<H', self._map, base + self.tail)[0]
+        if length == _WRAP:
+            self.used -= self.capacity - self.tail
+            self.tail = 0
+            return
+        size = _RECORD.size + length
+        self.tail += size
+        self.used -= size
+        self.overwritten += 1
+        if self.tail + _RECORD.size > self.capacity:
+            self.used -= self.capacity - self.tail
+            self.tail = 0
+
+    def record(self, direction, kind, port, data, timestamp=None):
+        """Append one record. data longer than 64 KiB is truncated."""
+        data = bytes(data[:0xFFFE])
+        size = _RECORD.size + len(data)
+        if size > self.capacity // 2:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self._lock:
+            port_id = self._port_id(port)
+            base = CAPTURE_HEADER_SIZE
+            if self.head + size > self.capacity:
+                # no room before the end: mark the rest of the area as skipped
+                while self.used and self.tail >= self.head:
+                    self._drop_oldest()
+                if self.head + 2 <= self.capacity:
+                    struct.pack_into('<H', self._map, base + self.head, _WRAP)
+                self.used += self.capacity - self.head
+                self.head = 0
+            while self.used and self.capacity - self.used < size:
+                self._drop_oldest()
+            while self.used and self.head <= self.tail < self.head + size:
+                self._drop_oldest()
+            _RECORD.pack_into(self._map, base + self.head, len(data), (kind << 1) | direction, port_id, timestamp)
+            start = base + self.head + _RECORD.size
+            self._map[start:start + len(data)] = data
+            self.head += size
+            self.used += size
+            self.records += 1
+            if self.head + _RECORD.size > self.capacity:
+                self.used += self.capacity - self.head
+                self.head = 0
+            self._write_header()
+
+    def _hook(self, port, command, tx_data, rx_data, elapsed, status):
+        now = time.monotonic()
+        if command.startswith('psu_cmd'):
+            kind = KIND_PSU
+        elif command.startswith('asic'):
+            kind = KIND_ASIC
+        else:
+            kind = KIND_CTRL
+        if tx_data:
+            self.record(DIR_TX, kind, port, tx_data, now - elapsed)
+        if rx_data:
+            self.record(DIR_RX, kind, port, rx_data, now)
+
+
+def read_records(path):
+    """
+    Yield (timestamp, direction, kind, port, data) for every record in a
+    capture file, oldest first.
+    """
+    with open(path, 'rb') as f:
+        blob = f.read()
+    magic, version, port_count, capacity, head, tail, used, records, overwritten = _HEADER.unpack_from(blob, 0)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError("%s is not a capture file" % path)
+    ports = []
+    for port_id in range(port_count):
+        offset = _PORT_TABLE_OFFSET + port_id * _PORT_NAME_LEN
+        ports.append(blob[offset:offset + _PORT_NAME_LEN].rstrip(b'\x00').decode())
+    data = memoryview(blob)[CAPTURE_HEADER_SIZE:CAPTURE_HEADER_SIZE + capacity]
+    pos = tail
+    remaining = used
+    while remaining > 0:
+        if pos + _RECORD.size > capacity:
+            remaining -= capacity - pos
+            pos = 0
+            continue
+        length, flags, port_id, timestamp = _RECORD.unpack_from(data, pos)
+        if length == _WRAP:
+            remaining -= capacity - pos
+            pos = 0
+            continue
+        start = pos + _RECORD.size
+        port = ports[port_id] if port_id < len(ports) else None
+        yield timestamp, flags & 0x01, flags >> 1, port, bytes(data[start:start + length])
+        pos = start + length
+        remaining -= _RECORD.size + length
+
+
+class ReplayStats:
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+        self.ctrl_replies = Counter()
+        self.ctrl_unmatched = 0
+        self.psu_valid = 0
+        self.psu_invalid = 0
+        self.asic_responses = 0
+        self.asic_crc_errors = 0
+        self.values = Counter()
+
+
+def replay(path, speed=None, on_record=None):
+    """
+    Feed a capture back through the parsers: control replies are matched to
+    their request by ID and decoded, PSU frames go through check_response and
+    ASIC bytes through a bm13xx.ResponseFramer per port.
+
+    Args:
+        speed: None to replay as fast as possible, otherwise a multiple of
+               real time (10 = ten times faster than captured)
+        on_record: Optional callback(timestamp, direction, kind, port, data, parsed)
+
+    Returns:
+        (ReplayStats, seconds taken)
+    """
+    stats = ReplayStats()
+    requests = {}
+    framers = {}
+    first = None
+    start = time.perf_counter()
+    for timestamp, direction, kind, port, data in read_records(path):
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        stats.records += 1
+        stats.bytes += len(data)
+        parsed = None
+        if kind == KIND_CTRL:
+            if direction == DIR_TX:
+                if len(data) >= 6:
+                    requests[(port, data[2])] = data
+            elif len(data) >= 3:
+                request = requests.pop((port, data[2]), None)
+                if request is None:
+                    stats.ctrl_unmatched += 1
+                else:
+                    parsed = decode_ctrl_reply(request, data)
+                    stats.ctrl_replies[bitcrane.command_name(request)] += 1
+        elif kind == KIND_PSU:
+            if direction == DIR_RX:
+                if APW_PSU.check_response(data):
+                    stats.psu_valid += 1
+                    parsed = data[3:-2]
+                else:
+                    stats.psu_invalid += 1
+        elif kind == KIND_ASIC and direction == DIR_RX:
+            framer = framers.get(port)
+            if framer is None:
+                framer = framers[port] = bm13xx.ResponseFramer()
+            parsed = framer.feed(data, timestamp)
+            stats.asic_responses += len(parsed)
+        if parsed is not None:
+            stats.values[(KIND_NAMES[kind], port)] += 1
+        if on_record is not None:
+            on_record(timestamp, direction, kind, port, data, parsed)
+    stats.asic_crc_errors = sum(framer.crc_errors for framer in framers.values())
+    return stats, time.perf_counter() - start
+
+def decode_ctrl_reply(request, reply):
+    """Decode a control reply given the request it answers."""
+    page, cmd = request[4], request[5]
+    if page == bitcrane.PAGE_FAN and cmd & 0xF0 == 0x20 and len(reply) >= 5:
+        return (reply[4] << 8) | reply[3]               # fan RPM
+    if page == bitcrane.PAGE_I2C and cmd == bitcrane.I2C_COMMAND_READWRITE and len(request) >= 9:
+        return bytes(reply[-request[8]:])               # register bytes
+    return bytes(reply[3:])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dump or replay a Bitcrane serial capture")
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=None, help="replay at this multiple of real time (default: as fast as possible)")
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        first = None
+        for timestamp, direction, kind, port, data in read_records(args.path):
+            first = timestamp if first is None else first
+            print("%10.6f %s %-4s %-28s [%s]" % (timestamp - first, 'tx' if direction == DIR_TX else 'rx',
+                                                 KIND_NAMES.get(kind, '?'), port, bitcrane.prettyHex(data)))
+    else:
+        stats, elapsed = replay(args.path, args.speed)
+        print("%d records, %d bytes in %.3f s (%.0f records/s, %.2f MB/s)" % (
+            stats.records, stats.bytes, elapsed, stats.records / elapsed if elapsed else 0,
+            stats.bytes / elapsed / 1e6 if elapsed else 0))
+        for command, count in sorted(stats.ctrl_replies.items()):
+            print("  ctrl %-10s %d replies" % (command, count))
+        print("  ctrl unmatched replies: %d" % stats.ctrl_unmatched)
+        print("  psu frames: %d valid, %d invalid" % (stats.psu_valid, stats.psu_invalid))
+        print("  asic responses: %d, crc errors: %d" % (stats.asic_responses, stats.asic_crc_errors))
@@ -0,0 +1,270 @@
+import array
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+import asic_chains
+import bm13xx
+
+#per-chip response latency and health across repeated passes over a chain
+#
+# Each pass broadcasts a chip ID read to an addressed chain and timestamps
+# every reply against the moment the command was written. Results go into
+# flat arrays indexed by chip address (one slot per possible address), so
+# hundreds of passes over hundreds of boards stay a few KB per chain:
+# replies, missing passes, duplicate replies, CRC failures, latency sum /
+# min / max and the gap to the previous chip in the chain.
+#
+# A corrupted frame carries no trustworthy chip address. It is charged to
+# the chip(s) missing between the good replies on either side of it, or to
+# the next good reply when nothing is missing there.
+#
+# Timestamps come from the read that completed each frame, so chips whose
+# replies land in one USB chunk share one; averaging over passes smooths it.
+
+CHIP_SLOTS = 256                # chip addresses are one byte
+
+PROFILE_PASSES = 20
+PROFILE_TIMEOUT = 1.0           # seconds to wait for one pass
+PROFILE_IDLE_TIMEOUT = 0.25     # seconds of silence that end a pass; a chip slower than this counts as missing
+PROFILE_GAP = 0.01              # seconds between passes
+
+DEGRADED_MISSING = 0.05         # fraction of passes a chip may be absent from
+DEGRADED_SLOW_FACTOR = 3.0      # gap above this many times the chain's median gap...
+DEGRADED_SLOW_MIN = 0.002       # ...and above the median by at least this many seconds
+
+PROFILE_READ = bm13xx.read_register(bm13xx.REG_CHIP_ID)
+
+ChipHealth = namedtuple('ChipHealth', 'address position replies missing duplicates crc_errors latency_mean latency_max gap_mean reasons')
+ChipHealth.__doc__ = """
+Profile of one chip over all passes.
+    position: index in the chain (0 = first chip after the controller)
+    replies, missing, duplicates, crc_errors: counts over all passes
+    latency_mean, latency_max: seconds from the command write to the reply
+    gap_mean: mean seconds after the previous chip's reply in the same pass
+    reasons: list of 'missing', 'duplicate', 'crc' or 'slow'; empty when healthy
+"""
+
+
+class ChainProfile:
+    """
+    Accumulated per-chip statistics for one chain.
+
+    Args:
+        hashboard_num: Board the chain is on
+        addresses: Chip addresses in chain order, as assigned by
+                   asic_chains.enumerate_chain / bm13xx.address_chain
+    """
+
+    def __init__(self, hashboard_num, addresses):
+        self.hashboard_num = hashboard_num
+        self.addresses = list(addresses)
+        self.position = {address: index for index, address in enumerate(self.addresses)}
+        self.passes = 0
+        self.unexpected = 0         # replies from addresses not in the chain
+        self.replies = array.array('I', bytes(4 * CHIP_SLOTS))
+        self.missing = array.array('I', bytes(4 * CHIP_SLOTS))
+        self.duplicates = array.array('I', bytes(4 * CHIP_SLOTS))
+        self.crc_errors = array.array('I', bytes(4 * CHIP_SLOTS))
+        self.gaps = array.array('I', bytes(4 * CHIP_SLOTS))
+        self.latency_sum = array.array('d', bytes(8 * CHIP_SLOTS))
+        self.latency_min = array.array('d', [float('inf')]) * CHIP_SLOTS
+        self.latency_max = array.array('d', bytes(8 * CHIP_SLOTS))
+        self.gap_sum = array.array('d', bytes(8 * CHIP_SLOTS))
+        self.elapsed_max = 0.0
+
+    def record_pass(self, replies, start, trailing_corrupt=False):
+        """
+        Add one pass. replies is a list of (AsicResponse, corrupt_before)
+        in arrival order, corrupt_before being true when a corrupted frame
+        came between the previous good reply and this one; start is the
+        time.monotonic() of the command write and trailing_corrupt whether
+        one came after the last good reply.
+        """
+        self.passes += 1
+        seen = set()
+        previous = None         # (position, timestamp) of the last good reply
+        for response, corrupt in replies:
+            address = response.chip_addr
+            latency = response.timestamp - start
+            position = self.position.get(address)
+            if corrupt:
+                # blame the chips skipped since the last good reply, else this one
+                after = previous[0] + 1 if previous is not None else 0
+                skipped = [a for a in self.addresses[after:position] if a not in seen] if position is not None else []
+                for a in skipped or [address]:
+                    self.crc_errors[a] += 1
+            if position is None:
+                self.unexpected += 1
+                continue
+            if address in seen:
+                self.duplicates[address] += 1
+                continue
+            seen.add(address)
+            self.replies[address] += 1
+            self.latency_sum[address] += latency
+            self.latency_min[address] = min(self.latency_min[address], latency)
+            self.latency_max[address] = max(self.latency_max[address], latency)
+            if previous is not None and position == previous[0] + 1:
+                self.gap_sum[address] += response.timestamp - previous[1]
+                self.gaps[address] += 1
+            previous = (position, response.timestamp)
+            self.elapsed_max = max(self.elapsed_max, latency)
+        if trailing_corrupt:
+            after = previous[0] + 1 if previous is not None else 0
+            for a in self.addresses[after:]:
+                if a not in seen:
+                    self.crc_errors[a] += 1
+        for address in self.addresses:
+            if address not in seen:
+                self.missing[address] += 1
+
+    def chip(self, address):
+        """ChipHealth for one address, without the degraded reasons."""
+        replies = self.replies[address]
+        gaps = self.gaps[address]
+        return ChipHealth(address, self.position.get(address), replies, self.missing[address],
+                          self.duplicates[address], self.crc_errors[address],
+                          self.latency_sum[address] / replies if replies else None,
+                          self.latency_max[address] if replies else None,
+                          self.gap_sum[address] / gaps if gaps else None, [])
+
+    def median_gap(self):
+        gaps = sorted(self.gap_sum[a] / self.gaps[a] for a in self.addresses if self.gaps[a])
+        return gaps[len(gaps) // 2] if gaps else None
+
+    def health(self):
+        """ChipHealth for every chip in chain order, with reasons filled in."""
+        median = self.median_gap()
+        slow = None if median is None else max(median * DEGRADED_SLOW_FACTOR, median + DEGRADED_SLOW_MIN)
+        result = []
+        for address in self.addresses:
+            chip = self.chip(address)
+            if self.passes and chip.missing > DEGRADED_MISSING * self.passes:
+                chip.reasons.append('missing')
+            if chip.duplicates:
+                chip.reasons.append('duplicate')
+            if chip.crc_errors:
+                chip.reasons.append('crc')
+            if slow is not None and chip.gap_mean is not None and chip.gap_mean > slow:
+                chip.reasons.append('slow')
+            result.append(chip)
+        return result
+
+    def degraded(self):
+        return [chip for chip in self.health() if chip.reasons]
+
+    def print_report(self):
+        health = self.health()
+        answered = [chip for chip in health if chip.replies]
+        median = self.median_gap()
+        print("HB%d: %d chips, %d passes, last reply after %.1f ms max, median chip gap %s" % (
+            self.hashboard_num, len(self.addresses), self.passes, self.elapsed_max * 1000,
+            "%.3f ms" % (median * 1000) if median is not None else "-"))
+        if answered:
+            mean = sum(chip.latency_mean for chip in answered) / len(answered)
+            print("     mean latency %.2f ms, %d unexpected replies" % (mean * 1000, self.unexpected))
+        degraded = [chip for chip in health if chip.reasons]
+        if not degraded:
+            print("     no degraded chips")
+        for chip in degraded:
+            print("     chip %3d addr %02X: %-22s replies %d/%d dup %d crc %d latency %s gap %s" % (
+                chip.position, chip.address, ','.join(chip.reasons), chip.replies, self.passes, chip.duplicates,
+                chip.crc_errors,
+                "%.2f ms" % (chip.latency_mean * 1000) if chip.latency_mean is not None else "-",
+                "%.3f ms" % (chip.gap_mean * 1000) if chip.gap_mean is not None else "-"))
+
+
+def profile_pass(ser_asic, profile, timeout=PROFILE_TIMEOUT, idle_timeout=PROFILE_IDLE_TIMEOUT):
+    """
+    Run one broadcast read over an addressed chain and add it to profile.
+    The idle cutoff is fixed rather than learned, so a slow chip is reported
+    as slow instead of cutting the pass short.
+    """
+    framer = bm13xx.ResponseFramer()
+    corrupt_before = set()      # good-frame counts at which a bad frame turned up
+    framer.on_crc_error = corrupt_before.add
+    ser_asic.reset_input_buffer()
+    bm13xx.send(ser_asic, PROFILE_READ)
+    start = time.monotonic()
+    responses = list(bm13xx.read_responses(ser_asic, expected=len(profile.addresses), timeout=timeout,
+                                           idle_timeout=idle_timeout, framer=framer))
+    replies = [(response, index in corrupt_before) for index, response in enumerate(responses)]
+    profile.record_pass(replies, start, len(responses) in corrupt_before)
+    return len(replies)
+
+def profile_chain(ser_asic, hashboard_num, addresses, passes=PROFILE_PASSES, timeout=PROFILE_TIMEOUT, gap=PROFILE_GAP):
+    """Profile an already addressed chain over several passes. Returns a ChainProfile."""
+    profile = ChainProfile(hashboard_num, addresses)
+    for n in range(passes):
+        if n:
+            time.sleep(gap)
+        profile_pass(ser_asic, profile, timeout)
+    return profile
+
+def profile_chains(ser_ctrl, asic_ports, passes=PROFILE_PASSES, expected=bm13xx.S19JPRO_ASIC_COUNT, timeout=PROFILE_TIMEOUT):
+    """
+    Reset and enumerate every chain with asic_chains.enumerate_chains, then
+    profile each one concurrently. Each chain is re-addressed for `expected`
+    chips first, so a chip that missed the enumeration ping still gets its
+    own address and shows up as missing rather than shifting the rest.
+    Returns {hashboard_num: ChainProfile}; boards where no chip answered are
+    left out.
+    """
+    if not asic_ports:
+        return {}
+    inventories = asic_chains.enumerate_chains(ser_ctrl, asic_ports, expected)
+    addresses = bm13xx.chip_addresses(expected)
+
+    def worker(hashboard_num):
+        inventory = inventories[hashboard_num]
+        if inventory.error or not inventory.chip_count:
+            return None
+        ser = asic_ports[hashboard_num]
+        try:
+            bm13xx.send(ser, bm13xx.address_chain(expected))
+            return profile_chain(ser, hashboard_num, addresses, passes, timeout)
+        except (serial.SerialException, OSError):
+            return None
+
+    hashboards = sorted(asic_ports)
+    with ThreadPoolExecutor(max_workers=len(hashboards)) as pool:
+        profiles = dict(zip(hashboards, pool.map(worker, hashboards)))
+    return {hashboard_num: profile for hashboard_num, profile in profiles.items() if profile is not None}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Profile per-chip latency and health on the ASIC chains")
+    parser.add_argument('passes', nargs='?', type=int, default=PROFILE_PASSES)
+    parser.add_argument('--sim', action='store_true', help="run against the simulator with a few injected faults")
+    args = parser.parse_args()
+
+    sim = None
+    try:
+        if args.sim:
+            from bitcrane_sim import BitcraneSim
+            sim = BitcraneSim(chip_latency=0.0002).start()
+            sim.chains[0].set_fault(40, delay=0.005)
+            sim.chains[1].set_fault(77, miss_rate=0.3)
+            sim.chains[2].set_fault(100, corrupt_rate=0.2)
+            ctrl_path, asic_paths = sim.ctrl_port, sim.asic_ports
+        else:
+            ctrl_path, asic_paths = asic_chains.CTRL_PORT, asic_chains.ASIC_PORTS
+        serial_port_ctrl = serial.Serial(port=ctrl_path, baudrate=115200, timeout=1)
+        asic_ports = asic_chains.open_asic_ports(ports=asic_paths)
+    except serial.SerialException as e:
+        print(f"Error opening serial port: {e}")
+        exit(1)
+
+    try:
+        for hashboard_num, profile in sorted(profile_chains(serial_port_ctrl, asic_ports, args.passes).items()):
+            profile.print_report()
+    finally:
+        serial_port_ctrl.close()
+        for ser in asic_ports.values():
+            ser.close()
+        if sim is not None:
+            sim.close()
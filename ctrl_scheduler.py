@@ -0,0 +1,368 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import APW_PSU
+import bitcrane
+from ctrl_transport import ControlTransport
+
+#priority lanes on one control port, and a PSU watchdog feeder
+#
+# A ControlScheduler sits in front of a ControlTransport. Safety requests
+# (watchdog feeds, over-temperature reads, PSU disable) are written as soon
+# as they're made. Control and bulk requests wait in per-lane queues and are
+# admitted only while their lane has fewer than its cap in flight, control
+# before bulk. A safety request therefore never queues behind more than the
+# control and bulk caps, which gives its worst-case latency:
+#
+#   budget = (control cap + bulk cap + 1) x round-trip time
+#
+# A PSU command on the safety lane also needs the port's PSU lock. Normal
+# holders pause it between their bridge reads (and between single bytes of
+# per-byte reads), so it first waits out at most one step of whatever
+# exchange holds it, then makes its own requests and waits for the PSU to
+# answer (psu_latency_budget).
+#
+# Completions arrive on the transport's reader thread, which must never
+# block, so the requests they make room for are issued by a pump thread.
+#
+# lane(n) returns a view with transact/request/send, so any bitcrane, TMP75
+# or APW_PSU function can be pointed at a lane.
+
+LANE_SAFETY = 0
+LANE_CONTROL = 1
+LANE_BULK = 2
+LANE_NAMES = ('safety', 'control', 'bulk')
+
+RTT_ALPHA = 0.1             # weight of the newest sample in the round-trip average
+RTT_MAX_DECAY = 0.99        # per sample, so one old outlier doesn't set the budget forever
+
+
+class LaneStats:
+    __slots__ = ('requests', 'completed', 'timeouts', 'queued', 'in_flight', 'latency_max', 'over_budget')
+
+    def __init__(self):
+        self.requests = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.latency_max = 0.0
+        self.over_budget = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Item:
+    __slots__ = ('packet', 'future', 'lane', 'queued_at', 'inner')
+
+    def __init__(self, packet, lane):
+        self.packet = packet
+        self.future = Future() if packet is not None else None
+        if self.future is not None:
+            self.future.item = self
+        self.lane = lane
+        self.queued_at = time.monotonic()
+        self.inner = None
+
+
+class LaneView:
+    """A control port as seen by one lane; drop-in for `ser`."""
+
+    def __init__(self, scheduler, lane):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.urgent = lane == LANE_SAFETY     # APW_PSU lets urgent views go first for the PSU bridge
+        self.timeout = scheduler.timeout
+
+    @property
+    def port(self):
+        return self.scheduler.port
+
+    def request(self, packet):
+        return self.scheduler.request(packet, self.lane)
+
+    def transact(self, packet, timeout=None):
+        return self.scheduler.transact(packet, self.lane, timeout)
+
+    def send(self, packet):
+        self.scheduler.send(packet, self.lane)
+
+    def in_flight(self):
+        """Everything outstanding on the port, so low-priority users can back off."""
+        return self.scheduler.outstanding()
+
+
+class ControlScheduler:
+    """
+    Priority lanes over one control port.
+
+    Args:
+        ser: ControlTransport, or an open serial.Serial to wrap in one
+        control_in_flight: Most control-lane requests outstanding at once
+        bulk_in_flight: Most bulk-lane requests outstanding at once
+        timeout: Default transact() timeout
+
+    The transport needs more slots than control_in_flight + bulk_in_flight so
+    a safety request never waits for one.
+    """
+
+    def __init__(self, ser, control_in_flight=4, bulk_in_flight=1, timeout=1.0, debug=False):
+        self.transport = ser if hasattr(ser, 'request') else ControlTransport(ser, timeout=timeout, debug=debug)
+        self.caps = (None, control_in_flight, bulk_in_flight)
+        self.timeout = timeout
+        self.debug = debug
+        self.lanes = [LaneStats() for _ in LANE_NAMES]
+        self.rtt = None
+        self.rtt_max = 0.0
+        self._queues = [deque() for _ in LANE_NAMES]
+        self._lock = threading.Lock()
+        self._views = [LaneView(self, lane) for lane in range(len(LANE_NAMES))]
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._pump_thread = threading.Thread(target=self._pump_loop, name="ctrl_scheduler-pump", daemon=True)
+        self._pump_thread.start()
+
+    @property
+    def port(self):
+        return self.transport.port
+
+    def lane(self, lane):
+        return self._views[lane]
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._pump_thread.join(timeout=1.0)
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def outstanding(self):
+        with self._lock:
+            return sum(stats.queued + stats.in_flight for stats in self.lanes)
+
+    def latency_budget(self):
+        """
+        Worst-case seconds from a safety request to its reply: everything the
+        control and bulk lanes may have in flight, then the request itself,
+        each at the worst recent round-trip time.
+        """
+        rtt = max(self.rtt_max, self.rtt or 0.0)
+        return (self.caps[LANE_CONTROL] + self.caps[LANE_BULK] + 1) * rtt
+
+    def psu_latency_budget(self, command=APW_PSU.PSU_CMD_FEED_WDT, num_read_bytes=8):
+        """
+        Worst-case seconds for a PSU command (without arguments) on the safety
+        lane: the PSU lock holder's current step (APW_PSU.psu_step_requests,
+        a whole command frame on per-byte firmware), the command's own writes and reads, as many as this port's
+        bulk support needs (APW_PSU.psu_exchange_requests), each within
+        latency_budget(), plus the PSU's learned response time for the command.
+        """
+        packet_len = len(APW_PSU.make_packet([command]))
+        requests = APW_PSU.psu_step_requests(self) + APW_PSU.psu_exchange_requests(self, packet_len, num_read_bytes)
+        return requests * self.latency_budget() + APW_PSU.psu_latency.get(command, 0.0)
+
+    def request(self, packet, lane=LANE_CONTROL):
+        """Queue a packet on a lane. Returns a Future for the reply bytes."""
+        item = _Item(packet, lane)
+        with self._lock:
+            self.lanes[lane].requests += 1
+            self.lanes[lane].queued += 1
+            self._queues[lane].append(item)
+        self._pump()
+        return item.future
+
+    def send(self, packet, lane=LANE_CONTROL):
+        """Fire-and-forget packet, still in lane order."""
+        item = _Item(None, lane)
+        item.inner = packet
+        with self._lock:
+            self.lanes[lane].requests += 1
+            self.lanes[lane].queued += 1
+            self._queues[lane].append(item)
+        self._pump()
+
+    def transact(self, packet, lane=LANE_CONTROL, timeout=None):
+        future = self.request(packet, lane)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            self._cancel(future)
+            return None
+
+    def _admissible(self):
+        # caller holds self._lock; pop everything that may go out now, highest lane first
+        ready = []
+        for lane, queue in enumerate(self._queues):
+            cap = self.caps[lane]
+            stats = self.lanes[lane]
+            while queue and (cap is None or stats.in_flight < cap):
+                item = queue.popleft()
+                stats.queued -= 1
+                if item.future is not None:
+                    if item.future.cancelled():
+                        continue
+                    stats.in_flight += 1
+                ready.append(item)
+            if queue and lane < LANE_BULK:
+                break       # lower lanes wait while a higher one is still queued
+        return ready
+
+    def _pump(self):
+        with self._lock:
+            ready = self._admissible()
+        for item in ready:
+            if item.future is None:
+                self.transport.send(item.inner)
+                continue
+            item.inner = self.transport.request(item.packet)
+            item.inner.add_done_callback(lambda inner, item=item: self._done(item, inner))
+
+    def _done(self, item, inner):
+        now = time.monotonic()
+        with self._lock:
+            stats = self.lanes[item.lane]
+            stats.in_flight -= 1
+            if inner.cancelled() or inner.exception() is not None:
+                stats.timeouts += 1
+            else:
+                stats.completed += 1
+                latency = now - item.queued_at
+                stats.latency_max = max(stats.latency_max, latency)
+                if item.lane == LANE_SAFETY and latency > self.latency_budget() > 0:
+                    stats.over_budget += 1
+                self._sample_rtt(latency if item.lane == LANE_SAFETY else None)
+        if inner.cancelled():
+            item.future.cancel()
+        elif inner.exception() is not None:
+            if item.future.set_running_or_notify_cancel():
+                item.future.set_exception(inner.exception())
+        elif item.future.set_running_or_notify_cancel():
+            item.future.set_result(inner.result())
+        self._wake.set()        # on the reader thread: leave the (possibly blocking) requests to the pump
+
+    def _pump_loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self._pump()
+
+    def _sample_rtt(self, latency):
+        # caller holds self._lock. Safety requests go straight out, so their
+        # latency is the best available round-trip estimate.
+        if latency is None:
+            return
+        self.rtt = latency if self.rtt is None else self.rtt + RTT_ALPHA * (latency - self.rtt)
+        self.rtt_max = max(latency, self.rtt_max * RTT_MAX_DECAY)
+
+    def _cancel(self, future):
+        item = future.item
+        with self._lock:
+            queue = self._queues[item.lane]
+            if item in queue:
+                queue.remove(item)
+                self.lanes[item.lane].queued -= 1
+                self.lanes[item.lane].timeouts += 1
+                future.cancel()
+                return
+        # already on the wire: have the transport drop it, _done releases the slot
+        future.cancel()
+        if item.inner is not None:
+            self.transport.cancel(item.inner)
+
+    def stats(self):
+        with self._lock:
+            lanes = {name: self.lanes[lane].as_dict() for lane, name in enumerate(LANE_NAMES)}
+        return {'lanes': lanes, 'rtt': self.rtt, 'rtt_max': self.rtt_max, 'latency_budget': self.latency_budget(),
+                'psu_latency_budget': self.psu_latency_budget()}
+
+
+class PsuWatchdogFeeder:
+    """
+    Feed the APW PSU watchdog every `interval` seconds from its own thread.
+
+    Args:
+        ser: Control port to feed on, normally scheduler.lane(LANE_SAFETY)
+        interval: Seconds between feeds; keep it well inside the PSU's watchdog timeout
+        max_misses: Consecutive failed feeds before on_miss is called
+        on_miss: callback(feeder) when feeds keep failing, e.g. to cut the
+                 PSU with psu_disable before the watchdog does it uncleanly
+    """
+
+    def __init__(self, ser, interval=1.0, max_misses=3, on_miss=None, debug=False):
+        self.ser = ser
+        self.interval = interval
+        self.max_misses = max_misses
+        self.on_miss = on_miss
+        self.debug = debug
+        self.feeds = 0
+        self.misses = 0
+        self.consecutive_misses = 0
+        self.latency_max = 0.0
+        self.last_feed = None
+        self._packet = APW_PSU.make_packet([APW_PSU.PSU_CMD_FEED_WDT])
+        self._stop = threading.Event()
+        self._thread = None
+
+    def feed(self):
+        start = time.monotonic()
+        data = APW_PSU.psu_transaction(self.ser, self._packet, 8, self.debug, timeout=self.interval)
+        elapsed = time.monotonic() - start
+        if data is None:
+            self.misses += 1
+            self.consecutive_misses += 1
+            if self.consecutive_misses == self.max_misses and self.on_miss is not None:
+                self.on_miss(self)
+            return False
+        self.feeds += 1
+        self.consecutive_misses = 0
+        self.latency_max = max(self.latency_max, elapsed)
+        self.last_feed = start + elapsed
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="psu-wdt", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.feed()
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()
+            elif self._stop.wait(delay):
+                break
+
+    def stats(self):
+        return {'feeds': self.feeds, 'misses': self.misses, 'consecutive_misses': self.consecutive_misses,
+                'latency_max': self.latency_max}
+
+
+def psu_disable(ser, debug=False):
+    """Cut the PSU through GPIO_PSU_EN (active low). Use a safety lane."""
+    return bitcrane.gpio_set(ser, 0xAB, bitcrane.GPIO_PSU_EN, bitcrane.GPIO_HIGH, debug)
+
+def enable_watchdog(ser, value=0x01, debug=False):
+    """PSU_CMD_DISABLE_WDT with a non-zero value turns the watchdog on."""
+    return APW_PSU.psu_transaction(ser, APW_PSU.make_packet([APW_PSU.PSU_CMD_DISABLE_WDT, value, 0x00]), 8, debug)
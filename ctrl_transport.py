@@ -0,0 +1,175 @@
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import serial
+
+#pipelined transport for the Bitcrane control serial port
+#
+# Control-page packets look like [len_lo, len_hi, id, 0x00, page, command, ...]
+# and every reply starts with [len_lo, len_hi, id, ...] where len is the total
+# reply length. Instead of one blocking write/read round trip per command, the
+# transport stamps a rolling ID into byte 2 of each packet, writes it straight
+# away and lets a reader thread route replies back to the waiting Future by ID.
+
+CTRL_ID_UNTRACKED = 0x00    # ID used for fire-and-forget packets, replies are dropped
+CTRL_ID_FIRST = 0x01
+CTRL_ID_LAST = 0xFF
+
+CTRL_REPLY_HEADER_LEN = 3   # len_lo, len_hi, id
+CTRL_REPLY_MAX_LEN = 0x100
+
+
+class ControlTransport:
+    """
+    Owns the control serial port and keeps many control-page requests in flight.
+
+    Args:
+        ser: An open serial.Serial for the control port. The transport takes
+             ownership: it sets a short read timeout and closes it on close().
+        max_in_flight: Upper bound on outstanding requests (at most 255).
+        timeout: Default seconds to wait for a reply in transact().
+        debug: Print unmatched replies and resyncs.
+    """
+
+    def __init__(self, ser, max_in_flight=32, timeout=1.0, debug=False):
+        if not 1 <= max_in_flight <= CTRL_ID_LAST:
+            raise ValueError("max_in_flight must be 1-255")
+        self.ser = ser
+        self.timeout = timeout
+        self.debug = debug
+        self._pending = {}
+        self._next_id = CTRL_ID_FIRST
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._stop = threading.Event()
+        self._rxbuf = bytearray()
+        self.ser.timeout = 0.05
+        self._reader = threading.Thread(target=self._read_loop, name="ctrl-rx", daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def open(cls, port, baudrate=115200, **kwargs):
+        return cls(serial.Serial(port=port, baudrate=baudrate), **kwargs)
+
+    @property
+    def port(self):
+        return self.ser.port
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        self._reader.join(timeout=1.0)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(serial.SerialException("control transport closed"))
+        self.ser.close()
+
+    def _alloc_id(self):
+        # caller holds self._lock; skip IDs that are still waiting for a reply
+        while True:
+            id = self._next_id
+            self._next_id = CTRL_ID_FIRST if id == CTRL_ID_LAST else id + 1
+            if id not in self._pending:
+                return id
+
+    def request(self, packet):
+        """
+        Queue a control-page packet and return a Future for its reply.
+        Byte 2 of the packet is replaced with a freshly allocated request ID.
+        The Future resolves to the full reply bytes.
+        """
+        self._slots.acquire()
+        future = Future()
+        with self._lock:
+            id = self._alloc_id()
+            self._pending[id] = future
+        future.id = id
+        future.add_done_callback(lambda f: self._slots.release())
+        packet = bytearray(packet)
+        packet[2] = id
+        try:
+            with self._write_lock:
+                self.ser.write(packet)
+        except Exception as e:
+            self._forget(id, e)
+        return future
+
+    def transact(self, packet, timeout=None):
+        """
+        Send a packet and block for its reply.
+        Returns the reply bytes, or None if nothing arrived within the timeout.
+        """
+        future = self.request(packet)
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            self._forget(future.id, None)
+            return None
+
+    def cancel(self, future):
+        """Stop waiting for a request's reply: the Future is cancelled and its ID and slot freed."""
+        self._forget(future.id, None)
+
+    def send(self, packet):
+        """Write a packet whose reply nobody waits for (ID 0, reply dropped)."""
+        packet = bytearray(packet)
+        packet[2] = CTRL_ID_UNTRACKED
+        with self._write_lock:
+            self.ser.write(packet)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _forget(self, id, exc):
+        with self._lock:
+            future = self._pending.pop(id, None)
+        if future is not None and not future.done():
+            if exc is None:
+                future.cancel()
+            else:
+                future.set_exception(exc)
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            try:
+                chunk = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                if self._stop.is_set():
+                    return
+                time.sleep(0.01)
+                continue
+            if chunk:
+                self._rxbuf += chunk
+                self._dispatch()
+
+    def _dispatch(self):
+        buf = self._rxbuf
+        while len(buf) >= CTRL_REPLY_HEADER_LEN:
+            length = buf[0] | (buf[1] << 8)
+            if length < CTRL_REPLY_HEADER_LEN or length > CTRL_REPLY_MAX_LEN:
+                # not a reply header, slide forward one byte and try again
+                if self.debug:
+                    print("ctrl rx resync: dropping %02X" % buf[0])
+                del buf[0]
+                continue
+            if len(buf) < length:
+                return
+            reply = bytes(buf[:length])
+            del buf[:length]
+            with self._lock:
+                future = self._pending.pop(reply[2], None)
+            if future is None:
+                if self.debug:
+                    print("ctrl rx unmatched id %02X: [%s]" % (reply[2], ' '.join(f'{b:02X}' for b in reply)))
+                continue
+            if future.set_running_or_notify_cancel():
+                future.set_result(reply)
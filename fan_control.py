@@ -0,0 +1,268 @@
+import threading
+import time
+
+import TMP75
+import bitcrane
+
+#closed-loop fan control from the hashboard TMP75s
+#
+# A PID loop turns the hottest TMP75 reading into a fan duty. The duty is
+# quantized and only written when the quantized value actually changes, and
+# a hysteresis band keeps the output from chattering between two steps, so a
+# steady loop sends no PAGE_FAN writes at all. Tachs are checked for stalls
+# on an interval that starts short after every duty change and doubles while
+# the fans stay where they were told to be.
+
+FAN_DEFAULT_SETPOINT = 65.0     # degrees C at the hottest sensor
+FAN_MIN_DUTY = 20               # percent; below this the fans may not spin
+FAN_MAX_DUTY = 100
+FAN_DUTY_STEP = 5               # quantization of the written duty
+FAN_DUTY_HYSTERESIS = 2.0       # extra percent the PID output must move past a step boundary
+FAN_STALL_RPM = 500             # a running fan below this is stalled
+FAN_SPINUP_TIME = 3.0           # seconds after a duty change before tach is trusted
+FAN_TACH_MIN_INTERVAL = 1.0
+FAN_TACH_MAX_INTERVAL = 30.0
+
+
+class PID:
+    """
+    PID controller with output clamping and conditional integration (the
+    integral only accumulates while the output isn't saturated).
+
+    The output rises with the measurement: error is measurement - setpoint,
+    as a fan should speed up when the board gets hotter.
+    """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, setpoint=FAN_DEFAULT_SETPOINT, out_min=FAN_MIN_DUTY, out_max=FAN_MAX_DUTY, bias=None):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.setpoint = setpoint
+        self.out_min = out_min
+        self.out_max = out_max
+        self.bias = out_min if bias is None else bias
+        self.integral = 0.0
+        self.last_error = None
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def update(self, measurement, dt):
+        error = measurement - self.setpoint
+        derivative = 0.0
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+
+        unclamped = self.bias + self.kp * error + self.ki * (self.integral + error * dt) + self.kd * derivative
+        output = min(self.out_max, max(self.out_min, unclamped))
+        if output == unclamped or (unclamped > self.out_max) != (error > 0):
+            self.integral += error * dt
+        return output
+
+
+def quantize_duty(raw, current, step=FAN_DUTY_STEP, hysteresis=FAN_DUTY_HYSTERESIS, duty_min=FAN_MIN_DUTY, duty_max=FAN_MAX_DUTY):
+    """
+    Quantize a PID output to the duty step, holding the current duty until
+    the raw output moves more than half a step plus the hysteresis away.
+    """
+    if current is not None and abs(raw - current) <= step / 2.0 + hysteresis:
+        return current
+    duty = int(round(raw / step)) * step
+    return min(duty_max, max(duty_min, duty))
+
+
+class FanController:
+    """
+    Drive FAN1-FAN4 from the hottest TMP75.
+
+    Args:
+        ser: Control port (serial.Serial or ControlTransport)
+        fans: Fan numbers to drive, all with the same duty
+        sensors: TMP75.TMP75Sensor list (default: both sensors on all three boards)
+        pid: PID instance (default: PI tuned for a few seconds of loop period)
+        period: Control loop period in seconds
+        on_stall: Optional callback(fan_num, rpm) when a fan is found stalled
+        temperature_source: Optional callable returning the hottest temperature
+                            (or None) in place of reading sensors, e.g. the
+                            hottest() of a ThermalAlertMonitor on the same sensors
+
+    If no sensor answers, or a fan stalls, the fans go to FAN_MAX_DUTY until
+    the condition clears.
+    """
+
+    def __init__(self, ser, fans=(1, 2, 3, 4), sensors=None, pid=None, period=1.0, on_stall=None, temperature_source=None, debug=False):
+        self.ser = ser
+        self.fans = tuple(fans)
+        self.temperature_source = temperature_source
+        if sensors is None:
+            sensors = [] if temperature_source is not None else TMP75.board_sensors(ser, debug=debug)
+        self.sensors = sensors
+        self.pid = pid if pid is not None else PID(kp=4.0, ki=0.2)
+        self.period = period
+        self.on_stall = on_stall
+        self.debug = debug
+
+        self.duty = {fan_num: None for fan_num in self.fans}    # last duty written (None = unknown)
+        self.rpm = {fan_num: None for fan_num in self.fans}
+        self.stalled = set()
+        self.temperature = None
+        self.output = None
+        self.writes = 0
+        self.writes_skipped = 0
+        self.tach_reads = 0
+        self.steps = 0
+
+        self.tach_interval = FAN_TACH_MIN_INTERVAL
+        self._next_tach = 0.0
+        self._changed_at = 0.0
+        self._last_step = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def read_temperature(self):
+        """Hottest reading across the sensors, or None if none answered."""
+        if self.temperature_source is not None:
+            return self.temperature_source()
+        temps = [t for t in (sensor.read_temperature() for sensor in self.sensors) if t is not None]
+        return max(temps) if temps else None
+
+    def set_duty(self, duty):
+        """Write duty to every fan whose last written duty differs. Returns the number of writes."""
+        writes = 0
+        for fan_num in self.fans:
+            if self.duty[fan_num] == duty:
+                self.writes_skipped += 1
+                continue
+            if bitcrane.fan_set_speed(self.ser, 0xAB, fan_num, duty, self.debug) is None:
+                self.duty[fan_num] = None       # unknown, retry on the next step
+                continue
+            self.duty[fan_num] = duty
+            writes += 1
+        if writes:
+            self.writes += writes
+            self._changed_at = time.monotonic()
+            self.tach_interval = FAN_TACH_MIN_INTERVAL
+            self._next_tach = self._changed_at + FAN_SPINUP_TIME
+        return writes
+
+    def check_tach(self, now):
+        """Read every fan's tach and update the stall set. Returns True if all fans are running."""
+        healthy = True
+        for fan_num in self.fans:
+            rpm = bitcrane.get_fan_rpm(self.ser, 0xAB, fan_num, self.debug)
+            self.tach_reads += 1
+            self.rpm[fan_num] = rpm
+            duty = self.duty[fan_num]
+            if duty and (rpm is None or rpm < FAN_STALL_RPM):
+                healthy = False
+                if fan_num not in self.stalled:
+                    self.stalled.add(fan_num)
+                    if self.on_stall is not None:
+                        self.on_stall(fan_num, rpm)
+            else:
+                self.stalled.discard(fan_num)
+        # stable fans get checked less and less often, trouble resets the interval
+        if healthy:
+            self.tach_interval = min(FAN_TACH_MAX_INTERVAL, self.tach_interval * 2)
+        else:
+            self.tach_interval = FAN_TACH_MIN_INTERVAL
+        self._next_tach = now + self.tach_interval
+        return healthy
+
+    def step(self):
+        """Run one control iteration. Returns the duty in effect afterwards."""
+        now = time.monotonic()
+        dt = self.period if self._last_step is None else now - self._last_step
+        self._last_step = now
+        self.steps += 1
+
+        self.temperature = self.read_temperature()
+        if self.temperature is None or self.stalled:
+            duty = FAN_MAX_DUTY     # fail safe: no temperature or a stalled fan
+            self.pid.reset()
+        else:
+            self.output = self.pid.update(self.temperature, dt)
+            current = self.duty[self.fans[0]] if self.fans else None
+            duty = quantize_duty(self.output, current, duty_min=self.pid.out_min, duty_max=self.pid.out_max)
+        self.set_duty(duty)
+
+        if now >= self._next_tach:
+            self.check_tach(now)
+
+        if self.debug:
+            print("temp %s  pid %s  duty %d  rpm %s" % (self.temperature, self.output, duty, self.rpm))
+        return duty
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="fan_control", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.step()
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()     # overran, don't try to catch up
+            elif self._stop.wait(delay):
+                break
+
+    def stats(self):
+        return {
+            'steps': self.steps,
+            'writes': self.writes,
+            'writes_skipped': self.writes_skipped,
+            'tach_reads': self.tach_reads,
+            'tach_interval': self.tach_interval,
+            'stalled': sorted(self.stalled),
+        }
+
+
+if __name__ == '__main__':
+    import sys
+    import serial
+
+    #usage: python fan_control.py [setpoint_c] [period_s]
+    setpoint = float(sys.argv[1]) if len(sys.argv) > 1 else FAN_DEFAULT_SETPOINT
+    period = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    try:
+        serial_port_ctrl = serial.Serial(
+            port='/dev/tty.usbmodemb310cc521',  # Update this to your serial port
+            baudrate=115200,
+            timeout=1
+        )
+    except serial.SerialException as e:
+        print(f"Error opening Control serial port: {e}")
+        exit(1)
+
+    def stall(fan_num, rpm):
+        print("FAN%d stalled (rpm %s)" % (fan_num, rpm))
+
+    controller = FanController(serial_port_ctrl, pid=PID(kp=4.0, ki=0.2, setpoint=setpoint), period=period, on_stall=stall)
+    try:
+        while True:
+            duty = controller.step()
+            print("hottest %s C  duty %d%%  rpm %s" % (controller.temperature, duty,
+                                                       ' '.join(str(controller.rpm[f]) for f in controller.fans)))
+            time.sleep(period)
+    except KeyboardInterrupt:
+        print(" -> Stopping the script.")
+    finally:
+        stats = controller.stats()
+        print("%d steps, %d fan writes, %d skipped, %d tach reads" % (
+            stats['steps'], stats['writes'], stats['writes_skipped'], stats['tach_reads']))
+        serial_port_ctrl.close()
@@ -0,0 +1,263 @@
+import array
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+import TMP75
+import bitcrane
+import bm13xx
+import registry
+import telemetry
+from ctrl_transport import ControlTransport
+
+#drive many Bitcranes from one host
+#
+# A Fleet holds one Session per board (a pipelined control transport plus
+# lazily opened ASIC ports) and runs bulk operations across them on a bounded
+# thread pool. Each operation returns a ResultTable: one row per board and one
+# array('d') column per value, NaN where a board didn't answer, so a rack
+# sweep costs about as long as the slowest board rather than the sum.
+
+NAN = float('nan')
+
+
+class Session:
+    """
+    One board's ports.
+
+    Args:
+        name: Label for the board (the USB serial number for registry devices)
+        ctrl_path: Control port path
+        asic_paths: {hashboard_num: ASIC port path}
+    """
+
+    def __init__(self, name, ctrl_path, asic_paths=None, timeout=1.0):
+        self.name = name
+        self.ctrl_path = ctrl_path
+        self.asic_paths = dict(asic_paths or {})
+        self.timeout = timeout
+        self.ctrl = ControlTransport(serial.Serial(port=ctrl_path, baudrate=115200), timeout=timeout)
+        self.asic = {}
+
+    @classmethod
+    def from_device(cls, device, **kwargs):
+        return cls(device.serial_number, device.path(registry.ROLE_CTRL), device.asic_ports(), **kwargs)
+
+    def asic_port(self, hashboard_num):
+        ser = self.asic.get(hashboard_num)
+        if ser is None:
+            ser = self.asic[hashboard_num] = serial.Serial(port=self.asic_paths[hashboard_num], baudrate=115200, timeout=2)
+        return ser
+
+    def close(self):
+        self.ctrl.close()
+        for ser in self.asic.values():
+            ser.close()
+        self.asic = {}
+
+
+class ResultTable:
+    """
+    Column-oriented results of a bulk operation: rows are boards, columns are
+    array('d') with NaN for missing values. errors maps a board name to the
+    exception text when the whole operation failed on that board.
+    """
+
+    def __init__(self, names, columns):
+        self.names = list(names)
+        self.columns = {column: array.array('d', [NAN]) * len(self.names) for column in columns}
+        self.errors = {}
+        self.elapsed = 0.0
+
+    def set_row(self, index, values):
+        for column, value in values.items():
+            if value is not None:
+                self.columns[column][index] = value
+
+    def column(self, name):
+        return self.columns[name]
+
+    def row(self, name):
+        index = self.names.index(name)
+        return {column: values[index] for column, values in self.columns.items()}
+
+    def summary(self):
+        """{column: (count, min, mean, max)} over the values that are present."""
+        result = {}
+        for column, values in self.columns.items():
+            present = [v for v in values if not math.isnan(v)]
+            if present:
+                result[column] = (len(present), min(present), sum(present) / len(present), max(present))
+            else:
+                result[column] = (0, NAN, NAN, NAN)
+        return result
+
+    def print(self):
+        columns = list(self.columns)
+        print("%-16s " % 'board' + ' '.join("%10s" % column for column in columns))
+        for index, name in enumerate(self.names):
+            if name in self.errors:
+                print("%-16s error: %s" % (name, self.errors[name]))
+                continue
+            print("%-16s " % name + ' '.join("%10.2f" % self.columns[column][index] for column in columns))
+        print("%d boards in %.1f ms" % (len(self.names), self.elapsed * 1000))
+
+
+# per-board operations: take a Session, return {column: value}
+
+def read_temperatures(session, hashboards=(0, 1, 2)):
+    return {"hb%d_t%d" % (hashboard_num, chipnum): TMP75.read_temperature(session.ctrl, chipnum, hashboard_num)
+            for hashboard_num in hashboards for chipnum in (0, 1)}
+
+def read_fan_rpms(session, fans=(1, 2, 3, 4)):
+    return {"fan%d" % fan_num: bitcrane.get_fan_rpm(session.ctrl, 0xAB, fan_num) for fan_num in fans}
+
+def set_fans(session, speed_percent, fans=(1, 2, 3, 4)):
+    return {"fan%d" % fan_num: 1.0 if bitcrane.fan_set_speed(session.ctrl, 0xAB, fan_num, speed_percent) is not None else 0.0
+            for fan_num in fans}
+
+def psu_measure_voltage(session):
+    return {'psu_v': telemetry.read_psu_measured_voltage(session.ctrl)}
+
+def ping_chains(session, expected=bm13xx.S19JPRO_ASIC_COUNT, timeout=2.0):
+    """Chips answering a chip ID read on each hashboard's chain."""
+    result = {}
+    for hashboard_num in sorted(session.asic_paths):
+        ser = session.asic_port(hashboard_num)
+        ser.reset_input_buffer()
+        bm13xx.send(ser, bm13xx.ping())
+        result["hb%d_chips" % hashboard_num] = sum(1 for _ in bm13xx.read_responses(ser, expected=expected, timeout=timeout))
+    return result
+
+OPERATION_COLUMNS = {
+    read_temperatures: ["hb%d_t%d" % (h, c) for h in (0, 1, 2) for c in (0, 1)],
+    read_fan_rpms: ["fan%d" % f for f in (1, 2, 3, 4)],
+    set_fans: ["fan%d" % f for f in (1, 2, 3, 4)],
+    psu_measure_voltage: ['psu_v'],
+    ping_chains: ["hb%d_chips" % h for h in (0, 1, 2)],
+}
+
+
+class Fleet:
+    """
+    Bulk operations across many boards with at most max_workers running at once.
+    Sessions are opened by the caller or with from_registry().
+    """
+
+    def __init__(self, sessions, max_workers=16):
+        self.sessions = list(sessions)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.sessions))), thread_name_prefix="fleet")
+
+    @classmethod
+    def from_registry(cls, serial_numbers=None, refresh=False, **kwargs):
+        """Open a session on every attached Bitcrane (or the listed ones)."""
+        devices = registry.registry.discover(refresh)
+        if serial_numbers is not None:
+            devices = {sn: registry.find_device(sn) for sn in serial_numbers}
+        sessions = []
+        try:
+            for serial_number in sorted(devices):
+                sessions.append(Session.from_device(devices[serial_number]))
+        except serial.SerialException:
+            for session in sessions:
+                session.close()
+            raise
+        return cls(sessions, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+        for session in self.sessions:
+            session.close()
+
+    def run(self, operation, *args, columns=None, **kwargs):
+        """
+        Run operation(session, *args, **kwargs) on every board. Returns a
+        ResultTable with the given columns (default: OPERATION_COLUMNS for the
+        built-in operations, otherwise whatever the first board returned).
+        """
+        start = time.perf_counter()
+
+        def call(session):
+            try:
+                return operation(session, *args, **kwargs), None
+            except (serial.SerialException, OSError, ValueError, KeyError) as e:
+                return None, str(e)
+
+        results = list(self.pool.map(call, self.sessions))
+        if columns is None:
+            columns = OPERATION_COLUMNS.get(operation)
+        if columns is None:
+            columns = []
+            for values, _ in results:
+                for column in values or ():
+                    if column not in columns:
+                        columns.append(column)
+        table = ResultTable([session.name for session in self.sessions], columns)
+        for index, (session, (values, error)) in enumerate(zip(self.sessions, results)):
+            if error is not None:
+                table.errors[session.name] = error
+            else:
+                table.set_row(index, {k: v for k, v in values.items() if k in table.columns})
+        table.elapsed = time.perf_counter() - start
+        return table
+
+    def read_temperatures(self):
+        return self.run(read_temperatures)
+
+    def read_fan_rpms(self):
+        return self.run(read_fan_rpms)
+
+    def set_fans(self, speed_percent):
+        return self.run(set_fans, speed_percent)
+
+    def psu_measure_voltage(self):
+        return self.run(psu_measure_voltage)
+
+    def ping_chains(self):
+        return self.run(ping_chains)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run one operation across every attached Bitcrane")
+    parser.add_argument('operation', choices=['temps', 'rpm', 'fans', 'psu', 'ping'])
+    parser.add_argument('speed', nargs='?', type=int, default=50, help="fan speed for 'fans'")
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--sim', type=int, default=0, help="run against this many simulated boards")
+    args = parser.parse_args()
+
+    sims = []
+    try:
+        if args.sim:
+            from bitcrane_sim import BitcraneSim
+            sims = [BitcraneSim().start() for _ in range(args.sim)]
+            fleet = Fleet([Session("sim%d" % i, sim.ctrl_port, sim.asic_ports) for i, sim in enumerate(sims)], args.workers)
+        else:
+            fleet = Fleet.from_registry(max_workers=args.workers)
+    except (serial.SerialException, LookupError) as e:
+        print(f"Error: {e}")
+        exit(1)
+
+    with fleet:
+        if args.operation == 'temps':
+            table = fleet.read_temperatures()
+        elif args.operation == 'rpm':
+            table = fleet.read_fan_rpms()
+        elif args.operation == 'fans':
+            table = fleet.set_fans(args.speed)
+        elif args.operation == 'psu':
+            table = fleet.psu_measure_voltage()
+        else:
+            table = fleet.ping_chains()
+        table.print()
+    for sim in sims:
+        sim.close()
@@ -0,0 +1,203 @@
+import math
+import threading
+import time
+
+import bitcrane
+
+#background LED animation engine for the Bitcrane RGB LED
+#
+# Frames are scheduled from the monotonic clock (each deadline is one frame
+# after the previous deadline, missed frames are dropped rather than caught
+# up), colors come from precomputed integer lookup tables, and a frame is only
+# written when its RGB differs from the last one sent. The LED is the lowest
+# priority user of the control port: if the port is busy the frame is held
+# and the next frame replaces it, so at most one LED write is ever pending.
+
+HUE_STEPS = 1536        # 6 segments x 256 levels, one step per LSB of color
+WAVE_STEPS = 256
+
+
+def _build_hue_table():
+    table = []
+    for step in range(HUE_STEPS):
+        segment, level = divmod(step, 256)
+        fall = 255 - level
+        table.append((
+            (255, fall, 0, 0, level, 255)[segment],
+            (level, 255, 255, fall, 0, 0)[segment],
+            (0, 0, level, 255, 255, fall)[segment],
+        ))
+    return tuple(table)
+
+def _build_wave_table():
+    # raised cosine 0..255..0 over one period, for breathing
+    return bytes(int(round(127.5 - 127.5 * math.cos(2 * math.pi * i / WAVE_STEPS))) for i in range(WAVE_STEPS))
+
+HUE_TABLE = _build_hue_table()      # full saturation and value, hue 0..360 in HUE_STEPS
+WAVE_TABLE = _build_wave_table()
+
+def scale(rgb, level):
+    """Scale an RGB tuple by level 0-255."""
+    return ((rgb[0] * level) >> 8, (rgb[1] * level) >> 8, (rgb[2] * level) >> 8)
+
+
+# patterns: callables taking seconds since the pattern started, returning (r, g, b)
+
+def solid(rgb):
+    rgb = tuple(rgb)
+    return lambda t: rgb
+
+def rainbow(period=10.0, brightness=255):
+    steps_per_second = HUE_STEPS / period
+    if brightness >= 255:
+        return lambda t: HUE_TABLE[int(t * steps_per_second) % HUE_STEPS]
+    return lambda t: scale(HUE_TABLE[int(t * steps_per_second) % HUE_STEPS], brightness)
+
+def breathe(rgb, period=2.0):
+    rgb = tuple(rgb)
+    steps_per_second = WAVE_STEPS / period
+    return lambda t: scale(rgb, WAVE_TABLE[int(t * steps_per_second) % WAVE_STEPS])
+
+def blink(rgb, period=1.0, duty=0.5):
+    rgb = tuple(rgb)
+    return lambda t: rgb if (t % period) < period * duty else (0, 0, 0)
+
+
+# board state -> pattern for status mode
+STATUS_PATTERNS = {
+    'off': solid((0, 0, 0)),
+    'idle': solid((32, 32, 32)),
+    'starting': breathe((0, 0, 255), 2.0),
+    'mining': solid((0, 255, 0)),
+    'warning': breathe((255, 160, 0), 1.0),
+    'overheat': blink((255, 64, 0), 0.5),
+    'fault': blink((255, 0, 0), 1.0),
+}
+
+
+class LedEngine:
+    """
+    Run an LED pattern on a background thread.
+
+    Args:
+        ser: Control port (serial.Serial or ControlTransport)
+        fps: Frame rate of the pattern
+        lock: Optional lock shared with other users of a plain serial port.
+              A frame is only written if the lock can be taken without waiting.
+        busy_in_flight: With a ControlTransport, hold frames while at least this
+              many requests are in flight
+    """
+
+    def __init__(self, ser, fps=20.0, lock=None, busy_in_flight=1, debug=False):
+        self.ser = ser
+        self.interval = 1.0 / fps
+        self.lock = lock
+        self.busy_in_flight = busy_in_flight
+        self.debug = debug
+        self.pattern = STATUS_PATTERNS['off']
+        self.status = None
+        self.last_sent = None
+        self.pending = None
+        self.frames = 0
+        self.writes = 0
+        self.unchanged = 0
+        self.coalesced = 0
+        self.dropped_frames = 0
+        self.errors = 0
+        self._pattern_start = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_pattern(self, pattern):
+        self.pattern = pattern
+        self.status = None
+        self._pattern_start = time.monotonic()
+
+    def set_status(self, status):
+        """Show a board state from STATUS_PATTERNS. Setting the same state again keeps its phase."""
+        if status == self.status:
+            return
+        self.pattern = STATUS_PATTERNS[status]
+        self.status = status
+        self._pattern_start = time.monotonic()
+
+    def _busy(self):
+        if hasattr(self.ser, 'in_flight'):
+            return self.ser.in_flight() >= self.busy_in_flight
+        return False
+
+    def _write(self, rgb):
+        if hasattr(self.ser, 'transact'):
+            # don't hold a request slot for the ack
+            bitcrane.led_set_color(self.ser, 0x00, rgb[0], rgb[1], rgb[2], self.debug, wait=False)
+            return True
+        if self.lock is not None and not self.lock.acquire(blocking=False):
+            return False
+        try:
+            return bitcrane.led_set_color(self.ser, 0xAB, rgb[0], rgb[1], rgb[2], self.debug) is not None
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def frame(self, now=None):
+        """Compute one frame and write it if it changed and the port is free. Returns True if written."""
+        if now is None:
+            now = time.monotonic()
+        self.frames += 1
+        rgb = self.pattern(now - self._pattern_start)
+        if rgb == self.last_sent:
+            self.unchanged += 1
+            self.pending = None
+            return False
+        if self.pending is not None:
+            self.coalesced += 1         # the held frame is replaced by this one
+        self.pending = rgb
+        if self._busy():
+            return False
+        try:
+            written = self._write(rgb)
+        except Exception:
+            self.errors += 1
+            return False
+        if not written:
+            return False
+        self.last_sent = rgb
+        self.pending = None
+        self.writes += 1
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="led", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.frame(deadline)
+            deadline += self.interval
+            now = time.monotonic()
+            if now > deadline:
+                missed = int((now - deadline) / self.interval) + 1
+                self.dropped_frames += missed
+                deadline += missed * self.interval
+            self._stop.wait(deadline - now)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'writes': self.writes,
+            'unchanged': self.unchanged,
+            'coalesced': self.coalesced,
+            'dropped_frames': self.dropped_frames,
+            'errors': self.errors,
+        }
@@ -0,0 +1,270 @@
+import array
+import bisect
+import json
+import os
+import threading
+import time
+
+#hot-path metrics and hooks for serial transactions
+#
+# bitcrane.ctrl_transaction / ctrl_send, asic_write / asic_read and the ASIC
+# response reader report every transaction here: per-command call counts,
+# latency histograms, bytes tx/rx, timeouts, short reads and ID mismatches.
+# Pre/post hooks see every transaction as it happens (capture, tracing, ...).
+# Counters can be exported as a Prometheus textfile or a JSON snapshot.
+#
+# Transaction status values passed to the post hooks:
+STATUS_OK = 'ok'
+STATUS_TIMEOUT = 'timeout'          # nothing came back
+STATUS_SHORT = 'short_read'         # fewer bytes than expected
+STATUS_ID_MISMATCH = 'id_mismatch'  # reply belongs to another request
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+# adaptive timeouts: a multiple of the recent round-trip percentile per command
+RTT_WINDOW = 128            # most recent samples kept per command
+RTT_MIN_SAMPLES = 16        # fewer than this and the caller's default timeout is used
+RTT_PERCENTILE = 0.99
+RTT_MULTIPLIER = 3.0
+RTT_TIMEOUT_MIN = 0.02      # seconds
+RTT_REFRESH = 16            # samples between percentile recomputes
+
+
+class CommandStats:
+    __slots__ = ('calls', 'timeouts', 'short_reads', 'id_mismatches', 'bytes_tx', 'bytes_rx',
+                 'latency_sum', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = 0
+        self.short_reads = 0
+        self.id_mismatches = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)   # last one is +Inf
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'timeouts': self.timeouts,
+            'short_reads': self.short_reads,
+            'id_mismatches': self.id_mismatches,
+            'bytes_tx': self.bytes_tx,
+            'bytes_rx': self.bytes_rx,
+            'latency_sum': self.latency_sum,
+            'latency_buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.buckets)),
+        }
+
+
+class Metrics:
+    """
+    Per-command transaction counters plus pre/post hooks.
+
+    Hooks:
+        pre(port, command, tx_data)
+        post(port, command, tx_data, rx_data, elapsed, status)
+    port is the serial port name (or None), command a short label such as
+    "fan_21" or "asic_write", and elapsed is in seconds.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.commands = {}
+        self.pre_hooks = []
+        self.post_hooks = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def begin(self, port, command, tx_data):
+        for hook in self.pre_hooks:
+            hook(port, command, tx_data)
+        return time.perf_counter()
+
+    def end(self, port, command, tx_data, rx_data, start, status=STATUS_OK):
+        elapsed = time.perf_counter() - start
+        if self.enabled:
+            with self._lock:
+                stats = self.commands.get(command)
+                if stats is None:
+                    stats = self.commands[command] = CommandStats()
+                stats.calls += 1
+                stats.bytes_tx += len(tx_data) if tx_data else 0
+                stats.bytes_rx += len(rx_data) if rx_data else 0
+                stats.latency_sum += elapsed
+                stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+                if status == STATUS_TIMEOUT:
+                    stats.timeouts += 1
+                elif status == STATUS_SHORT:
+                    stats.short_reads += 1
+                elif status == STATUS_ID_MISMATCH:
+                    stats.id_mismatches += 1
+        for hook in self.post_hooks:
+            hook(port, command, tx_data, rx_data, elapsed, status)
+        return elapsed
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            commands = {name: stats.as_dict() for name, stats in sorted(self.commands.items())}
+        return {'started': self.started, 'time': time.time(), 'commands': commands}
+
+    def prometheus_text(self, prefix='bitcrane', labels=None):
+        """Render the counters in the Prometheus text exposition format."""
+        extra = ''.join(',%s="%s"' % (k, v) for k, v in sorted((labels or {}).items()))
+        lines = []
+        counters = (
+            ('calls', 'transactions'),
+            ('timeouts', 'transactions with no reply'),
+            ('short_reads', 'replies shorter than expected'),
+            ('id_mismatches', 'replies with the wrong request ID'),
+            ('bytes_tx', 'bytes written'),
+            ('bytes_rx', 'bytes read'),
+        )
+        snapshot = self.snapshot()['commands']
+        for field, help_text in counters:
+            name = '%s_%s_total' % (prefix, field)
+            lines.append('# HELP %s Serial %s.' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for command, stats in snapshot.items():
+                lines.append('%s{command="%s"%s} %d' % (name, command, extra, stats[field]))
+        name = '%s_latency_seconds' % prefix
+        lines.append('# HELP %s Serial transaction latency.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for command, stats in snapshot.items():
+            cumulative = 0
+            for bound, count in stats['latency_buckets'].items():
+                cumulative += count
+                lines.append('%s_bucket{command="%s"%s,le="%s"} %d' % (name, command, extra, bound, cumulative))
+            lines.append('%s_sum{command="%s"%s} %.6f' % (name, command, extra, stats['latency_sum']))
+            lines.append('%s_count{command="%s"%s} %d' % (name, command, extra, stats['calls']))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path, **kwargs):
+        """
+        Atomically write the metrics to path: JSON if it ends in .json,
+        otherwise Prometheus text (for node_exporter's textfile collector).
+        """
+        if path.endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=2)
+        else:
+            text = self.prometheus_text(**kwargs)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+class RttWindow:
+    __slots__ = ('samples', 'next', 'count', 'percentile', 'stale', 'misses')
+
+    def __init__(self, size):
+        self.samples = array.array('d', bytes(8 * size))
+        self.next = 0
+        self.count = 0
+        self.percentile = None
+        self.stale = 0
+        self.misses = 0
+
+
+class RttTracker:
+    """
+    Recent round-trip times per command, for timeouts that follow the tail of
+    the latency distribution instead of a fixed worst case.
+
+    timeout(command, default) is RTT_MULTIPLIER x the RTT_PERCENTILE of the
+    last RTT_WINDOW samples, never below RTT_TIMEOUT_MIN and never above
+    default. Each consecutive miss() doubles it, so if the device really got
+    slower the timeout grows back to default within a few attempts and the
+    replies that then arrive move the percentile.
+    """
+
+    def __init__(self, window=RTT_WINDOW, percentile=RTT_PERCENTILE, multiplier=RTT_MULTIPLIER,
+                 minimum=RTT_TIMEOUT_MIN, min_samples=RTT_MIN_SAMPLES):
+        self.window = window
+        self.quantile = percentile
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.min_samples = min_samples
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def _window(self, command):
+        # caller holds self._lock
+        w = self.commands.get(command)
+        if w is None:
+            w = self.commands[command] = RttWindow(self.window)
+        return w
+
+    def record(self, command, seconds):
+        """A reply arrived after `seconds`."""
+        with self._lock:
+            w = self._window(command)
+            w.samples[w.next] = seconds
+            w.next = (w.next + 1) % self.window
+            w.count = min(w.count + 1, self.window)
+            w.stale += 1
+            if w.percentile is not None and seconds > w.percentile:
+                w.stale = RTT_REFRESH       # a slower reply than the cached tail shows up at once
+            w.misses = 0
+
+    def miss(self, command):
+        """An attempt timed out."""
+        with self._lock:
+            w = self._window(command)
+            w.misses = min(w.misses + 1, 16)
+
+    def percentile(self, command):
+        """Recent RTT_PERCENTILE round trip in seconds, or None with too few samples."""
+        with self._lock:
+            w = self.commands.get(command)
+            if w is None or w.count < self.min_samples:
+                return None
+            if w.percentile is None or w.stale >= RTT_REFRESH:
+                ordered = sorted(w.samples[:w.count])
+                w.percentile = ordered[min(w.count - 1, int(self.quantile * w.count))]
+                w.stale = 0
+            return w.percentile
+
+    def timeout(self, command, default):
+        p = self.percentile(command)
+        if p is None:
+            return default
+        timeout = max(self.minimum, p * self.multiplier) * (1 << self.commands[command].misses)
+        return timeout if default is None else min(timeout, default)
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+
+    def snapshot(self):
+        return {command: self.percentile(command) for command in sorted(self.commands)}
+
+
+# process-wide instances used by the library
+metrics = Metrics()
+rtt = RttTracker()
+
+def add_pre_hook(hook):
+    metrics.pre_hooks.append(hook)
+
+def add_post_hook(hook):
+    metrics.post_hooks.append(hook)
+
+def remove_hook(hook):
+    for hooks in (metrics.pre_hooks, metrics.post_hooks):
+        if hook in hooks:
+            hooks.remove(hook)
+
+def snapshot():
+    return metrics.snapshot()
+
+def prometheus_text(**kwargs):
+    return metrics.prometheus_text(**kwargs)
+
+def write_textfile(path, **kwargs):
+    metrics.write_textfile(path, **kwargs)
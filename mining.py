@@ -0,0 +1,336 @@
+import array
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import bm13xx
+
+#mining work dispatch and nonce collection on one ASIC port
+#
+# A writer thread turns block header templates into BM1366-style job frames
+# (bm13xx.work_frame, 82 byte payload) and streams them at the rate the chain
+# needs to stay busy: each job is a full nonce range times the version rolls
+# the chips do themselves, so at a known hashrate it lasts a known time. Job
+# IDs rotate in steps of JOB_ID_STEP; the low bits of the ID byte in a nonce
+# response carry the core that found it.
+#
+# A reader thread collects nonce responses continuously through the
+# streaming framer and maps each one back to its job through a bounded cache
+# keyed by job ID. Nonces for jobs that have been evicted count as stale,
+# repeats of a (job, nonce, version) as duplicates. Every accepted nonce is
+# a share at the chain's ticket difficulty, i.e. difficulty x 2^32 hashes,
+# which gives the effective hashrate per board and per chip.
+#
+# Chips split the nonce range by address, so the first nonce byte on the
+# wire is the address of the chip that found it.
+#
+# Job payload (multi-byte fields little endian):
+#   job_id | num_midstates | starting_nonce(4) | nbits(4) | ntime(4) |
+#   merkle_root(32) | prev_block_hash(32) | version(4)
+
+JOB_ID_STEP = 8
+JOB_ID_MOD = 128
+JOB_CACHE_SIZE = 8              # most recent jobs nonces are still accepted for
+
+NONCE_SPACE = 1 << 32
+VERSION_ROLLS = 1 << 16         # version bits the chips roll through per job
+VERSION_SHIFT = 13              # rolled bits in a response start at version bit 13
+JOB_FILL = 0.5                  # send a new job when the current one is this far through
+JOB_INTERVAL_MIN = 0.005        # seconds
+JOB_INTERVAL_MAX = 10.0
+
+SHARE_DIFFICULTY = 256          # ticket difficulty the chain is configured for
+DIFF1_TARGET = 0xFFFF << 208
+
+READ_SLICE = 0.05               # seconds per read_responses call on the reader thread
+
+BlockTemplate = namedtuple('BlockTemplate', 'version prev_hash merkle_root ntime nbits')
+BlockTemplate.__doc__ = """
+Block header fields for one job; prev_hash and merkle_root are 32 bytes in
+header byte order.
+"""
+
+Job = namedtuple('Job', 'job_id template payload sent_at nonces')
+
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def job_payload(job_id, template, starting_nonce=0):
+    """82 byte BM1366-style job payload for a template."""
+    return (struct.pack('<BBIII', job_id, 1, starting_nonce, template.nbits, template.ntime)
+            + template.merkle_root + template.prev_hash + struct.pack('<I', template.version))
+
+def job_interval(hashrate, version_rolls=VERSION_ROLLS, fill=JOB_FILL):
+    """Seconds between jobs to keep a chain hashing at `hashrate` H/s busy."""
+    seconds = NONCE_SPACE * version_rolls / hashrate * fill
+    return max(JOB_INTERVAL_MIN, min(JOB_INTERVAL_MAX, seconds))
+
+def next_job_id(job_id):
+    return (job_id + JOB_ID_STEP) % JOB_ID_MOD
+
+def nonce_job_id(response):
+    return response.reg_addr & ~(JOB_ID_STEP - 1) & 0xFF
+
+def nonce_chip_address(response):
+    return response.value >> 24
+
+def rolled_version(template, response):
+    return template.version | (response.extra << VERSION_SHIFT)
+
+def share_difficulty(template, response):
+    """Difficulty of the header hash for a nonce response, for checking a chain's results."""
+    header = (struct.pack('<I', rolled_version(template, response)) + template.prev_hash + template.merkle_root
+              + struct.pack('<II', template.ntime, template.nbits) + response.raw[2:6])
+    value = int.from_bytes(sha256d(header), 'little')
+    return DIFF1_TARGET / value if value else float('inf')
+
+def synthetic_templates(nbits=0x1703A30C, version=0x20000000):
+    """
+    Endless block header templates with a fresh merkle root each time, as an
+    extranonce roll would give, for running a chain without a pool.
+    """
+    prev_hash = os.urandom(32)
+    extranonce = 0
+    while True:
+        extranonce += 1
+        yield BlockTemplate(version, prev_hash, sha256d(prev_hash + extranonce.to_bytes(8, 'little')), int(time.time()), nbits)
+
+
+class JobCache:
+    """Bounded job ID -> Job map; the oldest job is evicted when it's full or its ID comes round again."""
+
+    def __init__(self, capacity=JOB_CACHE_SIZE):
+        self.capacity = capacity
+        self.jobs = OrderedDict()
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            if self.jobs.pop(job.job_id, None) is not None:
+                self.evicted += 1
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.capacity:
+                self.jobs.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def __len__(self):
+        return len(self.jobs)
+
+
+class MiningSession:
+    """
+    Stream jobs to one addressed chain and count the nonces that come back.
+
+    Args:
+        ser: The chain's ASIC port (serial.Serial or a broker AsicChannel)
+        hashboard_num: Board label for the stats
+        chip_count: Chips on the chain, addressed with bm13xx.address_chain(chip_count)
+        hashrate: Expected chain hashrate in H/s, sets the job rate
+        difficulty: Ticket difficulty the chips are configured for
+        templates: Iterator of BlockTemplate (default: synthetic_templates())
+        verify: Hash every nonce and count those below difficulty as errors
+    """
+
+    def __init__(self, ser, hashboard_num, chip_count=bm13xx.S19JPRO_ASIC_COUNT, hashrate=33e12,
+                 difficulty=SHARE_DIFFICULTY, templates=None, version_rolls=VERSION_ROLLS,
+                 cache_size=JOB_CACHE_SIZE, verify=False, debug=False):
+        self.ser = ser
+        self.hashboard_num = hashboard_num
+        self.chip_count = chip_count
+        self.hashrate_expected = hashrate
+        self.difficulty = difficulty
+        self.templates = templates if templates is not None else synthetic_templates()
+        self.interval = job_interval(hashrate, version_rolls)
+        self.verify = verify
+        self.debug = debug
+        self.cache = JobCache(cache_size)
+        self.interval_addr = bm13xx.address_interval(chip_count)
+        self.chip_nonces = array.array('I', bytes(4 * chip_count))
+        self.framer = bm13xx.ResponseFramer()
+        self.jobs_sent = 0
+        self.nonces = 0
+        self.stale = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.other = 0              # register replies and nonces from addresses off the chain
+        self.started = None
+        self.stopped = None
+        self._job_id = JOB_ID_MOD - JOB_ID_STEP
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def address(self):
+        """(Re)address the chain so the nonce ranges match chip_count."""
+        bm13xx.send(self.ser, bm13xx.address_chain(self.chip_count))
+
+    def send_job(self):
+        self._job_id = next_job_id(self._job_id)
+        template = next(self.templates)
+        payload = job_payload(self._job_id, template)
+        job = Job(self._job_id, template, payload, time.monotonic(), set())
+        self.cache.put(job)         # before the write, a fast chip may answer at once
+        bm13xx.send(self.ser, bm13xx.work_frame(payload))
+        self.jobs_sent += 1
+        return job
+
+    def handle(self, response):
+        """Account one response from the chain."""
+        if not response.is_job:
+            self.other += 1
+            return
+        chip = nonce_chip_address(response) // self.interval_addr
+        job = self.cache.get(nonce_job_id(response))
+        with self._lock:
+            if chip >= self.chip_count:
+                self.other += 1
+            elif job is None:
+                self.stale += 1
+            elif (response.value, response.extra) in job.nonces:
+                self.duplicates += 1
+            elif self.verify and share_difficulty(job.template, response) < self.difficulty:
+                self.errors += 1
+            else:
+                job.nonces.add((response.value, response.extra))
+                self.nonces += 1
+                self.chip_nonces[chip] += 1
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stop.clear()
+        self.started = time.monotonic()
+        self.stopped = None
+        self._threads = [
+            threading.Thread(target=self._read_loop, name="mining-hb%d-rx" % self.hashboard_num, daemon=True),
+            threading.Thread(target=self._write_loop, name="mining-hb%d-tx" % self.hashboard_num, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self._threads:
+            self.stopped = time.monotonic()
+        self._threads = []
+
+    def _write_loop(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            job = self.send_job()
+            if self.debug:
+                print("HB%d job %02X" % (self.hashboard_num, job.job_id))
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()
+            elif self._stop.wait(delay):
+                break
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            for response in bm13xx.read_responses(self.ser, timeout=READ_SLICE, idle_timeout=READ_SLICE, framer=self.framer):
+                self.handle(response)
+
+    def elapsed(self):
+        """Seconds mined: from start() to stop(), or to now while running."""
+        if self.started is None:
+            return 0.0
+        return (self.stopped if self.stopped is not None else time.monotonic()) - self.started
+
+    def hashrate(self):
+        """Effective board hashrate in H/s from the accepted nonces."""
+        elapsed = self.elapsed()
+        return self.nonces * self.difficulty * NONCE_SPACE / elapsed if elapsed else 0.0
+
+    def chip_hashrates(self):
+        """array('d') of effective hashrate in H/s per chip, in chain order."""
+        elapsed = self.elapsed()
+        scale = self.difficulty * NONCE_SPACE / elapsed if elapsed else 0.0
+        return array.array('d', (count * scale for count in self.chip_nonces))
+
+    def stats(self):
+        return {
+            'hashboard': self.hashboard_num,
+            'elapsed': self.elapsed(),
+            'jobs_sent': self.jobs_sent,
+            'job_interval': self.interval,
+            'nonces': self.nonces,
+            'stale': self.stale,
+            'duplicates': self.duplicates,
+            'errors': self.errors,
+            'other': self.other,
+            'crc_errors': self.framer.crc_errors,
+            'jobs_evicted': self.cache.evicted,
+            'hashrate': self.hashrate(),
+        }
+
+    def print_report(self, top=5):
+        stats = self.stats()
+        chips = self.chip_hashrates()
+        idle = sum(1 for rate in chips if rate == 0)
+        print("HB%d: %.2f TH/s effective (expected %.2f) over %.1f s, %d jobs every %.1f ms" % (
+            self.hashboard_num, stats['hashrate'] / 1e12, self.hashrate_expected / 1e12, stats['elapsed'],
+            stats['jobs_sent'], self.interval * 1000))
+        print("     %d nonces, %d stale, %d duplicate, %d bad, %d CRC errors, %d chips without a nonce" % (
+            stats['nonces'], stats['stale'], stats['duplicates'], stats['errors'], stats['crc_errors'], idle))
+        ranked = sorted(range(len(chips)), key=chips.__getitem__)
+        print("     slowest chips: %s" % ', '.join("%d (%.0f GH/s)" % (i, chips[i] / 1e9) for i in ranked[:top]))
+
+
+if __name__ == '__main__':
+    import argparse
+    import serial
+    import asic_chains
+
+    parser = argparse.ArgumentParser(description="Stream synthetic jobs to the ASIC chains and report effective hashrate")
+    parser.add_argument('seconds', nargs='?', type=float, default=10.0)
+    parser.add_argument('--hashrate', type=float, default=33.0, help="expected TH/s per board (default 33)")
+    parser.add_argument('--difficulty', type=int, default=SHARE_DIFFICULTY)
+    parser.add_argument('--sim', action='store_true', help="run against the simulator's synthetic nonces")
+    args = parser.parse_args()
+
+    sim = None
+    try:
+        if args.sim:
+            from bitcrane_sim import BitcraneSim
+            sim = BitcraneSim(nonce_hashrate=args.hashrate * 1e12, nonce_difficulty=args.difficulty).start()
+            asic_paths = sim.asic_ports
+        else:
+            asic_paths = asic_chains.ASIC_PORTS
+        asic_ports = asic_chains.open_asic_ports(ports=asic_paths)
+    except serial.SerialException as e:
+        print(f"Error opening serial port: {e}")
+        exit(1)
+
+    sessions = [MiningSession(ser, hashboard_num, hashrate=args.hashrate * 1e12, difficulty=args.difficulty)
+                for hashboard_num, ser in sorted(asic_ports.items())]
+    try:
+        for session in sessions:
+            session.address()
+            session.start()
+        time.sleep(args.seconds)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for session in sessions:
+            session.stop()
+        for session in sessions:
+            session.print_report()
+        print("Total: %.2f TH/s" % (sum(session.hashrate() for session in sessions) / 1e12))
+        for ser in asic_ports.values():
+            ser.close()
+        if sim is not None:
+            sim.close()
@@ -0,0 +1,270 @@
+import json
+import os
+import time
+from collections import namedtuple
+
+import APW_PSU
+
+#APW PSU calibration cache and verified voltage ramping
+#
+# A PSU model is identified by its HW and FW version words, which every unit
+# of that model shares. The JSON cache keeps the model's defaults (the
+# starting setpoint line and the raw PSU_CMD_READ_CAL word) under that key,
+# and each unit's refitted line under the model, keyed by an ID the caller
+# passes. The PSU reports no serial number and port names move on
+# re-enumeration, so without a unit ID the refitted line is kept in memory
+# only; label the PSU (or the rig it stays on) to have it cached. After the
+# first run loading it costs two version reads and no measurements. The measurement
+# conversion is taken as accurate; what drifts between units is the setpoint
+# line, and every ramp that verifies its result adds a point to refit it.
+#
+# A loaded calibration is installed for its port only (APW_PSU.converter_for),
+# so boards in one process each convert with their own unit's line.
+#
+# A ramp steps setpoints through to the target and only measures at the
+# end: one measurement when the calibration is good, one more per
+# correction when it isn't. Corrections are stepped the same way.
+
+PSU_CAL_CACHE = os.environ.get('BITCRANE_PSU_CAL', os.path.join(os.path.expanduser('~'), '.cache', 'bitcrane', 'psu_cal.json'))
+
+RAMP_STEP_VOLTS = 0.25      # largest setpoint change per write
+RAMP_DWELL = 0.05           # seconds between setpoint writes
+RAMP_SETTLE = 0.2           # seconds after the last write before measuring
+RAMP_TOLERANCE = 0.05       # volts
+RAMP_MAX_CORRECTIONS = 2
+FIT_MAX_POINTS = 32
+FIT_MIN_SPAN = 16           # codes; closer points only correct the offset
+
+RampResult = namedtuple('RampResult', 'target code measured writes measurements ok')
+
+
+def _command(ser, cmd_bytes, debug=False):
+    data = APW_PSU.psu_transaction(ser, APW_PSU.make_packet(list(cmd_bytes)), 8, debug)
+    return data[4:6] if data is not None else None
+
+def read_identity(ser, debug=False):
+    """Cache key for the attached PSU, e.g. 'hw1234-fw5678', or None if it doesn't answer."""
+    hw = _command(ser, [APW_PSU.PSU_CMD_GET_HW_VERSION], debug)
+    fw = _command(ser, [APW_PSU.PSU_CMD_GET_FW_VERSION], debug)
+    if hw is None or fw is None:
+        return None
+    return "hw%02x%02x-fw%02x%02x" % (hw[0], hw[1], fw[0], fw[1])
+
+def read_cal_word(ser, debug=False):
+    data = _command(ser, [APW_PSU.PSU_CMD_READ_CAL], debug)
+    return None if data is None else "%02x%02x" % (data[0], data[1])
+
+def read_setpoint(ser, debug=False):
+    """Current setpoint code, or None."""
+    data = _command(ser, [APW_PSU.PSU_CMD_GET_VOLTAGE], debug)
+    return None if data is None else data[0]
+
+def measure(ser, debug=False):
+    """Measured output voltage, or None."""
+    data = _command(ser, [APW_PSU.PSU_CMD_MEASURE_VOLTAGE], debug)
+    return None if data is None else APW_PSU.converter_for(ser).measured_volts(data[1] << 8 | data[0])
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(path, cache):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class PsuCalibration:
+    """
+    Calibration of one PSU unit: a PsuConverter plus the (code, volts) points
+    measured so far, cached under the unit within its model's identity key.
+    """
+
+    def __init__(self, key, converter=None, points=None, cal_word=None, path=PSU_CAL_CACHE, unit=None):
+        self.key = key
+        self.unit = unit
+        self.converter = converter or APW_PSU.PsuConverter()
+        self.points = list(points or [])
+        self.cal_word = cal_word
+        self.path = path
+
+    def install(self, ser):
+        """Use this calibration for the APW_PSU conversions on ser's port."""
+        APW_PSU.psu_converters[APW_PSU.psu_port(ser)] = self.converter
+        return self
+
+    def save(self):
+        """Store the model defaults, and this unit's fit if it has a unit ID."""
+        if self.key is None:
+            return
+        cache = _load_cache(self.path)
+        model = cache.get(self.key)
+        if model is None or 'units' not in model:
+            # new model, or an entry from before units were kept apart
+            model = cache[self.key] = {'converter': APW_PSU.PsuConverter().as_dict(), 'units': {}}
+        model['cal_word'] = self.cal_word
+        model['time'] = time.time()
+        if self.unit is not None:
+            model['units'][self.unit] = {
+                'converter': self.converter.as_dict(),
+                'points': self.points,
+                'time': time.time(),
+            }
+        _save_cache(self.path, cache)
+
+    def add_point(self, code, volts):
+        """Record a verified setpoint and refit the setpoint line."""
+        self.points = [p for p in self.points if p[0] != code][-(FIT_MAX_POINTS - 1):] + [[code, volts]]
+        fit = fit_setpoint(self.points, self.converter.set_slope)
+        if fit is not None:
+            c = self.converter
+            self.converter = APW_PSU.PsuConverter(fit[0], fit[1], c.measure_scale, c.measure_offset)
+            for port, converter in list(APW_PSU.psu_converters.items()):
+                if converter is c:
+                    APW_PSU.psu_converters[port] = self.converter
+
+
+def fit_setpoint(points, default_slope=APW_PSU.PSU_SET_SLOPE):
+    """
+    (offset, slope) of volts against setpoint code, or None without points.
+    Points spanning fewer than FIT_MIN_SPAN codes can't pin down a slope, so
+    then only the offset is fitted to default_slope.
+    """
+    n = len(points)
+    if n == 0:
+        return None
+    codes = [p[0] for p in points]
+    sx = sum(codes)
+    sy = sum(p[1] for p in points)
+    if max(codes) - min(codes) >= FIT_MIN_SPAN:
+        sxx = sum(p[0] * p[0] for p in points)
+        sxy = sum(p[0] * p[1] for p in points)
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        if slope < 0:       # output must fall as the code rises
+            return (sy - slope * sx) / n, slope
+    return (sy - default_slope * sx) / n, default_slope
+
+def load_calibration(ser, path=PSU_CAL_CACHE, refresh=False, install=True, unit=None, debug=False):
+    """
+    Calibration for the PSU on ser: the unit's own fit if it's cached, else
+    its model's defaults, else the built-in defaults plus the READ_CAL word,
+    saved for next time. unit is a stable ID for this PSU within its model;
+    without one the unit's fit isn't cached. With install set it becomes the
+    conversion APW_PSU uses for ser's port.
+    """
+    key = read_identity(ser, debug)
+    model = None if refresh or key is None else _load_cache(path).get(key)
+    if model is not None and 'units' in model:
+        entry = model['units'].get(unit) if unit is not None else None
+        calibration = PsuCalibration(key, APW_PSU.PsuConverter(**(entry or model)['converter']),
+                                     entry.get('points') if entry else None, model.get('cal_word'), path, unit)
+    else:
+        calibration = PsuCalibration(key, cal_word=read_cal_word(ser, debug), path=path, unit=unit)
+        calibration.save()
+    return calibration.install(ser) if install else calibration
+
+
+def step_setpoint(ser, current, code, codes_per_step, dwell=RAMP_DWELL, debug=False):
+    """
+    Walk the setpoint from current to code, at most codes_per_step per write.
+    Returns (setpoint reached, writes); short of code if the PSU stopped answering.
+    """
+    writes = 0
+    while current != code:
+        delta = max(-codes_per_step, min(codes_per_step, code - current))
+        if _command(ser, [APW_PSU.PSU_CMD_SET_VOLTAGE, current + delta, 0x00], debug) is None:
+            break
+        current += delta
+        writes += 1
+        if current != code:
+            time.sleep(dwell)
+    return current, writes
+
+def ramp_voltage(ser, target, calibration=None, step=RAMP_STEP_VOLTS, dwell=RAMP_DWELL, settle=RAMP_SETTLE,
+                 tolerance=RAMP_TOLERANCE, max_corrections=RAMP_MAX_CORRECTIONS, debug=False):
+    """
+    Step the PSU setpoint to target volts, at most `step` volts per write,
+    then measure once and correct the code from the error if needed. A
+    correction is stepped the same way, so a bad measurement can't move the
+    output by more than `step` in one write.
+
+    Returns a RampResult; ok is False if the output never came within
+    tolerance or the PSU stopped answering.
+    """
+    calibration = calibration or PsuCalibration(None, APW_PSU.converter_for(ser))
+    converter = calibration.converter
+    code = converter.setpoint_code(target)
+    current = read_setpoint(ser, debug)
+    if current is None:
+        return RampResult(target, None, None, 0, 0, False)
+
+    codes_per_step = max(1, int(abs(step / converter.set_slope)))
+    current, writes = step_setpoint(ser, current, code, codes_per_step, dwell, debug)
+    if current != code:
+        return RampResult(target, current, None, writes, 0, False)
+
+    measurements = 0
+    measured = None
+    for attempt in range(max_corrections + 1):
+        time.sleep(settle)
+        measured = measure(ser, debug)
+        measurements += 1
+        if measured is None:
+            return RampResult(target, code, None, writes, measurements, False)
+        calibration.add_point(code, measured)
+        converter = calibration.converter
+        error = measured - target
+        if debug:
+            print("PSU ramp: code 0x%02X measured %.3f V (target %.3f V)" % (code, measured, target))
+        if abs(error) <= tolerance or attempt == max_corrections:
+            break
+        new_code = min(255, max(0, code + int(round(-error / converter.set_slope))))
+        if new_code == code:
+            break
+        current, stepped = step_setpoint(ser, code, new_code, codes_per_step, dwell, debug)
+        writes += stepped
+        if current != new_code:
+            return RampResult(target, current, measured, writes, measurements, False)
+        code = new_code
+
+    if calibration.key is not None:
+        calibration.save()
+    return RampResult(target, code, measured, writes, measurements, abs(measured - target) <= tolerance)
+
+
+if __name__ == '__main__':
+    import sys
+    import serial
+
+    #usage: python psu_cal.py [target_volts] [--refresh] [--unit=ID]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    unit = next((arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--unit=')), None)
+    try:
+        serial_port_ctrl = serial.Serial(
+            port='/dev/tty.usbmodemb310cc521',  # Update this to your serial port
+            baudrate=115200,
+            timeout=1
+        )
+    except serial.SerialException as e:
+        print(f"Error opening Control serial port: {e}")
+        exit(1)
+
+    calibration = load_calibration(serial_port_ctrl, refresh='--refresh' in sys.argv, unit=unit)
+    c = calibration.converter
+    print("PSU %s: setpoint V = %.4f %+.5f * code, %d points, READ_CAL %s" % (
+        calibration.key, c.set_offset, c.set_slope, len(calibration.points), calibration.cal_word))
+    if args:
+        result = ramp_voltage(serial_port_ctrl, float(args[0]), calibration)
+        print("target %.3f V: code 0x%02X measured %s V, %d writes, %d measurements, %s" % (
+            result.target, result.code if result.code is not None else 0,
+            "%.3f" % result.measured if result.measured is not None else "-",
+            result.writes, result.measurements, "ok" if result.ok else "FAILED"))
+    serial_port_ctrl.close()
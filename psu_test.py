@@ -1,6 +1,8 @@
 import serial
+import sys
 import time
 import APW_PSU
+import ctrl_scheduler
 
 try:
     serial_port_ctrl = serial.Serial(
@@ -13,6 +15,13 @@ except serial.SerialException as e:
     exit(1)
 
 
+#python psu_test.py watchdog -> keep the PSU watchdog on and feed it from the safety lane
+feeder = None
+if len(sys.argv) > 1 and sys.argv[1] == 'watchdog':
+    scheduler = ctrl_scheduler.ControlScheduler(serial_port_ctrl)
+    serial_port_ctrl = scheduler.lane(ctrl_scheduler.LANE_CONTROL)
+    feeder = ctrl_scheduler.PsuWatchdogFeeder(scheduler.lane(ctrl_scheduler.LANE_SAFETY), interval=1.0)
+
 APW_PSU.PSU_set_enable(serial_port_ctrl, enable=True, debug=False)
 time.sleep(0.5)  # wait for PSU to power up
 
@@ -20,7 +29,11 @@ time.sleep(0.5)  # wait for PSU to power up
 # APW_PSU.PSU_get_fw_version(serial_port_ctrl, False)
 
 # it seems like 0x00 disables the watchdog, 0x01 enables it??
-APW_PSU.PSU_config_watchdog(serial_port_ctrl, 0x00, False)
+if feeder is None:
+    APW_PSU.PSU_config_watchdog(serial_port_ctrl, 0x00, False)
+else:
+    feeder.start()
+    APW_PSU.PSU_config_watchdog(serial_port_ctrl, 0x01, False)
 
 #APW_PSU.PSU_set_voltage(serial_port_ctrl, 11.89, False)
 APW_PSU.PSU_set_voltage_raw(serial_port_ctrl, 0xFF, False)
@@ -29,4 +42,8 @@ APW_PSU.PSU_set_voltage_raw(serial_port_ctrl, 0xFF, False)
 time.sleep(5)
 
 # this measure_voltage command is really squirrley
-APW_PSU.PSU_measure_voltage(serial_port_ctrl, False)
\ No newline at end of file
+APW_PSU.PSU_measure_voltage(serial_port_ctrl, False)
+
+if feeder is not None:
+    feeder.stop()
+    print("watchdog feeds: %(feeds)d, misses: %(misses)d, max latency %(latency_max).3f s" % feeder.stats())
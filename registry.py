@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import time
+
+import serial
+from serial.tools import list_ports
+
+#Bitcrane USB port discovery and on-disk device registry
+#
+# A Bitcrane enumerates as one USB device with four CDC ACM interfaces. In
+# interface order they are the control port and the ASIC ports of hashboards
+# 0, 1 and 2. The registry groups serial ports by USB serial number, orders
+# each group by interface index and assigns the roles, then caches the result
+# as JSON. Later startups only look up the cached paths, checking that each
+# still belongs to the same serial number and interface; ttyACM numbers are
+# handed out again on re-plug or reboot, so a path alone proves nothing.
+
+ROLE_CTRL = 'ctrl'
+ROLE_HB0 = 'hb0'
+ROLE_HB1 = 'hb1'
+ROLE_HB2 = 'hb2'
+ROLES = (ROLE_CTRL, ROLE_HB0, ROLE_HB1, ROLE_HB2)    # in USB interface order
+
+# set these to the board's USB IDs to ignore other CDC devices; None matches
+# any device that exposes exactly four serial interfaces under one serial number
+BITCRANE_USB_VID = None
+BITCRANE_USB_PID = None
+
+BAUD_RATE = 115200
+ROLE_TIMEOUTS = {ROLE_CTRL: 1.0, ROLE_HB0: 2.0, ROLE_HB1: 2.0, ROLE_HB2: 2.0}
+
+REGISTRY_PATH = os.environ.get('BITCRANE_REGISTRY', os.path.join(os.path.expanduser('~'), '.cache', 'bitcrane', 'registry.json'))
+REGISTRY_VERSION = 1
+
+
+def asic_role(hashboard_num):
+    return ROLES[1 + hashboard_num]
+
+def interface_index(info):
+    """
+    USB interface number of a port. Linux reports it in the sysfs location
+    (1-1.2:1.3), macOS in the last digit of the usbmodem name.
+    """
+    if info.location:
+        match = re.search(r':\d+\.(\d+)$', info.location)
+        if match:
+            return int(match.group(1))
+    match = re.search(r'usbmodem.*?(\d)$', info.device)
+    if match:
+        return int(match.group(1))
+    return None
+
+def _sort_key(info):
+    index = interface_index(info)
+    return (index if index is not None else 0xFFFF, info.device)
+
+def port_infos(paths):
+    """
+    {path: ListPortInfo or None} for just these ports: sysfs lookups on
+    Linux, a full list_ports scan elsewhere.
+    """
+    if os.path.isdir('/sys/class/tty'):
+        from serial.tools.list_ports_linux import SysFS
+        return {path: SysFS(path) for path in paths}
+    infos = {info.device: info for info in list_ports.comports()}
+    return {path: infos.get(os.path.realpath(path), infos.get(path)) for path in paths}
+
+
+class BitcraneDevice:
+    """
+    One Bitcrane board: its USB serial number and a {role: device path} map.
+    open() hands out serial ports configured for the role.
+    """
+
+    def __init__(self, serial_number, ports, vid=None, pid=None):
+        self.serial_number = serial_number
+        self.ports = dict(ports)
+        self.vid = vid
+        self.pid = pid
+
+    def __repr__(self):
+        return "BitcraneDevice(%r, %r)" % (self.serial_number, self.ports)
+
+    def path(self, role):
+        return self.ports[role]
+
+    def exists(self):
+        return all(os.path.exists(path) for path in self.ports.values())
+
+    def verify(self, infos):
+        """
+        True if every port path still belongs to this serial number and the
+        roles are still in interface order. infos is port_infos() output.
+        """
+        ordered = []
+        for role in ROLES:
+            info = infos.get(self.ports.get(role))
+            if info is None or info.serial_number != self.serial_number:
+                return False
+            ordered.append(info)
+        return ordered == sorted(ordered, key=_sort_key)
+
+    def open(self, role, **kwargs):
+        """Open the port for a role with its baud rate and timeout (overridable by kwargs)."""
+        options = {'baudrate': BAUD_RATE, 'timeout': ROLE_TIMEOUTS.get(role, 1.0)}
+        options.update(kwargs)
+        return serial.Serial(port=self.ports[role], **options)
+
+    def open_ctrl(self, transport=False, **kwargs):
+        """Open the control port, wrapped in a ControlTransport if transport is set."""
+        ser = self.open(ROLE_CTRL, **kwargs)
+        if transport:
+            from ctrl_transport import ControlTransport
+            return ControlTransport(ser)
+        return ser
+
+    def open_asic(self, hashboard_num, **kwargs):
+        return self.open(asic_role(hashboard_num), **kwargs)
+
+    def asic_ports(self):
+        """{hashboard_num: device path}, in the form asic_chains.open_asic_ports takes."""
+        return {hashboard_num: self.ports[asic_role(hashboard_num)] for hashboard_num in range(3)
+                if asic_role(hashboard_num) in self.ports}
+
+    def as_dict(self):
+        return {'vid': self.vid, 'pid': self.pid, 'ports': self.ports}
+
+
+def enumerate_devices(vid=BITCRANE_USB_VID, pid=BITCRANE_USB_PID):
+    """Scan the USB serial ports. Returns {serial_number: BitcraneDevice}."""
+    groups = {}
+    for info in list_ports.comports():
+        if info.vid is None or not info.serial_number:
+            continue
+        if (vid is not None and info.vid != vid) or (pid is not None and info.pid != pid):
+            continue
+        groups.setdefault(info.serial_number, []).append(info)
+
+    devices = {}
+    for serial_number, infos in groups.items():
+        if len(infos) != len(ROLES):
+            continue
+        infos.sort(key=_sort_key)
+        ports = dict(zip(ROLES, (info.device for info in infos)))
+        devices[serial_number] = BitcraneDevice(serial_number, ports, infos[0].vid, infos[0].pid)
+    return devices
+
+
+class Registry:
+    """
+    Cached map of attached Bitcranes.
+
+    Args:
+        path: JSON cache file
+        vid, pid: USB IDs to match when enumerating (None matches any)
+    """
+
+    def __init__(self, path=REGISTRY_PATH, vid=BITCRANE_USB_VID, pid=BITCRANE_USB_PID):
+        self.path = path
+        self.vid = vid
+        self.pid = pid
+        self.devices = None
+        self.enumerated = False     # True if the last discover() had to scan USB
+
+    def load(self):
+        """Read the cache. Returns {serial_number: BitcraneDevice}, empty if missing or unreadable."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != REGISTRY_VERSION:
+            return {}
+        return {serial_number: BitcraneDevice(serial_number, entry['ports'], entry.get('vid'), entry.get('pid'))
+                for serial_number, entry in data.get('devices', {}).items()}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {
+            'version': REGISTRY_VERSION,
+            'time': time.time(),
+            'devices': {serial_number: device.as_dict() for serial_number, device in sorted(self.devices.items())},
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def discover(self, refresh=False):
+        """
+        Return {serial_number: BitcraneDevice}. The cache is used as long as
+        every cached port path still exists and still belongs to the same
+        board and interface; otherwise (or with refresh) USB is scanned and
+        the cache rewritten.
+        """
+        if not refresh:
+            devices = self.devices if self.devices is not None else self.load()
+            if devices and all(device.exists() for device in devices.values()):
+                infos = port_infos([path for device in devices.values() for path in device.ports.values()])
+                if all(device.verify(infos) for device in devices.values()):
+                    self.devices = devices
+                    self.enumerated = False
+                    return devices
+        self.devices = enumerate_devices(self.vid, self.pid)
+        self.enumerated = True
+        try:
+            self.save()
+        except OSError:
+            pass        # a read-only home still gets the scan result
+        return self.devices
+
+    def get(self, serial_number=None, refresh=False):
+        """
+        The device with this USB serial number, or the only attached device if
+        serial_number is None. Raises LookupError if there's no match (or more
+        than one device and no serial number).
+        """
+        devices = self.discover(refresh)
+        if serial_number is None:
+            if len(devices) == 1:
+                return next(iter(devices.values()))
+            if not devices:
+                raise LookupError("No Bitcrane found")
+            raise LookupError("%d Bitcranes found, pass a serial number: %s" % (len(devices), ', '.join(sorted(devices))))
+        device = devices.get(serial_number)
+        if device is None and not refresh and not self.enumerated:
+            devices = self.discover(refresh=True)   # may have been plugged in since the cache was written
+            device = devices.get(serial_number)
+        if device is None:
+            raise LookupError("Bitcrane %s not found" % serial_number)
+        return device
+
+
+# process-wide registry used by the scripts
+registry = Registry()
+
+def find_device(serial_number=None, refresh=False):
+    return registry.get(serial_number, refresh)
+
+def open_port(role, serial_number=None, **kwargs):
+    """Open one role's port on the attached (or named) Bitcrane."""
+    return find_device(serial_number).open(role, **kwargs)
+
+
+if __name__ == '__main__':
+    import sys
+
+    #usage: python registry.py [--refresh]
+    refresh = '--refresh' in sys.argv[1:]
+    start = time.perf_counter()
+    devices = registry.discover(refresh)
+    elapsed = time.perf_counter() - start
+    print("%d Bitcrane(s) %s in %.1f ms (%s)" % (len(devices), 'enumerated' if registry.enumerated else 'from cache',
+                                              elapsed * 1000, registry.path))
+    for serial_number, device in sorted(devices.items()):
+        print(serial_number)
+        for role in ROLES:
+            print("  %-4s %s" % (role, device.ports.get(role)))
@@ -0,0 +1,241 @@
+import array
+import heapq
+import math
+import threading
+import time
+
+import APW_PSU
+import TMP75
+import bitcrane
+
+#deadline-scheduled telemetry poller for the Bitcrane control port
+#
+# Every signal has a fixed sample period. One thread keeps the signals in an
+# earliest-deadline-first heap and advances each deadline by exactly one
+# period from the previous deadline (not from when the read finished), so the
+# schedule doesn't drift. Samples go into a SampleRing that any number of
+# consumers can read without taking a lock.
+
+
+class SampleRing:
+    """
+    Fixed-size ring of (timestamp, channel, value) samples.
+
+    There is one writer (the poller thread). Readers keep their own cursor,
+    the count of samples seen so far, and call read() whenever they like; the
+    writer never waits for them. A reader that falls more than `capacity`
+    samples behind loses the oldest ones and is told how many.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.channels = array.array('H', bytes(2 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        self.head = 0   # total samples ever written
+
+    def append(self, timestamp, channel, value):
+        i = self.head % self.capacity
+        self.timestamps[i] = timestamp
+        self.channels[i] = channel
+        self.values[i] = math.nan if value is None else value
+        # publish only after the slot is filled in
+        self.head += 1
+
+    def read(self, cursor=0, limit=None):
+        """
+        Return (samples, new_cursor, lost) for everything written since cursor.
+        samples is a list of (timestamp, channel, value) tuples, a failed read
+        has a NaN value.
+        """
+        head = self.head
+        lost = 0
+        if head - cursor > self.capacity:
+            lost = head - self.capacity - cursor
+            cursor = head - self.capacity
+        if limit is not None:
+            head = min(head, cursor + limit)
+        samples = []
+        for n in range(cursor, head):
+            i = n % self.capacity
+            samples.append((self.timestamps[i], self.channels[i], self.values[i]))
+        # the writer may have lapped us while copying, drop what it overwrote
+        overwritten = self.head - self.capacity - cursor
+        if overwritten > 0:
+            del samples[:overwritten]
+            lost += overwritten
+        return samples, head, lost
+
+    def latest(self, channel):
+        """Most recent (timestamp, value) for a channel, or None."""
+        head = self.head
+        for n in range(head - 1, max(head - self.capacity, 0) - 1, -1):
+            i = n % self.capacity
+            if self.channels[i] == channel:
+                return self.timestamps[i], self.values[i]
+        return None
+
+
+class TelemetryPoller:
+    """
+    Sample many signals on one control port on an earliest-deadline-first schedule.
+
+    Args:
+        ser: Control port, a serial.Serial or ControlTransport. Only the
+             poller thread uses it unless it is a ControlTransport.
+        ring: SampleRing to publish into, a new 4096 sample ring by default
+    """
+
+    def __init__(self, ser, ring=None, debug=False):
+        self.ser = ser
+        self.ring = ring or SampleRing()
+        self.debug = debug
+        self.names = []
+        self.periods = []
+        self.readers = []
+        self.samples = []       # per channel: completed reads
+        self.errors = []        # per channel: reads that raised or returned None
+        self.overruns = []      # per channel: deadlines skipped because we fell behind
+        self.busy_time = 0.0
+        self.started = None
+        self._heap = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, rate_hz, read):
+        """
+        Add a signal sampled rate_hz times a second. read(ser) returns a number
+        or None. Returns the channel number used in the ring.
+        """
+        channel = len(self.names)
+        self.names.append(name)
+        self.periods.append(1.0 / rate_hz)
+        self.readers.append(read)
+        self.samples.append(0)
+        self.errors.append(0)
+        self.overruns.append(0)
+        return channel
+
+    def start(self):
+        now = time.monotonic()
+        self.started = now
+        self._heap = [(now, channel) for channel in range(len(self.names))]
+        heapq.heapify(self._heap)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        heap = self._heap
+        while heap and not self._stop.is_set():
+            deadline, channel = heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                self._stop.wait(deadline - now)
+                continue
+            heapq.heappop(heap)
+
+            try:
+                value = self.readers[channel](self.ser)
+            except Exception as e:
+                if self.debug:
+                    print("telemetry %s: %s" % (self.names[channel], e))
+                value = None
+            done = time.monotonic()
+            self.busy_time += done - now
+            if value is None:
+                self.errors[channel] += 1
+            else:
+                self.samples[channel] += 1
+            self.ring.append(done, channel, value)
+
+            period = self.periods[channel]
+            deadline += period
+            if deadline <= done:
+                # we fell behind: skip the missed slots but stay on the original grid
+                missed = int((done - deadline) / period) + 1
+                self.overruns[channel] += missed
+                deadline += missed * period
+            heapq.heappush(heap, (deadline, channel))
+
+    def stats(self):
+        """Per-signal achieved rates and the fraction of time the port was busy."""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        signals = {}
+        for channel, name in enumerate(self.names):
+            signals[name] = {
+                'target_hz': 1.0 / self.periods[channel],
+                'achieved_hz': self.samples[channel] / elapsed if elapsed else 0.0,
+                'errors': self.errors[channel],
+                'overruns': self.overruns[channel],
+            }
+        return {'elapsed': elapsed, 'utilization': self.busy_time / elapsed if elapsed else 0.0, 'signals': signals}
+
+
+def read_psu_measured_voltage(ser):
+    data = APW_PSU.psu_transaction(ser, APW_PSU.make_packet([APW_PSU.PSU_CMD_MEASURE_VOLTAGE]), 8)
+    if data is None:
+        return None
+    return APW_PSU.measured_voltage_volts(data, ser)
+
+def add_board_signals(poller, hashboards=(0, 1, 2), fans=(1, 2, 3, 4), temp_hz=1.0, fan_hz=1.0, psu_hz=0.2):
+    """
+    Add the standard Bitcrane signals: two TMP75s per hashboard, the fan
+    tachs and the PSU measured voltage (skipped when psu_hz is 0).
+    """
+    for hashboard_num in hashboards:
+        for chipnum in (0, 1):
+            poller.add("hb%d_temp%d" % (hashboard_num, chipnum), temp_hz,
+                       lambda ser, c=chipnum, h=hashboard_num: TMP75.read_temperature(ser, c, h))
+    for fan_num in fans:
+        poller.add("fan%d_rpm" % fan_num, fan_hz,
+                   lambda ser, f=fan_num: bitcrane.get_fan_rpm(ser, 0xAB, f))
+    if psu_hz:
+        poller.add("psu_voltage", psu_hz, read_psu_measured_voltage)
+
+
+if __name__ == '__main__':
+    import sys
+    import serial
+
+    #usage: python telemetry.py [temp_hz] [fan_hz] [psu_hz]
+    rates = [float(arg) for arg in sys.argv[1:4]] + [1.0, 1.0, 0.2][len(sys.argv[1:4]):]
+
+    try:
+        serial_port_ctrl = serial.Serial(
+            port='/dev/tty.usbmodemb310cc521',  # Update this to your serial port
+            baudrate=115200,
+            timeout=1
+        )
+    except serial.SerialException as e:
+        print(f"Error opening Control serial port: {e}")
+        exit(1)
+
+    poller = TelemetryPoller(serial_port_ctrl)
+    add_board_signals(poller, temp_hz=rates[0], fan_hz=rates[1], psu_hz=rates[2])
+    poller.start()
+    cursor = 0
+    try:
+        while True:
+            time.sleep(1)
+            samples, cursor, lost = poller.ring.read(cursor)
+            for timestamp, channel, value in samples:
+                print("%10.3f %-12s %10.2f" % (timestamp, poller.names[channel], value))
+            if lost:
+                print("(%d samples lost)" % lost)
+    except KeyboardInterrupt:
+        print(" -> Stopping the script.")
+    finally:
+        poller.stop()
+        stats = poller.stats()
+        print("port utilization %.0f%%" % (stats['utilization'] * 100))
+        for name, signal in stats['signals'].items():
+            print("%-12s %6.2f / %6.2f Hz  errors %d  overruns %d" % (
+                name, signal['achieved_hz'], signal['target_hz'], signal['errors'], signal['overruns']))
+        serial_port_ctrl.close()
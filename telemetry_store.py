@@ -0,0 +1,435 @@
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import time
+
+#append-only columnar telemetry store with downsampling tiers
+#
+# Samples are (timestamp, board, channel, value) and live in fixed-capacity
+# segments. A segment is one mmap (a file, or anonymous memory when the store
+# has no directory) holding a small header and one contiguous column per
+# field, so a sample costs 20 bytes and no Python objects. Each tier keeps a
+# bounded number of segments and drops its oldest when a new one is opened,
+# which keeps memory and disk use flat however long the store runs.
+#
+# Tiers: raw samples, then 1 s, 1 min and 1 h aggregates (count, min, max,
+# sum per board and channel). Every raw sample updates the 1 s bucket. A
+# sample that starts a new bucket finishes every earlier one, for all boards
+# and channels at once, and the finished buckets are written to their tier in
+# time order and folded into the next coarser one, so every tier stays sorted
+# however the channel rates differ. Timestamps are wall-clock seconds and
+# must be appended in order; a sample older than the last one stored is
+# dropped and counted in the tier's `late`, never restamped.
+
+SEGMENT_MAGIC = b'BTSG'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER_SIZE = 64
+_SEG_HEADER = struct.Struct('<4sHHIIdd')    # magic, version, schema, capacity, count, first, last timestamp
+
+SCHEMA_RAW = 0
+SCHEMA_AGG = 1
+SCHEMAS = {
+    SCHEMA_RAW: (('timestamp', 'd'), ('board', 'H'), ('channel', 'H'), ('value', 'd')),
+    SCHEMA_AGG: (('timestamp', 'd'), ('board', 'H'), ('channel', 'H'), ('count', 'I'),
+                 ('min', 'd'), ('max', 'd'), ('sum', 'd')),
+}
+
+TIER_RAW = 'raw'
+# name, bucket seconds, samples per segment, segments kept
+TIER_DEFAULTS = (
+    (TIER_RAW, 0, 1 << 16, 16),
+    ('1s', 1, 1 << 16, 8),
+    ('1m', 60, 1 << 14, 8),
+    ('1h', 3600, 1 << 12, 8),
+)
+
+
+class Segment:
+    """Fixed-capacity columnar block of samples in an mmap."""
+
+    def __init__(self, schema, capacity, path=None):
+        self.schema = schema
+        self.path = path
+        fields = SCHEMAS[schema]
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                magic, version, schema, capacity, count, first, last = _SEG_HEADER.unpack(f.read(_SEG_HEADER.size))
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or schema != self.schema:
+                raise ValueError("%s is not a telemetry segment" % path)
+        else:
+            capacity = (capacity + 7) & ~7      # keeps every column 8-byte aligned
+            count, first, last = 0, math.nan, math.nan
+        self.capacity = capacity
+        self.count = count
+        self.first = first
+        self.last = last
+        size = SEGMENT_HEADER_SIZE + sum(struct.calcsize(code) for _, code in fields) * capacity
+        if path is None:
+            self._file = None
+            self._map = mmap.mmap(-1, size)
+        else:
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.truncate(size)
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), size)
+        self.columns = {}
+        offset = SEGMENT_HEADER_SIZE
+        for name, code in fields:
+            nbytes = struct.calcsize(code) * capacity
+            self.columns[name] = memoryview(self._map)[offset:offset + nbytes].cast(code)
+            offset += nbytes
+        self._write_header()
+
+    def _write_header(self):
+        _SEG_HEADER.pack_into(self._map, 0, SEGMENT_MAGIC, SEGMENT_VERSION, self.schema, self.capacity,
+                              self.count, self.first, self.last)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def append(self, values):
+        """values is a tuple in schema order, starting with the timestamp."""
+        i = self.count
+        for column, value in zip(self.columns.values(), values):
+            column[i] = value
+        if i == 0:
+            self.first = values[0]
+        self.last = values[0]
+        self.count = i + 1
+        self._write_header()
+
+    def span(self, start, end):
+        """Index range [lo, hi) of the samples with start <= timestamp < end."""
+        timestamps = self.columns['timestamp']
+        return (bisect.bisect_left(timestamps, start, 0, self.count),
+                bisect.bisect_left(timestamps, end, 0, self.count))
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self, delete=False):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self._map.close()
+        if self._file is not None:
+            self._file.close()
+            if delete:
+                os.unlink(self.path)
+
+
+class Tier:
+    """A ring of segments of one schema; the oldest segment is dropped when a new one is opened."""
+
+    def __init__(self, name, resolution, capacity, max_segments, directory=None):
+        self.name = name
+        self.resolution = resolution
+        self.schema = SCHEMA_RAW if resolution == 0 else SCHEMA_AGG
+        self.capacity = capacity
+        self.max_segments = max_segments
+        self.directory = directory
+        self.segments = []
+        self.late = 0               # samples dropped for being older than the last one stored
+        self._next_index = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith('.seg'):
+                    self.segments.append(Segment(self.schema, capacity, os.path.join(directory, filename)))
+                    self._next_index = int(filename[:-4]) + 1
+            while len(self.segments) > max_segments:
+                self.segments.pop(0).close(delete=True)
+
+    def _new_segment(self):
+        path = None
+        if self.directory is not None:
+            path = os.path.join(self.directory, "%08d.seg" % self._next_index)
+        self._next_index += 1
+        if self.segments:
+            self.segments[-1].flush()
+        if len(self.segments) >= self.max_segments:
+            self.segments.pop(0).close(delete=True)
+        segment = Segment(self.schema, self.capacity, path)
+        self.segments.append(segment)
+        return segment
+
+    @property
+    def first(self):
+        for segment in self.segments:
+            if segment.count:
+                return segment.first
+        return math.nan
+
+    @property
+    def last(self):
+        for segment in reversed(self.segments):
+            if segment.count:
+                return segment.last
+        return math.nan
+
+    def append(self, values):
+        """Store one sample. Returns False (and counts it in late) if it's older than the last one."""
+        segment = self.segments[-1] if self.segments else None
+        if segment is not None and segment.count and values[0] < segment.last:
+            self.late += 1
+            return False
+        if segment is None or segment.full:
+            segment = self._new_segment()
+        segment.append(values)
+        return True
+
+    def query(self, start, end, board=None, channel=None):
+        """Columns (array per field) of the samples in [start, end), optionally for one board/channel."""
+        fields = SCHEMAS[self.schema]
+        result = {name: array.array(code) for name, code in fields}
+        for segment in self.segments:
+            if not segment.count or segment.last < start or segment.first >= end:
+                continue
+            lo, hi = segment.span(start, end)
+            if lo == hi:
+                continue
+            columns = segment.columns
+            if board is None and channel is None:
+                for name, _ in fields:
+                    result[name].extend(columns[name][lo:hi])
+                continue
+            boards = columns['board']
+            channels = columns['channel']
+            for i in range(lo, hi):
+                if (board is None or boards[i] == board) and (channel is None or channels[i] == channel):
+                    for name, _ in fields:
+                        result[name].append(columns[name][i])
+        return result
+
+    def flush(self):
+        for segment in self.segments:
+            segment.flush()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+class TelemetryStore:
+    """
+    Telemetry samples from many boards with 1 s / 1 min / 1 h rollups.
+
+    Args:
+        path: Directory for the segment files, or None to keep everything in
+              anonymous memory. An existing store is reopened and appended to.
+        tiers: (name, bucket seconds, samples per segment, segments kept) for
+              each tier, the raw tier first with 0 seconds
+    """
+
+    def __init__(self, path=None, tiers=TIER_DEFAULTS):
+        self.path = path
+        self.tiers = []
+        for name, resolution, capacity, max_segments in tiers:
+            directory = os.path.join(path, name) if path is not None else None
+            self.tiers.append(Tier(name, resolution, capacity, max_segments, directory))
+        self.tier_names = {tier.name: tier for tier in self.tiers}
+        self.channels = {}
+        if path is not None:
+            try:
+                with open(os.path.join(path, 'channels.json')) as f:
+                    self.channels = json.load(f)
+            except (OSError, ValueError):
+                pass
+        # per aggregate tier: {(board, channel): [bucket, count, min, max, sum]}
+        self._buckets = [{} for _ in self.tiers]
+        # per aggregate tier: start of the latest bucket any sample has fallen in
+        self._current = [-math.inf for _ in self.tiers]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def channel_id(self, name):
+        """Number for a channel name, assigned on first use and kept with the store."""
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = len(self.channels)
+            if self.path is not None:
+                tmp = os.path.join(self.path, 'channels.json.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(self.channels, f, indent=2)
+                os.replace(tmp, os.path.join(self.path, 'channels.json'))
+        return channel
+
+    def channel_name(self, channel):
+        for name, number in self.channels.items():
+            if number == channel:
+                return name
+        return str(channel)
+
+    def _channel(self, channel):
+        return self.channel_id(channel) if isinstance(channel, str) else channel
+
+    def append(self, timestamp, board, channel, value):
+        """
+        Store one sample. value None (a failed read) is stored as NaN and left
+        out of the rollups. Returns False if the sample was dropped as late.
+        """
+        channel = self._channel(channel)
+        value = math.nan if value is None else value
+        if not self.tiers[0].append((timestamp, board, channel, value)):
+            return False
+        if len(self.tiers) > 1 and not math.isnan(value):
+            self._rollup(1, timestamp, board, channel, 1, value, value, value)
+        return True
+
+    def _rollup(self, level, timestamp, board, channel, count, low, high, total):
+        tier = self.tiers[level]
+        bucket = math.floor(timestamp / tier.resolution) * tier.resolution
+        if bucket > self._current[level]:
+            self._emit_before(level, bucket)
+            self._current[level] = bucket
+        key = (board, channel)
+        acc = self._buckets[level].get(key)
+        if acc is None:
+            self._buckets[level][key] = [bucket, count, low, high, total]
+        else:
+            acc[1] += count
+            acc[2] = min(acc[2], low)
+            acc[3] = max(acc[3], high)
+            acc[4] += total
+
+    def _emit_before(self, level, end):
+        # write out every bucket of this tier that starts before end, oldest first across all keys
+        buckets = self._buckets[level]
+        for _, key in sorted((acc[0], key) for key, acc in buckets.items() if acc[0] < end):
+            self._emit(level, key, buckets.pop(key))
+
+    def _emit(self, level, key, acc):
+        bucket, count, low, high, total = acc
+        self.tiers[level].append((bucket, key[0], key[1], count, low, high, total))
+        if level + 1 < len(self.tiers):
+            self._rollup(level + 1, bucket, key[0], key[1], count, low, high, total)
+
+    def flush(self, now=None):
+        """Write out every bucket that has ended by now (all of them if now is None) and sync to disk."""
+        for level in range(1, len(self.tiers)):
+            resolution = self.tiers[level].resolution
+            self._emit_before(level, math.inf if now is None else math.floor(now / resolution) * resolution)
+        for tier in self.tiers:
+            tier.flush()
+
+    def close(self):
+        self.flush()
+        for tier in self.tiers:
+            tier.close()
+
+    def drain(self, ring, cursor, names, board=0, clock_offset=None):
+        """
+        Move everything written to a telemetry.SampleRing since cursor into
+        the store. names maps ring channels to names (TelemetryPoller.names).
+        Ring timestamps are time.monotonic(); clock_offset converts them to
+        wall-clock (default: the current offset). Returns the new cursor.
+        """
+        if clock_offset is None:
+            clock_offset = time.time() - time.monotonic()
+        samples, cursor, _ = ring.read(cursor)
+        ids = [self.channel_id(name) for name in names]
+        for timestamp, channel, value in samples:
+            self.append(timestamp + clock_offset, board, ids[channel], value)
+        return cursor
+
+    def pick_tier(self, start, end):
+        """The finest tier still holding data from start, or the coarsest if none reaches back that far."""
+        for tier in self.tiers:
+            if tier.first <= start:
+                return tier
+        for tier in self.tiers:
+            if tier.segments and tier.first <= end:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, start, end, board=None, channel=None, tier=None):
+        """
+        Samples with start <= timestamp < end as {field: array}. The raw tier
+        has a value column, the others count/min/max/sum. tier is a tier name,
+        or None to use the finest tier that covers start.
+        """
+        tier = self.tier_names[tier] if tier is not None else self.pick_tier(start, end)
+        result = tier.query(start, end, board, None if channel is None else self._channel(channel))
+        result['tier'] = tier.name
+        return result
+
+    def aggregate(self, start, end, board=None, channel=None, tier=None):
+        """(count, min, max, mean) over [start, end), NaN fields if there's no data."""
+        result = self.query(start, end, board, channel, tier)
+        if 'value' in result:
+            values = [v for v in result['value'] if not math.isnan(v)]
+            count, total = len(values), sum(values)
+            low, high = (min(values), max(values)) if values else (math.nan, math.nan)
+        else:
+            count, total = sum(result['count']), sum(result['sum'])
+            low = min(result['min']) if count else math.nan
+            high = max(result['max']) if count else math.nan
+        return count, low, high, total / count if count else math.nan
+
+
+if __name__ == '__main__':
+    import sys
+
+    #usage:
+    #  python telemetry_store.py record <dir> [temp_hz] [fan_hz] [psu_hz]
+    #  python telemetry_store.py query <dir> <channel> [seconds] [board]
+    if len(sys.argv) < 3 or sys.argv[1] not in ('record', 'query'):
+        print("Usage: python telemetry_store.py record <dir> [temp_hz] [fan_hz] [psu_hz]")
+        print("       python telemetry_store.py query <dir> <channel> [seconds] [board]")
+        exit(1)
+
+    if sys.argv[1] == 'query':
+        store = TelemetryStore(sys.argv[2])
+        channel = sys.argv[3]
+        seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 3600.0
+        board = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        now = time.time()
+        count, low, high, mean = store.aggregate(now - seconds, now, board, channel)
+        tier = store.pick_tier(now - seconds, now).name
+        print("%s over the last %.0f s (%s tier): n=%d min=%.2f max=%.2f mean=%.2f" % (
+            channel, seconds, tier, count, low, high, mean))
+        store.close()
+        exit(0)
+
+    import serial
+    import telemetry
+
+    rates = [float(arg) for arg in sys.argv[3:6]] + [1.0, 1.0, 0.2][len(sys.argv[3:6]):]
+    try:
+        serial_port_ctrl = serial.Serial(
+            port='/dev/tty.usbmodemb310cc521',  # Update this to your serial port
+            baudrate=115200,
+            timeout=1
+        )
+    except serial.SerialException as e:
+        print(f"Error opening Control serial port: {e}")
+        exit(1)
+
+    store = TelemetryStore(sys.argv[2])
+    poller = telemetry.TelemetryPoller(serial_port_ctrl)
+    telemetry.add_board_signals(poller, temp_hz=rates[0], fan_hz=rates[1], psu_hz=rates[2])
+    poller.start()
+    cursor = 0
+    try:
+        while True:
+            time.sleep(1)
+            cursor = store.drain(poller.ring, cursor, poller.names)
+            store.flush(time.time())
+    except KeyboardInterrupt:
+        print(" -> Stopping the script.")
+    finally:
+        poller.stop()
+        store.drain(poller.ring, cursor, poller.names)
+        store.close()
+        serial_port_ctrl.close()
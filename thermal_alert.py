@@ -0,0 +1,309 @@
+import threading
+import time
+from collections import namedtuple
+
+import APW_PSU
+import TMP75
+import bitcrane
+import psu_cal
+
+#event-driven over-temperature handling from the TMP75 alert limits
+#
+# Every sensor gets t_low / t_high limits and is put in interrupt mode, so it
+# raises ALERT once when it crosses t_high and once when it is back below
+# t_low. The monitor then polls only the SMBus Alert Response Address: one
+# I2C read per interval that answers with the address of an alerting sensor
+# (or nothing). Temperatures are read only for sensors that alerted or are
+# still hot, plus a slow full sweep in case an alert was missed.
+#
+# Reading any TMP75 register clears its interrupt-mode alert, so nothing else
+# may read the monitored sensors. A FanController on the same boards takes
+# its temperature from hottest() instead: hot sensors are read every poll,
+# the rest only on the slow sweep, which is as fresh as a fan loop below
+# t_low needs and costs no extra I2C traffic.
+
+ALERT_POLL_INTERVAL = 0.1       # seconds between alert response reads
+ALERT_FULL_SWEEP = 10.0         # seconds between full temperature sweeps
+ALERT_T_LOW = 75.0              # degrees C, alert clears below this
+ALERT_T_HIGH = 85.0             # degrees C, alert raised above this
+ALERT_T_CRITICAL = 95.0         # degrees C, hashboard held in reset above this
+ALERT_FAULT_QUEUE = 2           # conversions out of limits before ALERT asserts
+ALERT_MAX_AGE = 30.0            # seconds a reading counts for hottest() without a full sweep
+
+EVENT_OVER = 'over'
+EVENT_CRITICAL = 'critical'
+EVENT_CLEAR = 'clear'
+
+ThermalEvent = namedtuple('ThermalEvent', 'time address hashboard temperature kind')
+
+HASHBOARD_RST = {0: bitcrane.GPIO_HB0_RST, 1: bitcrane.GPIO_HB1_RST, 2: bitcrane.GPIO_HB2_RST}
+
+
+class ThermalAlertMonitor:
+    """
+    Watch the hashboard TMP75s through their alert limits.
+
+    Args:
+        ser: Control port (serial.Serial, ControlTransport or a scheduler lane)
+        hashboards: Boards whose two sensors are monitored
+        t_low, t_high: Alert hysteresis band in degrees C
+        t_critical: Temperature that escalates an over-temperature to critical
+        interval: Seconds between alert polls
+        full_sweep: Seconds between reads of every sensor (None to disable)
+        on_event: callback(ThermalEvent), e.g. ThermalReaction(...)
+    """
+
+    def __init__(self, ser, hashboards=(0, 1, 2), t_low=ALERT_T_LOW, t_high=ALERT_T_HIGH, t_critical=ALERT_T_CRITICAL,
+                 interval=ALERT_POLL_INTERVAL, full_sweep=ALERT_FULL_SWEEP, on_event=None, debug=False):
+        if not t_low < t_high <= t_critical:
+            raise ValueError("Limits must satisfy t_low < t_high <= t_critical")
+        self.ser = ser
+        self.t_low = t_low
+        self.t_high = t_high
+        self.t_critical = t_critical
+        self.interval = interval
+        self.full_sweep = full_sweep
+        self.on_event = on_event
+        self.debug = debug
+        self.sensors = {}
+        self.hashboard = {}
+        for hashboard_num in hashboards:
+            for chipnum in (0, 1):
+                sensor = TMP75.TMP75Sensor.on_board(ser, hashboard_num, chipnum, debug)
+                self.sensors[sensor.address] = sensor
+                self.hashboard[sensor.address] = hashboard_num
+        self.state = {address: EVENT_CLEAR for address in self.sensors}
+        self.temperature = {address: None for address in self.sensors}
+        self.read_at = {address: None for address in self.sensors}
+        self.polls = 0
+        self.alerts = 0
+        self.reads = 0
+        self.events = 0
+        self._next_sweep = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def arm(self):
+        """Program limits and interrupt mode on every sensor. Returns the addresses that failed."""
+        failed = []
+        for address, sensor in self.sensors.items():
+            ok = sensor.update_config(TMP75.TMP75_CFG_SD, 0)      # converting continuously
+            if ok:
+                sensor.set_limits(self.t_low, self.t_high)
+                ok = sensor.set_alert_mode(interrupt=True, faults=ALERT_FAULT_QUEUE)
+            if not ok:
+                failed.append(address)
+        self._next_sweep = 0.0
+        return failed
+
+    def alerting(self):
+        """Addresses answering the alert response, each cleared as it answers."""
+        addresses = []
+        for _ in range(len(self.sensors)):
+            address = TMP75.alert_response(self.ser, self.debug)
+            if address is None or address in addresses:
+                break
+            addresses.append(address)
+        return addresses
+
+    def check(self, address):
+        """Read one sensor and move it between clear/over/critical. Returns the ThermalEvent, if any."""
+        temp = self.sensors[address].read_temperature()
+        self.reads += 1
+        if temp is None:
+            return None
+        self.temperature[address] = temp
+        self.read_at[address] = time.monotonic()
+        previous = self.state[address]
+        if temp >= self.t_critical:
+            state = EVENT_CRITICAL
+        elif temp >= self.t_high or (previous != EVENT_CLEAR and temp >= self.t_low):
+            state = EVENT_OVER if previous != EVENT_CRITICAL else EVENT_CRITICAL
+        else:
+            state = EVENT_CLEAR
+        if state == previous:
+            return None
+        self.state[address] = state
+        event = ThermalEvent(time.time(), address, self.hashboard[address], temp, state)
+        self.events += 1
+        if self.debug:
+            print("thermal %s: HB%d sensor %02X at %.2f C" % (state, event.hashboard, address, temp))
+        if self.on_event is not None:
+            self.on_event(event)
+        return event
+
+    def hottest(self, max_age=None):
+        """
+        Hottest temperature read by the monitor, for FanController's
+        temperature_source. Readings older than max_age seconds (default two
+        full sweeps, or ALERT_MAX_AGE without them) are ignored, so a stalled
+        monitor gives None and the fans go to full.
+        """
+        if max_age is None:
+            max_age = 2 * self.full_sweep if self.full_sweep is not None else ALERT_MAX_AGE
+        oldest = time.monotonic() - max_age
+        temps = [temp for address, temp in self.temperature.items()
+                 if temp is not None and self.read_at[address] >= oldest]
+        return max(temps) if temps else None
+
+    def poll(self):
+        """One alert poll. Returns the list of ThermalEvents it produced."""
+        self.polls += 1
+        now = time.monotonic()
+        alerted = [a for a in self.alerting() if a in self.sensors]
+        self.alerts += len(alerted)
+        if self.full_sweep is not None and now >= self._next_sweep:
+            self._next_sweep = now + self.full_sweep
+            addresses = list(self.sensors)
+        else:
+            # alerting sensors, plus hot ones so over can escalate to critical
+            addresses = sorted(set(alerted) | {a for a, state in self.state.items() if state != EVENT_CLEAR})
+        return [event for event in (self.check(address) for address in addresses) if event is not None]
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thermal_alert", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.poll()
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                deadline = time.monotonic()
+            elif self._stop.wait(delay):
+                break
+
+    def stats(self):
+        return {
+            'polls': self.polls,
+            'alerts': self.alerts,
+            'reads': self.reads,
+            'events': self.events,
+            'hot': sorted(a for a, state in self.state.items() if state != EVENT_CLEAR),
+        }
+
+
+class ThermalReaction:
+    """
+    ThermalAlertMonitor callback that acts on the events.
+
+    critical: the hashboard's reset line is asserted before anything else,
+              stopping its ASICs; it stays asserted, the chain has to be
+              re-initialised anyway
+    over:     fans to fan_duty (stopping fan_controller so it doesn't fight),
+              and PSU output lowered by psu_drop volts if set (also done
+              for a critical event if it's the first)
+    clear:    once every sensor is clear, the PSU voltage is restored and
+              fan_controller restarted
+
+    Args:
+        ser: Control port, normally a safety lane
+        fans: Fans to drive when there's no fan_controller
+        fan_controller: Optional running fan_control.FanController, reading its
+                        temperature from the monitor's hottest()
+        psu_drop: Volts to take off the PSU output while hot (None leaves it alone)
+    """
+
+    def __init__(self, ser, fans=(1, 2, 3, 4), fan_duty=100, fan_controller=None, psu_drop=None, debug=False):
+        self.ser = ser
+        self.fans = tuple(fans)
+        self.fan_duty = fan_duty
+        self.fan_controller = fan_controller
+        self.psu_drop = psu_drop
+        self.debug = debug
+        self.hot = set()
+        self.held_in_reset = set()
+        self.psu_restore = None
+        self.log = []
+
+    def __call__(self, event):
+        self.log.append(event)
+        if event.kind == EVENT_CLEAR:
+            self.hot.discard(event.address)
+            if not self.hot:
+                self.cool_down()
+            return
+        first = not self.hot
+        self.hot.add(event.address)
+        if event.kind == EVENT_CRITICAL:
+            self.hold_reset(event.hashboard)     # first: the PSU ramp takes hundreds of ms
+        if first:
+            self.fans_max()
+            self.lower_psu()
+
+    def fans_max(self):
+        if self.fan_controller is not None:
+            self.fan_controller.stop()
+            self.fan_controller.set_duty(self.fan_duty)
+            return
+        for fan_num in self.fans:
+            bitcrane.fan_set_speed(self.ser, 0xAB, fan_num, self.fan_duty, self.debug)
+
+    def lower_psu(self):
+        if self.psu_drop is None or self.psu_restore is not None:
+            return
+        code = psu_cal.read_setpoint(self.ser, self.debug)
+        if code is None:
+            return
+        volts = APW_PSU.converter_for(self.ser).setpoint_volts(code)
+        result = psu_cal.ramp_voltage(self.ser, volts - self.psu_drop, debug=self.debug)
+        if result.code is not None:
+            self.psu_restore = volts
+
+    def hold_reset(self, hashboard_num):
+        if hashboard_num in self.held_in_reset:
+            return
+        if bitcrane.gpio_set(self.ser, 0xAB, HASHBOARD_RST[hashboard_num], bitcrane.GPIO_LOW, self.debug) is not None:
+            self.held_in_reset.add(hashboard_num)
+
+    def cool_down(self):
+        if self.psu_restore is not None:
+            psu_cal.ramp_voltage(self.ser, self.psu_restore, debug=self.debug)
+            self.psu_restore = None
+        if self.fan_controller is not None:
+            self.fan_controller.start()
+
+
+if __name__ == '__main__':
+    import sys
+    import serial
+
+    #usage: python thermal_alert.py [t_low] [t_high] [t_critical]
+    limits = [float(arg) for arg in sys.argv[1:4]]
+    try:
+        serial_port_ctrl = serial.Serial(
+            port='/dev/tty.usbmodemb310cc521',  # Update this to your serial port
+            baudrate=115200,
+            timeout=1
+        )
+    except serial.SerialException as e:
+        print(f"Error opening Control serial port: {e}")
+        exit(1)
+
+    reaction = ThermalReaction(serial_port_ctrl)
+    monitor = ThermalAlertMonitor(serial_port_ctrl, on_event=reaction,
+                                  **dict(zip(('t_low', 't_high', 't_critical'), limits)))
+    failed = monitor.arm()
+    if failed:
+        print("No answer from sensors: %s" % ' '.join("%02X" % a for a in failed))
+    print("Watching for alerts (%.1f / %.1f / %.1f C), Ctrl-C to stop" % (monitor.t_low, monitor.t_high, monitor.t_critical))
+    try:
+        while True:
+            for event in monitor.poll():
+                print("%s HB%d %02X %.2f C" % (event.kind, event.hashboard, event.address, event.temperature))
+            time.sleep(monitor.interval)
+    except KeyboardInterrupt:
+        print(" -> %s" % monitor.stats())
+    serial_port_ctrl.close()